@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+#This software is distributed under the Creative Commons license (CC0) version 1.0. A copy of this license should have been distributed with this software.
+#The license can also be read online: <https://creativecommons.org/publicdomain/zero/1.0/>. If this online license differs from the license provided with this software, the license provided with this software should be applied.
+
+"""
+Measures the performance of the optimise script on synthetic profile
+structures.
+
+The profile structures are generated to be shaped like Cura's resources, but
+with a configurable size. For usage instructions, run the script with the
+"--help" parameter.
+"""
+
+import argparse #To parse the size of the profile structure to generate.
+import configparser #To compare the CFG parser of the optimise script with.
+import json #To read the reports of the optimisation stages.
+import logging #To silence the logging of the optimise script while measuring.
+import os #To write the generated profile structure.
+import random #To generate settings.
+import sys #To find the optimise script.
+import tempfile #To generate the profile structure in a temporary directory.
+import time #To measure how long parsing takes.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))) #Allow running this script from any directory.
+import optimise #The script we're measuring.
+
+def generate_tree(directory, depth=3, fan_out=10, num_settings=100, cardinality=5, material_share=0.5, seed=0):
+	"""
+	Generates a synthetic profile structure shaped like Cura's resources.
+
+	The root directory gets a profile with a value for every setting, like
+	fdmprinter. Below it are ``depth`` levels of directories with ``fan_out``
+	subdirectories each, and the deepest directories contain ``fan_out`` leaf
+	profiles each, like quality profiles. Some of the directories on the level
+	above the leaf directories are named after materials, so that they are
+	treated as material profiles. Each profile changes a few settings to a
+	random value.
+	:param directory: The directory to generate the profile structure in. The
+	root of the profile structure is a subdirectory called "fdmprinter".
+	:param depth: How many levels of directories there are below the root.
+	:param fan_out: How many subdirectories each directory has, and how many
+	leaf profiles each of the deepest directories has.
+	:param num_settings: How many different settings there are.
+	:param cardinality: How many different values each setting can have.
+	:param material_share: Which part of the directories on the level above the
+	leaf directories are material directories. There can be at most one of each
+	material in ``optimise.material_profiles`` per directory.
+	:param seed: The seed for the random generator, to generate the same
+	profile structure every time.
+	:return: The root directory of the generated profile structure.
+	"""
+	generator = random.Random(seed)
+	keys = sorted(optimise.material_settings) + ["setting_{index}".format(index=index) for index in range(max(0, num_settings - len(optimise.material_settings)))]
+	materials = sorted(optimise.material_profiles)
+
+	def random_settings(share):
+		"""
+		Picks random values for a random part of the settings.
+		:param share: Which part of the settings to pick values for.
+		:return: A dictionary of settings.
+		"""
+		return {key: str(generator.randrange(cardinality)) for key in keys if generator.random() < share}
+
+	root = os.path.join(directory, "fdmprinter")
+	pending = [(root, "fdmprinter", 0)]
+	while pending:
+		path, name, level = pending.pop()
+		os.makedirs(path)
+		settings = {key: str(generator.randrange(cardinality)) for key in keys} if level == 0 else random_settings(0.05)
+		write_profile(os.path.join(path, name + ".inst.cfg"), name, settings)
+		if level < depth: #Inner directory.
+			num_materials = round(fan_out * material_share) if level == depth - 1 else 0
+			for index in range(fan_out):
+				child_name = materials[index] if index < min(num_materials, len(materials)) else "{name}_{index}".format(name=name, index=index)
+				pending.append((os.path.join(path, child_name), child_name, level + 1))
+		else: #Leaf directory.
+			for index in range(fan_out):
+				leaf_name = "{name}_quality_{index}".format(name=name, index=index)
+				write_profile(os.path.join(path, leaf_name + ".inst.cfg"), leaf_name, random_settings(0.2))
+	return root
+
+def write_profile(file, name, settings):
+	"""
+	Writes a synthetic quality profile.
+	:param file: The path of the file to write.
+	:param name: The name of the profile.
+	:param settings: A dictionary with the settings of the profile.
+	"""
+	with open(file, "w") as profile_file:
+		profile_file.write("[general]\nversion = 2\nname = {name}\n\n[metadata]\ntype = quality\n\n[values]\n".format(name=name))
+		for key, value in settings.items():
+			profile_file.write("{key} = {value}\n".format(key=key, value=value))
+
+def benchmark(engines, optimise_jobs=1, **tree_parameters):
+	"""
+	Generates a synthetic profile structure and measures each stage of
+	optimising it.
+	:param engines: The engines to optimise the profile structure with, as
+	accepted by ``optimise.optimise``.
+	:param optimise_jobs: How many processes to bubble and remove
+	redundancies with.
+	:param tree_parameters: Parameters for ``generate_tree``.
+	:return: A dictionary with the report of ``optimise.StageProfiler`` for
+	each engine.
+	"""
+	reports = {}
+	original_directory = os.getcwd()
+	with tempfile.TemporaryDirectory() as temporary_directory:
+		os.chdir(temporary_directory) #The output keeps the path of the input, so generate the input at a relative path.
+		try:
+			generate_tree(".", **tree_parameters)
+			for engine in engines:
+				stages_file = "{engine}.json".format(engine=engine)
+				optimise.optimise("fdmprinter", os.path.join("output", engine), engine=engine, stages_file=stages_file, optimise_jobs=optimise_jobs)
+				with open(stages_file) as report_file:
+					reports[engine] = json.load(report_file)
+		finally:
+			os.chdir(original_directory)
+	return reports
+
+def benchmark_parsers(**tree_parameters):
+	"""
+	Generates a synthetic profile structure and measures how long it takes to
+	parse all of its files, with the CFG parser of the optimise script and with
+	ConfigParser.
+	:param tree_parameters: Parameters for ``generate_tree``.
+	:return: A dictionary with the number of files parsed and the time in
+	seconds that each parser took.
+	"""
+	with tempfile.TemporaryDirectory() as temporary_directory:
+		root = generate_tree(temporary_directory, **tree_parameters)
+		files = [os.path.join(directory, file) for directory, _, directory_files in os.walk(root) for file in directory_files]
+		report = {"files": len(files)}
+		for name, parse in (("optimise", optimise.parse_cfg), ("configparser", parse_cfg_configparser)):
+			start_time = time.perf_counter()
+			for file in files:
+				parse(file)
+			report[name] = time.perf_counter() - start_time
+	return report
+
+def benchmark_memory(**tree_parameters):
+	"""
+	Generates a synthetic profile structure and measures how much memory the
+	setting keys, values and base configs of its profiles take, compared to
+	how much they would take if every profile had its own copies.
+	:param tree_parameters: Parameters for ``generate_tree``.
+	:return: A dictionary with the number of profiles, settings and references
+	to strings and base configs in them, the number of distinct objects that
+	these references point to, and the size in bytes of all references if
+	each were a separate object and of the distinct objects.
+	"""
+	with tempfile.TemporaryDirectory() as temporary_directory:
+		profile_root = optimise.get_profiles(generate_tree(temporary_directory, **tree_parameters))
+	report = {"profiles": 0, "settings": 0, "objects": 0, "distinct_objects": 0, "bytes": 0, "distinct_bytes": 0}
+	seen = set() #IDs of the objects that were already counted.
+
+	def count(obj):
+		"""
+		Counts an object and everything in it, if it is a tuple.
+		:param obj: The object to count.
+		"""
+		size = sys.getsizeof(obj)
+		report["objects"] += 1
+		report["bytes"] += size
+		if id(obj) not in seen:
+			seen.add(id(obj))
+			report["distinct_objects"] += 1
+			report["distinct_bytes"] += size
+		if isinstance(obj, tuple):
+			for item in obj:
+				count(item)
+
+	for profile in optimise.ProfileTraversal(profile_root).profiles:
+		report["profiles"] += 1
+		report["settings"] += len(profile.settings)
+		for key, value in profile.settings.items():
+			count(key)
+			count(value)
+		count(profile.baseconfig)
+	return report
+
+def parse_cfg_configparser(file):
+	"""
+	Parses a CFG file with ConfigParser into the same sections as
+	``optimise.parse_cfg`` keeps, as a reference to compare the speed of that
+	parser with.
+	:param file: The file path of the file to parse.
+	:return: The sections that ``optimise.parse_cfg`` would keep of the file, as
+	dictionaries of their keys and values.
+	"""
+	data = configparser.ConfigParser()
+	data.read(file)
+	return {section: dict(data[section]) for section in ("general", "metadata", "values") if data.has_section(section)}
+
+def print_reports(reports):
+	"""
+	Prints the reports of a benchmark as a table.
+	:param reports: The reports of each engine, as returned by ``benchmark``.
+	"""
+	print("{engine:<9} {stage:<31} {wall:>10} {cpu:>10} {memory:>12} {profiles:>9} {settings:>10}".format(engine="engine", stage="stage", wall="wall (s)", cpu="cpu (s)", memory="peak (MiB)", profiles="profiles", settings="settings"))
+	for engine, report in reports.items():
+		for stage in report["stages"]:
+			print("{engine:<9} {stage:<31} {wall:>10.3f} {cpu:>10.3f} {memory:>12.1f} {profiles:>9} {settings:>10}".format(engine=engine, stage=stage["stage"], wall=stage["wall_time"], cpu=stage["cpu_time"], memory=stage["peak_traced_memory"] / 1024 / 1024, profiles=stage["profiles"], settings=stage["settings"]))
+		total = report["total"]
+		print("{engine:<9} {stage:<31} {wall:>10.3f} {cpu:>10.3f} {memory:>12.1f}".format(engine=engine, stage="total", wall=total["wall_time"], cpu=total["cpu_time"], memory=total["peak_traced_memory"] / 1024 / 1024))
+
+if __name__ == "__main__":
+	argument_parser = argparse.ArgumentParser(description="Measure the performance of optimising a synthetic set of profiles for Cura.")
+	argument_parser.add_argument("--depth", dest="depth", type=int, help="How many levels of directories to generate below the root.", default=3)
+	argument_parser.add_argument("--fan-out", dest="fan_out", type=int, help="How many subdirectories or leaf profiles each directory has.", default=10)
+	argument_parser.add_argument("--settings", dest="num_settings", type=int, help="How many different settings there are.", default=100)
+	argument_parser.add_argument("--cardinality", dest="cardinality", type=int, help="How many different values each setting can have.", default=5)
+	argument_parser.add_argument("--material-share", dest="material_share", type=float, help="Which part of the directories above the leaf directories are materials.", default=0.5)
+	argument_parser.add_argument("--seed", dest="seed", type=int, help="Seed for generating the settings.", default=0)
+	argument_parser.add_argument("--engine", dest="engines", action="append", choices=["dict", "lazy", "fused", "streaming", "compact", "numpy"], help="Engine to measure. Can be given multiple times to compare them.")
+	argument_parser.add_argument("--optimise-jobs", dest="optimise_jobs", type=int, help="How many processes to bubble and remove redundancies with.", default=1)
+	argument_parser.add_argument("--parsers", dest="parsers", action="store_true", help="Compare the speed of parsing the profiles with ConfigParser instead of measuring the engines.")
+	argument_parser.add_argument("--memory", dest="memory", action="store_true", help="Measure how much memory sharing the setting keys, values and metadata of the profiles saves instead of measuring the engines.")
+	argument_parser.add_argument("--json", dest="json_file", help="File to write the reports to as JSON, in addition to printing them.", default=None)
+	arguments = argument_parser.parse_args()
+	logging.getLogger().setLevel(logging.WARNING) #Logging every profile would dominate the measurements.
+	tree_parameters = {"depth": arguments.depth, "fan_out": arguments.fan_out, "num_settings": arguments.num_settings, "cardinality": arguments.cardinality, "material_share": arguments.material_share, "seed": arguments.seed}
+	if arguments.parsers:
+		reports = benchmark_parsers(**tree_parameters)
+		print("Parsed {files} files in {optimise:.3f}s, or in {configparser:.3f}s with ConfigParser.".format(**reports))
+	elif arguments.memory:
+		reports = benchmark_memory(**tree_parameters)
+		print("{profiles} profiles with {settings} settings refer to {objects} strings and base configs of {megabytes:.1f} MiB, which share {distinct_objects} objects of {distinct_megabytes:.1f} MiB.".format(megabytes=reports["bytes"] / 1024 / 1024, distinct_megabytes=reports["distinct_bytes"] / 1024 / 1024, **reports))
+	else:
+		reports = benchmark(arguments.engines or ["dict"], arguments.optimise_jobs, **tree_parameters)
+		print_reports(reports)
+	if arguments.json_file:
+		with open(arguments.json_file, "w") as json_file:
+			json.dump(reports, json_file, indent="\t")
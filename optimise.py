@@ -11,30 +11,57 @@ For usage instructions, run the script with the "--help" parameter.
 """
 
 import argparse #To parse the input and output directories.
-import configparser #To parse and write .cfg files.
+import array #To store the settings of profiles compactly.
+import collections #To flatten profiles lazily with chained dictionaries.
+import concurrent.futures #To parse files and optimise subtrees in parallel.
+import configparser #To report errors in .cfg files the same way as ConfigParser.
+import contextlib #To measure the stages of the optimisation.
+import contextvars #To configure each optimisation separately, even if they run concurrently.
+import csv #To write reports of what the optimisation changed.
+import hashlib #To detect which files changed since the previous run.
+import io #To write files to tar archives from memory.
 import json #To parse .json files.
 import logging
 import os #To get the current working directory as defaults for input and output, and for file path operations.
+import pickle #To store the cache between runs.
+import sys #To know the unit of peak memory usage on this platform.
+import tarfile #To read and write profile structures in tar archives.
+import threading #To write to archives and files from multiple threads.
+import time #To measure how long the stages of the optimisation take.
+import tracemalloc #To measure how much memory the stages of the optimisation take.
+import xml.etree.ElementTree #To parse .fdm_material files.
+import zipfile #To read and write profile structures in zip archives.
 
-#Global configuration stuff.
-bubble_from_depth = 0
-track_setting = ""
-logging.basicConfig(level=logging.DEBUG)
+try:
+	import resource #To measure the peak memory usage of the process.
+except ImportError: #Not available on Windows.
+	resource = None
+
+try:
+	import numpy #To bubble common values in batches with the numpy engine.
+except ImportError: #NumPy is optional. Only the numpy engine needs it.
+	numpy = None
+
+#Global configuration stuff. Everything else is configured per optimisation with ``Options``.
+tracked_setting = contextvars.ContextVar("tracked_setting", default="") #If set, changes to this setting are logged. Checked once per profile, so it costs nothing per setting.
+parse_worker_source = None #In the processes that parse files in parallel, the source to parse them from. See ``start_parse_worker``.
 class Profile:
-	def __init__(self, filepath: str="Unknown", settings=None, subprofiles=None, baseconfig=None, weight=1): #The `None` are sentry values.
+	__slots__ = ("filepath", "settings", "subprofiles", "baseconfig", "weight", "kind") #There are many profiles, so don't give each of them a dictionary of attributes.
+
+	def __init__(self, filepath: str="Unknown", settings=None, subprofiles=None, baseconfig=(), weight=1, kind=None): #The `None` are sentry values.
 		if not settings:
 			settings = {}
 		if not subprofiles:
 			subprofiles = []
-		if not baseconfig:
-			baseconfig = configparser.ConfigParser()
 		self.filepath = filepath #Path string.
 		self.settings = settings #Dictionary of settings.
 		self.subprofiles = subprofiles #Set of other Profile instances.
-		self.baseconfig = baseconfig #ConfigParser instance without all the settings filled in.
+		self.baseconfig = baseconfig #Sections of the file without the settings, as tuples of section names and tuples of key-value pairs.
 		self.weight = weight #How much the profile counts in the decision which is the most common value. Equal to the number of leaf profiles.
+		self.kind = kind or classify_profile(filepath, baseconfig) #"material", "main" for the main profile of a directory, or "leaf".
 
-material_profiles = {"PLA", "ABS", "CPE", "Nylon", "PVA", "CPEP", "PC", "TPU"} #Material profiles can only have material settings. TODO: Don't hard-code these, but get them based on XML input.
+material_profiles = {"PLA", "ABS", "CPE", "Nylon", "PVA", "CPEP", "PC", "TPU"} #Material profiles can only have material settings. These names are material profiles even if their metadata doesn't say so.
+material_extensions = {".fdm_material"} #Files with these extensions are always material profiles.
 material_settings = {
 	"default_material_print_temperature": "print temperature",
 	"material_bed_temperature": "heated bed temperature",
@@ -44,6 +71,7 @@ material_settings = {
 	"retraction_amount": "retraction amount",
 	"retraction_speed": "retraction speed"
 }
+material_setting_keys = {name: key for key, name in material_settings.items()} #The setting key of each setting name in material files.
 per_extruder_warning_settings = {"support_enable",
                                  "adhesion_extruder_nr", "support_extruder_nr", "support_infill_extruder_nr", "support_roof_extruder_nr", "support_bottom_extruder_nr", "support_extruder_nr_layer_0",
                                  "prime_tower_position_x", "prime_tower_position_y",
@@ -53,69 +81,423 @@ per_extruder_warning_settings = {"support_enable",
                                  #TODO: Machine settings.
                                 }
 
-def optimise(input_dir, output_dir):
+class Options:
+	"""
+	The configuration of an optimisation.
+
+	Each optimisation gets its own options, so that the optimiser can be used
+	repeatedly in the same process with different configurations.
+	"""
+
+	def __init__(self, bubble_from_depth=0, track_setting="", jobs=1, engine="dict", cache_file=None, skip_unchanged=False, write_jobs=1, stages_file=None, optimise_jobs=1, dry_run=False, report_file=None, solver="greedy"):
+		"""
+		Creates the configuration of an optimisation.
+		:param bubble_from_depth: How many levels of profiles to retain. These
+		levels are not changed by bubbling. If 0, settings are bubbled all the
+		way up to the root.
+		:param track_setting: A setting key to log every change of, to debug. If
+		empty, nothing is tracked.
+		:param jobs: How many processes to parse the input files with.
+		:param engine: How to store the settings while optimising. Either "dict"
+		to keep a dictionary of settings in each profile, "lazy" to let each
+		profile look up the settings it inherits in its parents instead of
+		copying them, "fused" to keep a dictionary of settings in each profile
+		but bubble the common values and remove redundancies in a single pass,
+		"streaming" to do that while reading and writing the profiles so that
+		only a few directories are in memory at the same time (see
+		``optimise_streaming``) but without a cache file and with only one job
+		to read and write with, "compact" to store them as arrays of interned
+		values in a ``CompactProfiles`` table, or "numpy" to also bubble them
+		with NumPy.
+		:param cache_file: A file to cache parsed profiles and optimisation
+		results in between runs, so that only what changed gets recomputed. If
+		``None``, nothing is cached.
+		:param skip_unchanged: Whether to skip writing output files that already
+		have the right contents, and to replace the other files atomically.
+		:param write_jobs: How many threads to write the output files with.
+		:param stages_file: A file to write a JSON report to, with the time and
+		memory that each stage took. If ``None``, the stages are not measured.
+		:param optimise_jobs: How many processes to bubble the common values and
+		remove redundancies with. The subtrees below the root are optimised in
+		parallel. Not used by the compact and numpy engines.
+		:param dry_run: Whether to only optimise the profiles, without writing
+		them. Neither the output nor the cache is touched.
+		:param report_file: A file to write a report to, with the number of
+		settings and the estimated size of each profile before and after the
+		optimisation. It is written as CSV if the file name ends in ".csv", or
+		as JSON otherwise. If ``None``, no report is made.
+		:param solver: How to choose the values to bubble up. Either "greedy" to
+		take the most common value among the subprofiles of each profile, or
+		"exact" to choose the values with which the fewest settings remain (see
+		``bubble_optimal_values``). The exact solver takes longer, only works
+		with the dict, lazy and fused engines and only with one optimise job.
+		The greedy solver takes the weights of the profiles into account, the
+		exact solver doesn't.
+		"""
+		self.bubble_from_depth = bubble_from_depth
+		self.track_setting = track_setting
+		self.jobs = jobs
+		self.engine = engine
+		self.cache_file = cache_file
+		self.skip_unchanged = skip_unchanged
+		self.write_jobs = write_jobs
+		self.stages_file = stages_file
+		self.optimise_jobs = optimise_jobs
+		self.dry_run = dry_run
+		self.report_file = report_file
+		self.solver = solver
+
+def combine_options(options, option_values):
+	"""
+	Combines the options given to ``optimise`` or ``watch``.
+	:param options: The ``Options`` to start from. If ``None``, the default
+	options are used.
+	:param option_values: A dictionary of options to use instead of the ones in
+	``options``, with the same names as the parameters of ``Options``.
+	:return: The combined ``Options``.
+	"""
+	if option_values:
+		return Options(**dict(vars(options) if options else {}, **option_values))
+	return options or Options()
+
+def optimise(source, sink, options=None, **option_values):
 	"""
 	Performs the optimisation.
 
-	Files are taken from the input directory in its appropriate structure,
-	flattened, the common denominator is taken, and everything is then written
-	to the output directories.
-	:param input_dir: The root directory of the input profile structure.
-	:param output_dir: The root directory of the output profile structure.
+	Files are taken from the source in their appropriate structure, flattened,
+	the common denominator is taken, and everything is then written to the
+	sink.
+
+	Nothing is stored between calls apart from the cache file, so this can be
+	called repeatedly, also from multiple threads at the same time.
+	:param source: Where to read the input profile structure from. Either a
+	source like ``DirectorySource`` or ``MemorySource``, or the path to the
+	root directory of the profile structure.
+	:param sink: Where to write the output profile structure to. Either a sink
+	like ``DirectorySink`` or ``MemorySink``, or the path to a directory.
+	:param options: The ``Options`` to optimise with. If ``None``, the default
+	options are used.
+	:param option_values: Options to use instead of the ones in ``options``,
+	with the same names as the parameters of ``Options``.
+	"""
+	options = combine_options(options, option_values)
+	token = tracked_setting.set(options.track_setting)
+	try:
+		with open_source(source) as source, open_sink(sink) as sink:
+			optimise_with_options(source, sink, options)
+	finally:
+		tracked_setting.reset(token)
+
+def optimise_with_options(source, sink, options, cache=None):
 	"""
-	profile_root = get_profiles(input_dir)
-	flatten_profiles(profile_root)
-	bubble_common_values(profile_root, bubble_from_depth)
-	remove_redundancies(profile_root)
-	write_profiles(output_dir, profile_root)
+	Performs the optimisation with a source and sink that are already opened.
+
+	The setting to track must already be set in ``tracked_setting``.
+	:param source: The source to read the input profile structure from.
+	:param sink: The sink to write the output profile structure to.
+	:param options: The ``Options`` to optimise with.
+	:param cache: The ``ProfileCache`` to use. If ``None``, it is loaded from
+	the cache file in the options, if any.
+	"""
+	if options.solver == "exact" and options.engine not in {"dict", "lazy", "fused"}:
+		raise ValueError("The exact solver doesn't work with the {engine} engine.".format(engine=options.engine))
+	if options.solver == "exact" and options.optimise_jobs > 1:
+		raise ValueError("The exact solver can't optimise with multiple processes.")
+	if options.engine == "streaming" and options.cache_file:
+		raise ValueError("The streaming engine doesn't use a cache file.")
+	if options.engine == "streaming" and (options.jobs > 1 or options.write_jobs > 1):
+		raise ValueError("The streaming engine reads and writes the profiles in a single process.")
+	profiler = StageProfiler(enabled=options.stages_file is not None)
+	report = SizeReport() if options.report_file else None
+	if options.engine == "streaming": #Reads, optimises and writes each directory in turn, so there are no separate stages.
+		counts = (0, 0, 0)
+		with profiler.stage("optimise_streaming", lambda: (counts[0], counts[2])):
+			counts = optimise_streaming(source, sink, options.bubble_from_depth, options.skip_unchanged, options.dry_run, report)
+		num_profiles, num_settings, num_optimised_settings = counts
+		logging.info("Read {profiles} profiles with {settings} settings from {source}.".format(profiles=num_profiles, settings=num_settings, source=source))
+		logging.info("Optimised {profiles} profiles from {settings} to {optimised_settings} settings.".format(profiles=num_profiles, settings=num_settings, optimised_settings=num_optimised_settings))
+		if not options.dry_run:
+			logging.info("Wrote {profiles} profiles to {sink}.".format(profiles=num_profiles, sink=sink))
+		if report:
+			report.write(options.report_file)
+		if options.stages_file:
+			profiler.write(options.stages_file)
+		return
+
+	if cache is None and options.cache_file:
+		cache = ProfileCache(options.cache_file)
+	with profiler.stage("get_profiles", lambda: count_settings(profile_root)):
+		profile_root = get_profiles(source, options.jobs, cache)
+	num_profiles, num_settings = count_settings(profile_root)
+	logging.info("Read {profiles} profiles with {settings} settings from {source}.".format(profiles=num_profiles, settings=num_settings, source=source))
+	if report:
+		for profile in ProfileTraversal(profile_root).profiles:
+			report.before(profile)
+	traversal = None
+	if options.engine in {"compact", "numpy"}:
+		with profiler.stage("flatten_profiles", lambda: compact.count_settings()):
+			compact = NumpyProfiles(profile_root) if options.engine == "numpy" else CompactProfiles(profile_root)
+			compact.flatten_profiles()
+		with profiler.stage("bubble_common_values", lambda: compact.count_settings()):
+			compact.bubble_common_values(options.bubble_from_depth)
+		with profiler.stage("remove_redundancies", lambda: count_settings(profile_root)):
+			compact.remove_redundancies()
+			compact.store()
+	else:
+		with profiler.stage("flatten_profiles", lambda: count_settings(profile_root)):
+			traversal = ProfileTraversal(profile_root) #The structure doesn't change any more, so all stages can visit the profiles in this order.
+			keys_below = find_keys_below(profile_root, traversal) #Must be found before flattening, when only the settings in the files are in the profiles.
+			flatten_profiles(profile_root, lazy=options.engine == "lazy", traversal=traversal)
+		if options.solver == "exact": #Needs to see the whole structure at once, so it can't be fused or split over processes.
+			if cache: #The exact solver doesn't use the changes that bubbling made, but keep them for the next run that does.
+				cache.used_bubbled.update(cache.bubbled)
+			with profiler.stage("bubble_optimal_values", lambda: count_settings(profile_root)):
+				bubble_optimal_values(profile_root, options.bubble_from_depth, keys_below, traversal)
+			with profiler.stage("remove_redundancies", lambda: count_settings(profile_root)):
+				remove_redundancies(profile_root, traversal=traversal)
+		else:
+			memo = None
+			if cache:
+				memo = cache.bubble_memo(subtree_digests(profile_root, cache.digests, options.bubble_from_depth, traversal))
+			if options.engine == "fused" or options.optimise_jobs > 1:
+				with profiler.stage("bubble_and_remove_redundancies", lambda: count_settings(profile_root)):
+					bubble_and_remove_redundancies_parallel(profile_root, options.bubble_from_depth, options.optimise_jobs, memo, keys_below, traversal)
+			else:
+				with profiler.stage("bubble_common_values", lambda: count_settings(profile_root)):
+					bubble_common_values(profile_root, options.bubble_from_depth, memo, keys_below, traversal)
+				with profiler.stage("remove_redundancies", lambda: count_settings(profile_root)):
+					remove_redundancies(profile_root, traversal=traversal)
+	_, num_optimised_settings = count_settings(profile_root)
+	logging.info("Optimised {profiles} profiles from {settings} to {optimised_settings} settings.".format(profiles=num_profiles, settings=num_settings, optimised_settings=num_optimised_settings))
+	if report:
+		for profile in (traversal or ProfileTraversal(profile_root)).profiles:
+			report.after(profile)
+		report.write(options.report_file)
+	if not options.dry_run:
+		with profiler.stage("write_profiles", lambda: count_settings(profile_root)):
+			write_profiles(sink, profile_root, cache, options.skip_unchanged, options.write_jobs, traversal)
+		logging.info("Wrote {profiles} profiles to {sink}.".format(profiles=num_profiles, sink=sink))
+		if cache:
+			cache.save()
+	if options.stages_file:
+		profiler.write(options.stages_file)
+
+def watch(input_directory, sink, options=None, interval=1, rounds=None, **option_values):
+	"""
+	Optimises a profile structure again every time that its files change.
+
+	The optimised profiles are kept in memory in a ``WatchedProfiles``. When
+	only the contents of leaf profiles change, only those files are parsed
+	again, only the profiles above them are bubbled again and only the output
+	files that change are written again. Other changes optimise the whole
+	profile structure again, but only parse the files that changed. The
+	directory is polled for changes.
+
+	The profiles in memory are stored as dictionaries, so the engine and the
+	number of optimise jobs are not used. With the exact solver, or with a
+	report or stages file, the whole profile structure is optimised again with
+	all options after every change instead, with only the parsed profiles and
+	written files kept in memory like the cache file keeps them between runs.
+
+	If an optimisation fails, for instance because a file was only partly
+	saved, the error is logged and the next change is waited for.
+	:param input_directory: The root directory of the input profile structure.
+	:param sink: Where to write the output profile structure to, as accepted
+	by ``optimise``.
+	:param options: The ``Options`` to optimise with. If ``None``, the default
+	options are used. If the options have a cache file, it is loaded at the
+	start and saved after each optimisation.
+	:param interval: How many seconds to wait between polls.
+	:param rounds: How many times to poll before returning. The profiles are
+	optimised in the first round. If ``None``, this never returns.
+	:param option_values: Options to use instead of the ones in ``options``,
+	with the same names as the parameters of ``Options``.
+	"""
+	options = combine_options(options, option_values)
+	token = tracked_setting.set(options.track_setting)
+	try:
+		source = WatchedSource(input_directory)
+		cache = ProfileCache(options.cache_file)
+		resident = options.solver == "greedy" and not options.report_file and not options.stages_file #Whether the optimised profiles can be kept in memory.
+		profiles = None #The optimised profiles in memory, if they are up to date with the files.
+		snapshot = None
+		round_number = 0
+		while rounds is None or round_number < rounds:
+			if round_number > 0:
+				time.sleep(interval)
+			round_number += 1
+			new_snapshot = source.snapshot()
+			if new_snapshot == snapshot:
+				continue
+			changed = []
+			if snapshot is not None:
+				changed = sorted(file for file in new_snapshot.keys() | snapshot.keys() if new_snapshot.get(file) != snapshot.get(file))
+				logging.info("Changed: {files}".format(files=", ".join(changed)))
+			snapshot = new_snapshot
+			try:
+				if not resident:
+					with open_sink(sink) as opened_sink:
+						optimise_with_options(source, opened_sink, options, cache)
+					cache.next_run()
+				elif profiles is None:
+					profiles = WatchedProfiles(source, sink, options, cache)
+				else:
+					profiles.update(changed)
+			except Exception as error: #Keep watching, so that the author can fix the file.
+				logging.error("Optimising {source} failed: {error}".format(source=source, error=error))
+				profiles = None #May be partly updated, so read everything again after the next change.
+	finally:
+		tracked_setting.reset(token)
 
 #################################MAIN STAGES####################################
 
-def get_profiles(input_dir):
+def get_profiles(source, jobs=1, cache=None):
 	"""
 	Gets the profile structure described in the input directory.
 
 	Each profile is completely flat, meaning that its settings contain every key
 	known in the input directory.
-	:param input_dir: The root of the input directory structure.
-	:return: The root profile of the profile structure in the input directory.
-	"""
-	logging.info("Reading profiles in {directory}.".format(directory=input_dir))
-
-	files = [file for file in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, file))]
-	files.sort()
-	directories = [directory for directory in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, directory))]
-	directories.sort()
-
-	if not files and not directories:
-		raise FileNotFoundError("Input directory is empty. This is probably not what you intended.")
-
-	#Find the base file.
-	this_directory = os.path.split(input_dir)[-1]
-	for file in files:
-		if is_main_file(file, this_directory): #Named similarly.
-			base_profile = parse(os.path.join(input_dir, file))
-			base_profile.weight = 0
-			break
-	else: #There was no common file for this directory.
-		base_profile = Profile(filepath=os.path.join(input_dir, this_directory + ".inst.cfg"), weight=0)
-
-	if directories: #Not a leaf node.
-		for directory in directories:
-			subprofile = get_profiles(os.path.join(input_dir, directory))
-			base_profile.subprofiles.append(subprofile)
-			base_profile.weight += subprofile.weight
-	else: #Leaf node.
+
+	The directory structure is discovered first. Only then are the files
+	parsed, optionally in parallel, after which the profiles are assembled in
+	the same order as the directory structure.
+	:param source: The source to read the profile structure from, or the path
+	to the root of the input directory structure.
+	:param jobs: How many processes to parse the files with. If 1, the files are
+	parsed in this process.
+	:param cache: A ``ProfileCache`` to get the profiles from if their files
+	didn't change, and to store the newly parsed profiles in. If ``None``, all
+	files are parsed.
+	:return: The root profile of the profile structure in the source.
+	"""
+	with open_source(source) as source:
+		layout = find_profiles(source)
+
+		files = []
+		pending = [layout]
+		while pending: #Collect all files to parse, in the order of the directory structure.
+			_, main_file, leaf_files, subdirectories = pending.pop()
+			if main_file:
+				files.append(main_file)
+			files.extend(leaf_files)
+			pending.extend(reversed(subdirectories))
+
+		parsed = {}
+		interned = {} #Shared copies of the strings and base configs of this profile structure. See ``intern_profile``.
+		if cache:
+			for file in files:
+				profile = cache.load(file, source)
+				if profile:
+					parsed[file] = intern_profile(profile, interned)
+			files = [file for file in files if file not in parsed]
+
+		if jobs > 1:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=start_parse_worker, initargs=(source,)) as pool: #Each process gets the source once, instead of with every chunk of files. Sources in memory hold the contents of all files.
+				chunk_size = max(1, len(files) // (jobs * 4)) #Large enough chunks to limit the inter-process overhead, small enough to balance the load.
+				parsed.update(zip(files, map(lambda profile: intern_profile(profile, interned), pool.map(parse_in_worker, files, chunksize=chunk_size)))) #Interned in this process, since each process has its own copies of the strings.
+		else:
+			parsed.update((file, intern_profile(source.parse(file), interned)) for file in files)
+
+		if cache:
+			for file in files:
+				cache.store(file, parsed[file])
+
+		return assemble_profiles(layout, parsed)
+
+def start_parse_worker(source):
+	"""
+	Prepares a process that parses files for ``get_profiles``.
+	:param source: The source to parse the files from.
+	"""
+	global parse_worker_source
+	parse_worker_source = source
+
+def parse_in_worker(file):
+	"""
+	Parses a file in a process that was prepared by ``start_parse_worker``.
+	:param file: The path of the file.
+	:return: A ``Profile`` with the settings in the file.
+	"""
+	return parse_worker_source.parse(file)
+
+def find_profiles(source):
+	"""
+	Discovers the files that make up the profile structure in a source, without
+	parsing them.
+	:param source: The source to read the profile structure from.
+	:return: A tuple containing the directory, the path to its main file (or
+	``None`` if it has none), the paths to its leaf files and the same kind of
+	tuple for each of its subdirectories. Leaf files are only listed if the
+	directory has no subdirectories.
+	"""
+	root_layout = None
+	pending = [(source.root, None)] #Directories to discover, with the list of subdirectory layouts of their parent to add them to.
+	while pending:
+		directory, parent_subdirectories = pending.pop()
+		logging.debug("Reading profiles in {directory}.".format(directory=directory))
+
+		files, directories = source.list_directory(directory)
+
+		if not files and not directories:
+			raise FileNotFoundError("Input directory is empty. This is probably not what you intended.")
+
+		#Find the base file.
+		this_directory = os.path.split(directory)[-1]
+		main_file = None
 		for file in files:
-			if is_main_file(file, this_directory): #This is the parent file.
-				continue
-			profile = parse(os.path.join(input_dir, file)) #Act as if every file is in its own subdirectory.
-			base_profile.subprofiles.append(profile)
-			base_profile.weight += profile.weight
+			if is_main_file(file, this_directory): #Named similarly.
+				main_file = os.path.join(directory, file)
+				break
+
+		if directories: #Not a leaf node.
+			leaf_files = []
+		else:
+			leaf_files = [os.path.join(directory, file) for file in files if not is_main_file(file, this_directory)] #Act as if every file is in its own subdirectory.
+		layout = (directory, main_file, leaf_files, [])
+		if parent_subdirectories is None:
+			root_layout = layout
+		else:
+			parent_subdirectories.append(layout)
+		pending.extend((os.path.join(directory, subdirectory), layout[3]) for subdirectory in reversed(directories)) #Reversed, so that they are discovered and added in order.
+	return root_layout
 
-	return base_profile
+def assemble_profiles(layout, parsed):
+	"""
+	Builds the profile structure from a discovered directory layout and the
+	profiles parsed from its files.
+	:param layout: The directory layout, as returned by ``find_profiles``.
+	:param parsed: A dictionary mapping each file path in the layout to the
+	profile parsed from it.
+	:return: The root profile of the profile structure.
+	"""
+	def base_profile(layout):
+		directory, main_file, _, _ = layout
+		if main_file:
+			profile = parsed[main_file]
+			profile.weight = 0
+		else: #There was no common file for this directory.
+			profile = Profile(filepath=os.path.join(directory, os.path.split(directory)[-1] + ".inst.cfg"), weight=0)
+		if profile.kind != "material":
+			profile.kind = "main"
+		return profile
 
-def flatten_profiles(profile, parent=None):
+	profile_root = base_profile(layout)
+	pending = [(layout, profile_root)]
+	while pending:
+		(_, _, leaf_files, subdirectories), profile = pending.pop()
+		for subdirectory in subdirectories:
+			subprofile = base_profile(subdirectory)
+			profile.subprofiles.append(subprofile)
+			pending.append((subdirectory, subprofile))
+		for file in leaf_files:
+			profile.subprofiles.append(parsed[file])
+
+	for profile in reversed(ProfileTraversal(profile_root).profiles): #Subprofiles before their parents, so that their weights are known.
+		if profile.subprofiles:
+			profile.weight = sum(subprofile.weight for subprofile in profile.subprofiles)
+	return profile_root
+
+def flatten_profiles(profile, parent=None, lazy=False, traversal=None):
 	"""
 	Flattens a profile, instantiating all settings that it inherits from its
 	parents.
@@ -124,19 +506,32 @@ def flatten_profiles(profile, parent=None):
 	:param profile: The profile to flatten.
 	:param parent: The parent of this profile. If not provided, a copy of the
 	input file is returned.
+	:param lazy: Whether to flatten lazily. If lazy, the settings are not copied
+	from the parent, but the settings of the profile become a ``ChainMap``
+	that looks up the settings in the profile and then in its ancestors. The
+	parent must then have been flattened lazily too.
+	:param traversal: The ``ProfileTraversal`` of the profile, if it was already
+	computed.
 	"""
-	logging.info("Flattening {file}.".format(file=profile.filepath))
-	if parent:
-		for key, value in parent.settings.items():
-			if key not in profile.settings: #Only inherit settings that are not specified in the profile itself.
-				if key == track_setting:
-					logging.debug("Flattening adds {key}.".format(key=key))
-				profile.settings[key] = value
+	track_setting = tracked_setting.get()
+	traversal = traversal or ProfileTraversal(profile)
+	profiles = traversal.profiles
+	parents = traversal.parents
+	for index, profile in enumerate(profiles): #Parents come before their subprofiles, so they are already flat.
+		profile_parent = profiles[parents[index]] if index else parent
+		if lazy:
+			if profile_parent:
+				profile.settings = profile_parent.settings.new_child(profile.settings)
+			else:
+				profile.settings = collections.ChainMap(profile.settings)
+		elif profile_parent:
+			if track_setting and track_setting in profile_parent.settings and track_setting not in profile.settings:
+				logging.debug("Flattening adds {key} to {file}.".format(key=track_setting, file=profile.filepath))
+			inherited = dict(profile_parent.settings)
+			inherited.update(profile.settings) #Only inherit settings that are not specified in the profile itself.
+			profile.settings = inherited
 
-	for subprofile in profile.subprofiles:
-		flatten_profiles(subprofile, profile)
-
-def bubble_common_values(profile, bubble_from_depth):
+def bubble_common_values(profile, bubble_from_depth, memo=None, keys_below=None, traversal=None):
 	"""
 	Finds the common denominator of the profiles in each subgroup, and bubbles
 	them up.
@@ -150,57 +545,203 @@ def bubble_common_values(profile, bubble_from_depth):
 	subprofiles.
 	:param bubble_from_depth: How many layers of profiles below this one should
 	not get bubbled.
-	:param except_root: Whether we should prevent making changes to the root of
-	the profile tree.
+	:param memo: A ``BubbleMemo`` with the changes that bubbling made to
+	profiles in earlier runs, if their subtrees are unchanged. If ``None``,
+	every profile is bubbled.
+	:param keys_below: The settings that are specified in the files below each
+	profile, as found by ``find_keys_below``. Only these settings are bubbled.
+	If ``None``, all settings are bubbled.
+	:param traversal: The ``ProfileTraversal`` of the profile, if it was already
+	computed.
+	"""
+	traversal = traversal or ProfileTraversal(profile)
+	for index in traversal.post_order: #Subprofiles are bubbled before their parents.
+		if traversal.depths[index] < bubble_from_depth: #We want to exempt this level from bubbling.
+			continue
+		bubble_profile(traversal.profiles[index], memo, keys_below)
+
+def bubble_profile(profile, memo=None, keys_below=None):
+	"""
+	Sets each setting of one profile to the most common value among its
+	subprofiles.
+
+	The subprofiles that inherit a setting that changes keep their old value.
+	:param profile: The profile to bubble. Its subprofiles must have been
+	bubbled already.
+	:param memo: A ``BubbleMemo`` with the changes that bubbling made to
+	profiles in earlier runs. If ``None``, the changes are computed.
+	:param keys_below: The settings that are specified in the files below each
+	profile, as found by ``find_keys_below``. If ``None``, all settings are
+	bubbled.
 	"""
-	#First tail-recursively bubble all subprofiles.
-	for subprofile in profile.subprofiles:
-		bubble_common_values(subprofile, bubble_from_depth - 1)
-	if bubble_from_depth > 0: #We want to exempt this level from bubbling.
-		return
-	logging.info("Finding common denominators of {file}.".format(file=profile.filepath))
 	#Edge case: No subprofiles.
 	if not profile.subprofiles:
 		return #We are already the common denominator then.
 
+	changes = memo.get(profile) if memo else None
+	if changes is None:
+		changes = find_common_values(profile, keys_below.get(profile) if keys_below is not None else None)
+		if memo:
+			memo.put(profile, changes)
+	track_setting = tracked_setting.get()
+	if track_setting in changes:
+		logging.debug("Bubbling set {key} to {value} in {file}.".format(key=track_setting, value=changes[track_setting], file=profile.filepath))
+	for key, value in changes.items():
+		for subprofile in profile.subprofiles: #Subprofiles that inherit the old value must keep it.
+			materialise_setting(subprofile, key)
+		profile.settings[key] = value
+
+def find_common_values(profile, keys=None):
+	"""
+	Finds the most common value of each setting among the subprofiles of a
+	profile.
+	:param profile: The profile whose subprofiles to look in.
+	:param keys: The settings to look at. Other settings are assumed to have the
+	same value in all subprofiles as in the profile itself. If ``None``, all
+	settings of the profile are looked at.
+	:return: A dictionary of the settings that need to change to become the
+	most common value, with their new values.
+	"""
+	changes = {}
+	profile_is_material = is_material(profile)
+	#For each voter, the settings it stores, the settings it inherits from the profiles between it and this profile, and its weight.
+	material_voters = [(stored_settings(subprofile), {}, subprofile.weight) for subprofile in profile.subprofiles]
+	nonmaterial_voters = [] #The profiles that vote on non-material settings, which skip material profiles.
+	for subprofile, voter in zip(profile.subprofiles, material_voters):
+		if is_material(subprofile): #Look in all its grandchildren. TODO: Make it possible to have multiple material profiles in the chain.
+			nonmaterial_voters.extend((stored_settings(subsubprofile), voter[0] if isinstance(subsubprofile.settings, collections.ChainMap) else {}, subsubprofile.weight) for subsubprofile in subprofile.subprofiles)
+		else:
+			nonmaterial_voters.append(voter)
+	if keys is None or not nonmaterial_voters: #Without any votes, even settings that are the same everywhere change, so they must all be looked at.
+		keys = profile.settings
+	else:
+		keys = [key for key in keys if key in profile.settings]
 	#For every key, find the most common value among its children.
-	for key in profile.settings:
+	for key in keys:
+		current = profile.settings[key]
 		value_counts = {}
 		if key in material_settings:
-			for subprofile in profile.subprofiles:
-				value = subprofile.settings[key]
-				if value not in value_counts:
-					value_counts[value] = 0
-				value_counts[value] += subprofile.weight
+			voters = material_voters
 		else: #Setting may not occur in a material profile. Skip all material profiles in the bubbling.
-			if is_material(profile): #We can't store the setting in this profile, so don't update the profile.
+			if profile_is_material: #We can't store the setting in this profile, so don't update the profile.
 				continue
-			for subprofile in profile.subprofiles:
-				if is_material(subprofile): #This is a material profile.
-					for subsubprofile in subprofile.subprofiles: #Look in all its grandchildren. TODO: Make it possible to have multiple material profiles in the chain.
-						value = subsubprofile.settings[key]
-						if value not in value_counts:
-							value_counts[value] = 0
-						value_counts[value] += subsubprofile.weight
-				else:
-					value = subprofile.settings[key]
-					if value not in value_counts:
-						value_counts[value] = 0
-					value_counts[value] += subprofile.weight
-		most_common_value = None
-		highest_count = -1
-		for value, count in value_counts.items():
-			if count > highest_count:
-				most_common_value = value
-				highest_count = count
-			elif count == highest_count: #We have a tie.
-				if value < most_common_value: #Just to make it deterministic.
-					most_common_value = value
-		if profile.settings[key] != most_common_value and key == track_setting:
-			logging.debug("Bubbling set {key} to {value}.".format(key=key, value=most_common_value))
-		profile.settings[key] = most_common_value
+			voters = nonmaterial_voters
+		for stored, inherited, weight in voters:
+			value = stored[key] if key in stored else inherited.get(key, current)
+			if value not in value_counts:
+				value_counts[value] = 0
+			value_counts[value] += weight
+		value = most_common_value(value_counts)
+		if current != value:
+			changes[key] = value
+	return changes
+
+def bubble_optimal_values(profile_root, bubble_from_depth, keys_below=None, traversal=None):
+	"""
+	Chooses the values of the settings in the profiles above the leaves such
+	that the fewest settings remain after removing the redundancies.
 
-def remove_redundancies(profile, parent=None, grandparent=None):
+	This is an exact alternative to ``bubble_common_values``. Instead of taking
+	the most common value among the subprofiles of each profile on its own, it
+	takes into account how the values of a profile, its parent and its
+	grandparents interact. Each setting is solved separately with a dynamic
+	program over the profile structure, in linear time:
+
+	Going up from the leaves, each profile gets the smallest number of settings
+	that its subtree needs to write if the profile it is compared with (its
+	parent, or for non-material settings the profile above a material parent)
+	has the best possible value, and the set of values for that profile with
+	which one fewer setting is needed. For a profile whose value can be
+	chosen, those are the values that most of its subprofiles prefer. Going
+	down from the root, each profile then takes the value of the profile it is
+	compared with if that is among its preferred values, or else the preferred
+	value that sorts first.
+
+	Every profile counts the same, regardless of its weight. Leaves, profiles
+	less than ``bubble_from_depth`` levels below the root and non-material
+	settings of material profiles keep their values. The profile structure
+	must already be flattened, and the root must have every setting.
+	:param profile_root: The root profile, containing all profiles as
+	subprofiles.
+	:param bubble_from_depth: How many layers of profiles below the root
+	should be exempt from bubbling.
+	:param keys_below: The settings that are specified in the files below each
+	profile, as found by ``find_keys_below``. Settings that are not specified
+	below the root are skipped. If ``None``, all settings are solved.
+	:param traversal: The ``ProfileTraversal`` of the root profile, if it was
+	already computed.
+	"""
+	traversal = traversal or ProfileTraversal(profile_root)
+	profiles = traversal.profiles
+	parents = traversal.parents
+	post_order = traversal.post_order
+	materials = [is_material(profile) for profile in profiles]
+	nonmaterial_parents = [] #For each profile, the index of the profile it compares non-material settings with, as in ``remove_profile_redundancies``.
+	for index, parent in enumerate(parents):
+		if parent != -1 and materials[parent] and parents[parent] != -1:
+			parent = parents[parent]
+		nonmaterial_parents.append(parent)
+	can_change = [bool(profile.subprofiles) and depth >= bubble_from_depth for profile, depth in zip(profiles, traversal.depths)]
+	compared_children = {} #For each relation between profiles, the indices of the profiles that are compared with each profile.
+	for relation in (parents, nonmaterial_parents):
+		children = [[] for _ in profiles]
+		for index, parent in enumerate(relation):
+			if parent != -1:
+				children[parent].append(index)
+		compared_children[id(relation)] = children
+
+	keys = keys_below.get(profile_root) if keys_below is not None else None
+	keys = list(profile_root.settings) if keys is None else [key for key in keys if key in profile_root.settings]
+	track_setting = tracked_setting.get()
+	for key in keys:
+		is_material_setting = key in material_settings
+		compared = parents if is_material_setting else nonmaterial_parents
+		children = compared_children[id(compared)]
+		costs = [0] * len(profiles) #For each profile, how many settings its subtree writes if the profile it is compared with has a value that is not preferred.
+		preferred = [None] * len(profiles) #For each profile, the values of the profile it is compared with that save one setting, or None if no value does.
+		for index in post_order:
+			value = profiles[index].settings[key]
+			is_dropped = not is_material_setting and materials[index] #Material profiles never write non-material settings.
+			total = 0
+			votes = {}
+			for child in children[index]:
+				total += costs[child]
+				if preferred[child] is not None:
+					for child_value in preferred[child]:
+						votes[child_value] = votes.get(child_value, 0) + 1
+			if can_change[index] and not is_dropped:
+				if votes:
+					most_votes = max(votes.values())
+					costs[index] = total - most_votes + 1
+					preferred[index] = {vote for vote, count in votes.items() if count == most_votes}
+				else: #Any value is as good, so take the value of the profile it is compared with.
+					costs[index] = total
+			elif is_dropped:
+				costs[index] = total - votes.get(value, 0)
+			else:
+				costs[index] = total - votes.get(value, 0) + 1
+				preferred[index] = (value,)
+
+		values = [None] * len(profiles)
+		for index, profile in enumerate(profiles): #Parents before their subprofiles.
+			values[index] = profile.settings[key]
+			if not can_change[index] or (not is_material_setting and materials[index]):
+				continue
+			compared_value = values[compared[index]] if compared[index] != -1 else values[index]
+			if preferred[index] is not None and compared_value not in preferred[index]:
+				compared_value = min(preferred[index])
+			values[index] = compared_value
+
+		for index in post_order: #Subprofiles before their parents, so that they are changed before they could inherit the new value.
+			profile = profiles[index]
+			if values[index] != profile.settings[key]:
+				for subprofile in profile.subprofiles: #Subprofiles that inherit the old value must keep it.
+					materialise_setting(subprofile, key)
+				profile.settings[key] = values[index]
+				if key == track_setting:
+					logging.debug("Bubbling set {key} to {value} in {file}.".format(key=key, value=values[index], file=profile.filepath))
+
+def remove_redundancies(profile, parent=None, grandparent=None, traversal=None):
 	"""
 	Removes the settings in each profile that have the same value as its parent.
 
@@ -210,58 +751,461 @@ def remove_redundancies(profile, parent=None, grandparent=None):
 	:param parent: The parent profile of the specified profile, if any.
 	:param grandparent: The grandparent profile of the specified profile, if
 	any.
+	:param traversal: The ``ProfileTraversal`` of the profile, if it was already
+	computed.
 	"""
-	#First tail-recursively remove redundancies of all subprofiles.
-	for subprofile in profile.subprofiles:
-		remove_redundancies(subprofile, parent=profile, grandparent=parent)
-	logging.info("Removing redundancies of {file}.".format(file=profile.filepath))
-	#Edge case: Root file has no redundancies.
-	if not parent:
-		return
+	traversal = traversal or ProfileTraversal(profile)
+	profiles = traversal.profiles
+	parents = traversal.parents
+	for index in traversal.post_order: #Subprofiles compare with their parents before the redundancies of their parents are removed.
+		parent_index = parents[index]
+		if parent_index == -1: #The given profile itself.
+			profile_parent, profile_grandparent = parent, grandparent
+		elif parents[parent_index] == -1:
+			profile_parent, profile_grandparent = profiles[parent_index], parent
+		else:
+			profile_parent, profile_grandparent = profiles[parent_index], profiles[parents[parent_index]]
+		if not profile_parent: #Edge case: Root file has no redundancies.
+			continue
+		remove_profile_redundancies(profiles[index], profile_parent, profile_grandparent)
 
+def remove_profile_redundancies(profile, parent, grandparent):
+	"""
+	Removes the settings in one profile that have the same value as its parent.
+	:param profile: The profile to remove redundancies from.
+	:param parent: The parent profile of the profile. Its redundancies must not
+	have been removed yet.
+	:param grandparent: The grandparent profile of the profile, if any.
+	"""
 	#Remove settings that are the same as the parent.
 	redundancies = set()
-	for key in profile.settings:
-		temp_parent = parent
-		if key not in material_settings and is_material(parent) and grandparent:
-			temp_parent = grandparent
-		if key not in material_settings and is_material(profile):
-			if key == track_setting:
-				logging.debug("Removed redundant {key} (non-material setting).".format(key=key))
-			redundancies.add(key)
-			continue
-		if profile.settings[key] == temp_parent.settings[key]:
-			if key == track_setting:
-				logging.debug("Removed redundant {key} (same as parent: {value} vs {parent_value})".format(key=key, value=profile.settings[key], parent_value=temp_parent.settings[key]))
+	profile_is_material = is_material(profile)
+	nonmaterial_parent = grandparent if is_material(parent) and grandparent else parent #Non-material settings are compared with the profile above the material profile.
+	settings = profile.settings
+	if isinstance(settings, collections.ChainMap): #Lazily flattened. The settings it inherits have the value of the parent, so they are all redundant.
+		settings = settings.maps[0]
+		if nonmaterial_parent is not parent and not profile_is_material: #But the non-material settings that the material parent stores are compared with the grandparent.
+			inherited = {key: value for key, value in profile.settings.maps[1].items() if key not in material_settings and key not in settings}
+			inherited.update(settings)
+			settings = inherited
+	for key in settings:
+		if key in material_settings:
+			if settings[key] == parent.settings[key]:
+				redundancies.add(key)
+		elif profile_is_material or settings[key] == nonmaterial_parent.settings[key]:
 			redundancies.add(key)
-			continue
-	for key in redundancies:
-		del profile.settings[key]
+	track_setting = tracked_setting.get()
+	if track_setting in redundancies or (track_setting in profile.settings and track_setting not in settings):
+		if track_setting not in material_settings and profile_is_material:
+			logging.debug("Removed redundant {key} from {file} (non-material setting).".format(key=track_setting, file=profile.filepath))
+		else:
+			logging.debug("Removed redundant {key} from {file} (same as parent: {value}).".format(key=track_setting, file=profile.filepath, value=profile.settings[track_setting]))
+	profile.settings = {key: value for key, value in settings.items() if key not in redundancies}
 
-def write_profiles(output_dir, profile):
+def bubble_and_remove_redundancies(profile_root, bubble_from_depth, memo=None, keys_below=None, traversal=None):
+	"""
+	Bubbles the common values up and removes the redundancies in one pass over
+	the profile structure.
+
+	This has the same result as ``bubble_common_values`` followed by
+	``remove_redundancies``. The redundancies of the subprofiles of a profile
+	are removed right after the profile is bubbled, by
+	``remove_subprofile_redundancies``.
+	:param profile_root: The root profile, containing all profiles as
+	subprofiles.
+	:param bubble_from_depth: How many layers of profiles below the root should
+	not get bubbled.
+	:param memo: A ``BubbleMemo``, as for ``bubble_common_values``.
+	:param keys_below: The settings that are specified in the files below each
+	profile, as for ``bubble_common_values``.
+	:param traversal: The ``ProfileTraversal`` of the root profile, if it was
+	already computed.
+	"""
+	traversal = traversal or ProfileTraversal(profile_root)
+	profiles = traversal.profiles
+	for index in traversal.post_order: #Subprofiles are bubbled before their parents.
+		profile = profiles[index]
+		if traversal.depths[index] >= bubble_from_depth:
+			bubble_profile(profile, memo, keys_below)
+		remove_subprofile_redundancies(profile, profiles[traversal.parents[index]] if index != 0 else None)
+
+def remove_subprofile_redundancies(profile, parent, removed=None):
+	"""
+	Removes the redundancies of the subprofiles of a profile that was just
+	bubbled, as far as nothing needs their settings any more.
+
+	The subprofiles compare with the profile, which is final now. Only the
+	subprofiles of a material profile in a non-material profile are left
+	alone: For non-material settings they vote in the parent of the material
+	profile and compare with it, so they are removed when that parent is
+	bubbled. That is done here as well.
+	:param profile: The profile that was just bubbled. Its subprofiles must
+	have been bubbled and their subprofiles removed by this function before.
+	:param parent: The parent of the profile, or ``None`` if it's the root.
+	:param removed: A function to call with each profile of which the
+	redundancies were removed, after which nothing looks at it any more.
+	"""
+	profile_is_material = is_material(profile)
+	deferred = profile_is_material and parent is not None and not is_material(parent) #Its subprofiles are left for its parent.
+	for subprofile in profile.subprofiles:
+		if not profile_is_material and is_material(subprofile): #Its subprofiles were left for this profile.
+			for subsubprofile in subprofile.subprofiles:
+				remove_profile_redundancies(subsubprofile, subprofile, profile)
+				if removed:
+					removed(subsubprofile)
+		if not deferred:
+			remove_profile_redundancies(subprofile, profile, parent)
+			if removed:
+				removed(subprofile)
+
+def bubble_and_remove_redundancies_parallel(profile_root, bubble_from_depth, jobs, memo=None, keys_below=None, traversal=None):
+	"""
+	Bubbles the common values up and removes the redundancies, optimising the
+	subtrees of the subprofiles of the root in parallel.
+
+	The subtrees don't depend on each other until their results are merged in
+	the root. Each subtree is bubbled in a separate process, which also removes
+	the redundancies of the profiles that only compare with profiles in the
+	subtree. The processes send back the settings of the subtree and the votes
+	of the subtree for the settings of the root. Then the root is bubbled from
+	the merged votes, after which the remaining redundancies are removed.
+
+	This has the same result as ``bubble_common_values`` followed by
+	``remove_redundancies``.
+	:param profile_root: The root profile, containing all profiles as
+	subprofiles.
+	:param bubble_from_depth: How many layers of profiles below the root should
+	not get bubbled.
+	:param jobs: How many processes to optimise the subtrees with.
+	:param memo: A ``BubbleMemo``, as for ``bubble_common_values``. The memo
+	can't be shared with other processes, so with a memo everything is done in
+	this process.
+	:param keys_below: The settings that are specified in the files below each
+	profile, as for ``bubble_common_values``.
+	:param traversal: The ``ProfileTraversal`` of the root profile, if it was
+	already computed.
+	"""
+	subprofiles = list(profile_root.subprofiles)
+	if jobs <= 1 or len(subprofiles) < 2 or memo:
+		bubble_and_remove_redundancies(profile_root, bubble_from_depth, memo, keys_below, traversal)
+		return
+
+	subtrees = [ProfileTraversal(subprofile).profiles for subprofile in subprofiles]
+	with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+		futures = [pool.submit(optimise_subtree, subprofile, bubble_from_depth - 1, [keys_below.get(profile) for profile in subtree] if keys_below is not None else None) for subprofile, subtree in zip(subprofiles, subtrees)]
+		results = [future.result() for future in futures]
+
+	votes = {} #The merged votes of all subtrees.
+	for subtree, (settings, subtree_votes) in zip(subtrees, results):
+		for profile, profile_settings in zip(subtree, settings): #The processes worked on copies of the profiles.
+			profile.settings = profile_settings
+		for key, value_counts in subtree_votes.items():
+			key_votes = votes.setdefault(key, {})
+			for value, count in value_counts.items():
+				key_votes[value] = key_votes.get(value, 0) + count
+
+	if bubble_from_depth <= 0:
+		keys = keys_below.get(profile_root) if keys_below is not None else None
+		profile_is_material = is_material(profile_root)
+		changes = {}
+		for key in profile_root.settings if keys is None else [key for key in keys if key in profile_root.settings]:
+			if key not in material_settings and profile_is_material: #We can't store the setting in this profile.
+				continue
+			value = most_common_value(votes.get(key, {}))
+			if profile_root.settings[key] != value:
+				changes[key] = value
+		track_setting = tracked_setting.get()
+		if track_setting in changes:
+			logging.debug("Bubbling set {key} to {value} in {file}.".format(key=track_setting, value=changes[track_setting], file=profile_root.filepath))
+		profile_root.settings.update(changes) #The subprofiles got their own copies of the settings from the other processes, so they keep their values.
+
+	for subprofile in subprofiles: #The profiles that compare with the root.
+		for subsubprofile in subprofile.subprofiles:
+			remove_profile_redundancies(subsubprofile, subprofile, profile_root)
+		remove_profile_redundancies(subprofile, profile_root, None)
+
+def optimise_subtree(profile, bubble_from_depth, keys_below):
+	"""
+	Bubbles the common values up in the subtree of a subprofile of the root
+	and removes the redundancies of the profiles that only compare with
+	profiles in the subtree.
+
+	This is run in a separate process by
+	``bubble_and_remove_redundancies_parallel``. The profile itself and its
+	subprofiles compare with the root, so their redundancies are not removed.
+	:param profile: The subprofile of the root, containing the profiles in its
+	subtree as subprofiles.
+	:param bubble_from_depth: How many layers of profiles below this profile
+	should not get bubbled.
+	:param keys_below: For each profile in the subtree in pre-order, the
+	settings that are specified in the files below it, as found by
+	``find_keys_below``. If ``None``, all settings are bubbled.
+	:return: A tuple with the settings of each profile in the subtree in
+	pre-order, and the votes of the subtree for the value of each setting in
+	the root, as dictionaries mapping values to their total weight.
+	"""
+	traversal = ProfileTraversal(profile)
+	if keys_below is not None:
+		keys_below = dict(zip(traversal.profiles, keys_below))
+	bubble_common_values(profile, bubble_from_depth, None, keys_below, traversal)
+	for index in traversal.post_order:
+		if traversal.depths[index] >= 2: #Compares only with profiles in the subtree.
+			parent_index = traversal.parents[index]
+			remove_profile_redundancies(traversal.profiles[index], traversal.profiles[parent_index], traversal.profiles[traversal.parents[parent_index]])
+
+	votes = {}
+	nonmaterial_voters = profile.subprofiles if is_material(profile) else [profile] #For non-material settings, material profiles are skipped in favour of their subprofiles.
+	for key, value in profile.settings.items():
+		key_votes = votes[key] = {}
+		for voter in [profile] if key in material_settings else nonmaterial_voters:
+			voter_value = voter.settings[key]
+			key_votes[voter_value] = key_votes.get(voter_value, 0) + voter.weight
+	return [dict(subtree_profile.settings) for subtree_profile in traversal.profiles], votes
+
+def write_profiles(sink, profile, cache=None, skip_unchanged=False, jobs=1, traversal=None):
 	"""
 	Writes a profile structure to file.
 
 	All profiles are written as the CFG file format. No other file format has
 	yet been implemented due to time constraints.
-	:param output_dir: The root directory to write the file structure to.
+
+	All profiles are rendered first, after which the files are written.
+	:param sink: The sink to write the file structure to, or the root directory
+	to write it to.
 	:param profile: The root profile, containing all profiles as
 	subprofiles.
+	:param cache: A ``ProfileCache`` that remembers what was written in the
+	previous run. Files that would get the same contents are not rewritten. If
+	``None``, all files are written.
+	:param skip_unchanged: Whether to compare the contents with the files that
+	are already in the output, skipping the files that would stay the same.
+	Files that do change are written to a temporary file first, which then
+	replaces the original file, so that the output never contains partially
+	written files.
+	:param jobs: How many threads to write the files with.
+	:param traversal: The ``ProfileTraversal`` of the root profile, if it was
+	already computed.
 	"""
-	logging.info("Writing optimised profile: {file}".format(file=profile.filepath))
-	write_cfg(profile, output_dir)
-	for subprofile in profile.subprofiles:
-		write_profiles(output_dir, subprofile)
+	write_profile_files(sink, (traversal or ProfileTraversal(profile)).profiles, cache, skip_unchanged, jobs)
+
+def write_profile_files(sink, profiles, cache=None, skip_unchanged=False, jobs=1):
+	"""
+	Writes a list of profiles to file, as in ``write_profiles``.
+	:param sink: The sink to write the files to, or the root directory to
+	write them to.
+	:param profiles: The profiles to write. Their subprofiles are not written.
+	:param cache: A ``ProfileCache`` that remembers what was written in the
+	previous run. Files that would get the same contents are not rewritten. If
+	``None``, all files are written.
+	:param skip_unchanged: Whether to compare the contents with the files that
+	are already in the output, skipping the files that would stay the same.
+	:param jobs: How many threads to write the files with.
+	"""
+	with open_sink(sink) as sink:
+		outputs = []
+		for profile in profiles:
+			contents = render_cfg(profile)
+			if not cache or cache.needs_writing(profile.filepath, contents, sink):
+				outputs.append((profile.filepath, contents))
+
+		if jobs > 1:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+				futures = [pool.submit(sink.write, file, contents, skip_unchanged) for file, contents in outputs]
+				for future in futures:
+					future.result() #Raise any errors that occurred while writing.
+		else:
+			for file, contents in outputs:
+				sink.write(file, contents, skip_unchanged)
+
+def optimise_streaming(source, sink, bubble_from_depth=0, skip_unchanged=False, dry_run=False, report=None):
+	"""
+	Optimises a profile structure while reading and writing it, without
+	keeping all of it in memory.
+
+	The directories are visited in post-order. When entering a directory, its
+	profiles are read and flattened. When leaving it, its profile is bubbled
+	and the redundancies of the profiles below it are removed with
+	``remove_subprofile_redundancies``, after which those profiles are written
+	and discarded. Only the profiles of the directories on the path to the
+	current directory and of their subdirectories are kept in memory, so the
+	memory usage is bounded by the size of the largest directories instead of
+	the whole profile structure.
+
+	This has the same result as ``bubble_common_values`` followed by
+	``remove_redundancies``. Bubbling results are not cached.
+	:param source: The source to read the profile structure from, or the path
+	to the root of the input directory structure.
+	:param sink: The sink to write the optimised profile structure to, or the
+	root directory to write it to.
+	:param bubble_from_depth: How many layers of profiles below the root should
+	be exempt from bubbling.
+	:param skip_unchanged: Whether to skip writing output files that already
+	have the right contents, and to replace the other files atomically.
+	:param dry_run: Whether to only optimise the profiles, without writing
+	them.
+	:param report: A ``SizeReport`` to record the size of each profile in
+	before and after optimising it. If ``None``, nothing is recorded.
+	:return: A tuple with the number of profiles, the number of settings that
+	were read and the number of settings that were written.
+	"""
+	with open_source(source) as source, open_sink(sink) as sink:
+		num_profiles = 0
+		num_settings = 0
+		num_written_settings = 0
+		own_keys = {} #For each profile in memory, the settings specified in its own file.
+		keys_below = {} #For each profile in memory that has subprofiles, the settings specified below it, as in ``find_keys_below``.
+		parents = {} #For each profile in memory, its parent.
+		interned = {} #Shared copies of the strings and base configs of this profile structure. See ``intern_profile``.
+
+		def read(profile, parent):
+			nonlocal num_profiles, num_settings
+			intern_profile(profile, interned)
+			num_profiles += 1
+			num_settings += len(profile.settings)
+			if report:
+				report.before(profile)
+			own_keys[profile] = set(profile.settings)
+			parents[profile] = parent
+			flatten_profiles(profile, parent)
+			if parent:
+				parent.subprofiles.append(profile)
+
+		def write(profile):
+			nonlocal num_written_settings
+			if report:
+				report.after(profile)
+			if not dry_run:
+				write_cfg(profile, sink, skip_unchanged=skip_unchanged)
+			num_written_settings += len(profile.settings)
+			profile.subprofiles = [] #Were all written before this one.
+			del own_keys[profile]
+			keys_below.pop(profile, None)
+			del parents[profile]
+
+		profile_root = None
+		pending = [(find_profiles(source), None, 0)] #Directories to enter, or profiles to leave if there is no layout.
+		while pending:
+			layout, profile, depth = pending.pop()
+			if layout: #Entering a directory.
+				directory, main_file, leaf_files, subdirectories = layout
+				parent = profile
+				if main_file:
+					profile = source.parse(main_file)
+				else: #There was no common file for this directory.
+					profile = Profile(filepath=os.path.join(directory, os.path.split(directory)[-1] + ".inst.cfg"))
+				profile.weight = 0
+				if profile.kind != "material":
+					profile.kind = "main"
+				read(profile, parent)
+				profile_root = profile_root or profile
+				for file in leaf_files:
+					read(source.parse(file), profile)
+				pending.append((None, profile, depth))
+				pending.extend((subdirectory, profile, depth + 1) for subdirectory in reversed(subdirectories)) #Reversed, so that they are visited in order.
+				continue
+
+			#Leaving a directory. All of its subdirectories have been bubbled.
+			if profile.subprofiles:
+				profile.weight = sum(subprofile.weight for subprofile in profile.subprofiles)
+				keys = set()
+				if not is_material(profile) and all(is_material(subprofile) and not subprofile.subprofiles for subprofile in profile.subprofiles):
+					keys = None
+				for subprofile in profile.subprofiles:
+					subprofile_keys = keys_below[subprofile] if subprofile in keys_below else ()
+					if keys is None or subprofile_keys is None:
+						keys = None
+						break
+					keys.update(own_keys[subprofile])
+					keys.update(subprofile_keys)
+				keys_below[profile] = keys
+			if depth >= bubble_from_depth:
+				bubble_profile(profile, None, keys_below)
+			remove_subprofile_redundancies(profile, parents[profile], write)
+		if profile_root:
+			write(profile_root)
+		return num_profiles, num_settings, num_written_settings
 
 #################################SUBROUTINES####################################
 
+def count_settings(profile_root):
+	"""
+	Counts the profiles in a profile structure and the settings stored in them.
+
+	Settings that lazily flattened profiles inherit are not counted, since they
+	are not stored in the profile itself.
+	:param profile_root: The root profile, containing all profiles as
+	subprofiles.
+	:return: A tuple with the number of profiles and the number of settings.
+	"""
+	num_profiles = 0
+	num_settings = 0
+	pending = [profile_root]
+	while pending:
+		profile = pending.pop()
+		num_profiles += 1
+		if isinstance(profile.settings, collections.ChainMap):
+			num_settings += len(profile.settings.maps[0])
+		else:
+			num_settings += len(profile.settings)
+		pending.extend(profile.subprofiles)
+	return num_profiles, num_settings
+
+def classify_profile(filepath, baseconfig):
+	"""
+	Determines whether a file contains a material profile.
+
+	A profile is a material profile if its metadata says it is, if its file has
+	the extension of material files, or if its file is named after one of the
+	``material_profiles``.
+	:param filepath: The path of the file of the profile.
+	:param baseconfig: The sections of the file without the settings.
+	:return: ``"material"`` if it is a material profile, or ``"leaf"`` if it
+	isn't. Which profiles are the main profile of a directory is only known when
+	the directory structure is assembled.
+	"""
+	for section, options in baseconfig:
+		if section == "metadata" and ("type", "material") in options:
+			return "material"
+	file_name = os.path.basename(filepath)
+	if os.path.splitext(file_name)[1] in material_extensions or file_name.split(".")[0] in material_profiles:
+		return "material"
+	return "leaf"
+
+def intern_profile(profile, interned):
+	"""
+	Replaces the setting keys, values and metadata of a profile by their
+	shared copies in a table.
+
+	Profiles that are parsed from different files then share the strings that
+	are equal in those files, instead of each having their own copy. The base
+	configs are shared the same way, per key-value pair, per section and as a
+	whole, so that profiles with the same metadata share a single base config.
+	Base configs are tuples, so a profile that needs different metadata gets a
+	new tuple instead of changing the shared one.
+	:param profile: The profile to intern the settings and metadata of.
+	:param interned: A dictionary with the shared copy of each string and
+	tuple, by itself. New ones are added to it. It should only live as long
+	as the profiles, so that it doesn't keep strings of earlier runs alive.
+	:return: The same profile, with a new dictionary of settings.
+	"""
+	intern = interned.setdefault
+	profile.settings = {intern(key, key): intern(value, value) for key, value in profile.settings.items()}
+	sections = []
+	for section, options in profile.baseconfig:
+		options = tuple(intern(pair, pair) for pair in ((intern(key, key), intern(value, value)) for key, value in options))
+		section = (intern(section, section), intern(options, options))
+		sections.append(intern(section, section))
+	sections = tuple(sections)
+	profile.baseconfig = intern(sections, sections)
+	return profile
+
 def is_material(profile):
 	"""
 	Determines whether a profile is a material profile.
 	:param profile: The profile to check.
 	:return: True if the profile is a material profile, or False if it isn't.
 	"""
-	return os.path.split(profile.filepath)[-1].split(".")[0] in material_profiles
+	return profile.kind == "material"
 
 def is_main_file(file_name, directory_name):
 	"""
@@ -277,77 +1221,269 @@ def is_main_file(file_name, directory_name):
 	the main file.
 	:return: ``True`` if the file is the main file, or ``False`` if it isn't.
 	"""
-	split_file = file_name.split(".")
-	for i in range(len(split_file)):
-		if ".".join(split_file[0:i + 1]) == directory_name:
-			return True
-	return False
+	return file_name == directory_name or file_name.startswith(directory_name + ".")
+
+def subtree_digests(profile_root, file_digests, bubble_from_depth, traversal=None):
+	"""
+	Computes a digest of each subtree of a profile structure, which changes
+	whenever anything changes that could change the result of bubbling the root
+	of the subtree.
+
+	That is the contents of each file in the subtree, the contents of the files
+	of its ancestors (since they are flattened into it), the structure of the
+	subtree and how deep the subtree is.
+	:param profile_root: The root profile, containing all profiles as
+	subprofiles.
+	:param file_digests: A dictionary with a digest of the contents of each
+	file.
+	:param bubble_from_depth: How many layers of profiles below the root should
+	not get bubbled.
+	:param traversal: The ``ProfileTraversal`` of the root profile, if it was
+	already computed.
+	:return: A dictionary with the digest of the subtree of each profile.
+	"""
+	traversal = traversal or ProfileTraversal(profile_root)
+	profiles = traversal.profiles
+	context_digests = [] #For each profile, a digest of its own file and the files of its ancestors.
+	for index, profile in enumerate(profiles): #Ancestors first.
+		own_digest = hashlib.sha256("{file}\n{digest}\n{weight}".format(file=profile.filepath, digest=file_digests.get(profile.filepath, ""), weight=profile.weight).encode("utf-8")).hexdigest()
+		ancestors_digest = context_digests[traversal.parents[index]] if index else ""
+		context_digests.append(hashlib.sha256((ancestors_digest + own_digest).encode("utf-8")).hexdigest())
+	digests = {}
+	for index in traversal.post_order: #Subtrees first.
+		profile = profiles[index]
+		subtree = hashlib.sha256("{context}\n{depth}".format(context=context_digests[index], depth=bubble_from_depth - traversal.depths[index]).encode("utf-8"))
+		for subprofile in profile.subprofiles:
+			subtree.update(digests[subprofile].encode("utf-8"))
+		digests[profile] = subtree.hexdigest()
+	return digests
+
+def most_common_value(value_counts):
+	"""
+	Finds the value with the highest weight among the votes for a setting.
+
+	Ties are broken by taking the value that sorts first, to make it
+	deterministic.
+	:param value_counts: A dictionary mapping each value to its total weight.
+	:return: The most common value, or ``None`` if there were no votes.
+	"""
+	most_common = None
+	highest_count = -1
+	for value, count in value_counts.items():
+		if count > highest_count:
+			most_common = value
+			highest_count = count
+		elif count == highest_count: #We have a tie.
+			if value < most_common: #Just to make it deterministic.
+				most_common = value
+	return most_common
+
+def find_keys_below(profile_root, traversal=None):
+	"""
+	Finds which settings are specified in the files below each profile.
+
+	Bubbling can only change the settings that are specified somewhere below a
+	profile. All other settings are inherited from the profile itself by all of
+	its subprofiles. The exception is a profile whose subprofiles are all
+	material profiles without subprofiles. Nothing votes on its non-material
+	settings, so bubbling changes all of them. This must be called before
+	flattening the profiles.
+	:param profile_root: The root profile, containing all profiles as
+	subprofiles.
+	:param traversal: The ``ProfileTraversal`` of the root profile, if it was
+	already computed.
+	:return: A dictionary with the set of keys specified below each profile
+	that has subprofiles, or ``None`` for profiles where all settings can
+	change.
+	"""
+	traversal = traversal or ProfileTraversal(profile_root)
+	keys_below = {}
+	for index in traversal.post_order: #Subprofiles first.
+		profile = traversal.profiles[index]
+		if not profile.subprofiles:
+			continue
+		keys = set()
+		if not is_material(profile) and all(is_material(subprofile) and not subprofile.subprofiles for subprofile in profile.subprofiles):
+			keys = None
+		for subprofile in profile.subprofiles:
+			subprofile_keys = keys_below[subprofile] if subprofile.subprofiles else ()
+			if keys is None or subprofile_keys is None:
+				keys = None
+				break
+			keys.update(subprofile.settings)
+			keys.update(subprofile_keys)
+		keys_below[profile] = keys
+	return keys_below
 
-def parse(file):
+def stored_settings(profile):
+	"""
+	Gets the settings that a profile stores itself.
+
+	Profiles that are flattened lazily inherit the value of their parent for
+	the other settings. Profiles that are not flattened lazily store all their
+	settings.
+	:param profile: The profile to get the stored settings of.
+	:return: A dictionary with the settings that the profile stores.
+	"""
+	settings = profile.settings
+	return settings.maps[0] if isinstance(settings, collections.ChainMap) else settings
+
+def materialise_setting(profile, key):
+	"""
+	Makes a lazily flattened profile store the value of a setting that it
+	inherits, so that it keeps that value if the value in its parent changes.
+
+	Profiles that are not flattened lazily already store all their settings, so
+	they are left alone.
+	:param profile: The profile to store the setting in.
+	:param key: The key of the setting to store.
+	"""
+	settings = profile.settings
+	if isinstance(settings, collections.ChainMap) and key not in settings.maps[0]:
+		settings.maps[0][key] = settings[key]
+
+def parse(file, contents=None):
 	"""
 	Parses one file, creating a Profile instance with all settings from the
 	file.
 	:param file: The file path of the file to parse.
+	:param contents: The contents of the file. If ``None``, the file is read
+	from disk.
 	:return: A Profile instance, instantiated with all the settings from the
 	file.
 	"""
 	extension = os.path.splitext(file)[1]
 	if extension == ".cfg":
-		return parse_cfg(file)
+		return parse_cfg(file, contents)
 	if extension == ".json":
-		return parse_json(file)
+		return parse_json(file, contents)
 	if extension == ".fdm_material":
-		return parse_xml(file)
+		return parse_xml(file, contents)
 	raise Exception("Unknown file extension \"{extension}\".".format(extension=extension))
 
-def parse_cfg(file):
+def parse_cfg(file, contents=None):
 	"""
 	Parses a CFG file, creating a Profile instance with all settings from the
 	file.
 	:param file: The file path of the file to parse.
+	:param contents: The contents of the file. If ``None``, the file is read
+	from disk.
 	:return: A Profile instance, instantiated with all the settings from the
 	file.
 	"""
-	result = Profile(filepath=file) #An empty profile.
-
-	data = configparser.ConfigParser() #Input file.
-	data.read(file)
-	if data.has_section("general"): #Copy over all metadata.
-		result.baseconfig["general"] = data["general"]
-	if data.has_section("metadata"):
-		result.baseconfig["metadata"] = data["metadata"]
-	if data.has_section("values"): #Put the settings in the settings dict for further processing later.
-		for key, value in data["values"].items():
-			if key == track_setting:
-				logging.debug("Loading {key} from {file}: {value}.".format(key=key, value=value, file=file))
-			result.settings[key] = value
+	if contents is None:
+		with open(file) as cfg_file: #Input file.
+			data = parse_cfg_sections(cfg_file, file)
+	else:
+		data = parse_cfg_sections(contents.splitlines(), file)
+	baseconfig = tuple((section, tuple(data[section].items())) for section in ("general", "metadata") if section in data) #Copy over all metadata.
+	result = Profile(filepath=file, settings=data.get("values"), baseconfig=baseconfig) #Put the settings in the settings dict for further processing later.
+	track_setting = tracked_setting.get()
+	if track_setting and track_setting in result.settings:
+		logging.debug("Loading {key} from {file}: {value}.".format(key=track_setting, value=result.settings[track_setting], file=file))
 	return result
 
-def parse_json(file):
+def parse_cfg_sections(lines, file):
+	"""
+	Parses the sections of a CFG file.
+
+	This understands the same syntax as ``configparser.ConfigParser`` with its
+	default options, apart from interpolation, which Cura doesn't use: Keys
+	are case-insensitive, keys and values are separated by ``=`` or ``:``,
+	lines starting with ``#`` or ``;`` are comments and lines that are indented
+	further than their key continue its value on a new line. Like
+	ConfigParser, a section or a key in a section that appears twice is an
+	error.
+	:param lines: The lines of the file.
+	:param file: The file path of the file, to report errors with.
+	:return: A dictionary of the sections in the file, each of which is a
+	dictionary of its keys and values.
+	"""
+	sections = {} #For each section, a dictionary with the lines of the value of each key.
+	section = None
+	key = None #The key that continuation lines add to.
+	indentation = 0 #The indentation of the line of that key.
+	for line_number, line in enumerate(lines, start=1):
+		stripped = line.strip()
+		if not stripped: #Empty lines are part of the value if it continues after them.
+			if key is not None:
+				section[key].append("")
+			continue
+		if stripped[0] == "#" or stripped[0] == ";": #Comment.
+			continue
+		line_indentation = len(line) - len(line.lstrip())
+		if key is not None and line_indentation > indentation: #Continuation of a multi-line value.
+			section[key].append(stripped)
+			continue
+		indentation = line_indentation
+		if stripped[0] == "[" and stripped.rfind("]") > 1: #Section header.
+			name = stripped[1:stripped.rfind("]")]
+			if name in sections:
+				raise configparser.DuplicateSectionError(name, file, line_number)
+			section = sections[name] = {}
+			key = None
+			continue
+		if section is None:
+			raise configparser.MissingSectionHeaderError(file, line_number, line)
+		equals = stripped.find("=")
+		colon = stripped.find(":")
+		delimiter = min(equals, colon) if equals >= 0 and colon >= 0 else max(equals, colon) #The first of either.
+		key = stripped[:delimiter].rstrip().lower() if delimiter >= 0 else ""
+		if not key:
+			error = configparser.ParsingError(file)
+			error.append(line_number, line)
+			raise error
+		if key in section:
+			raise configparser.DuplicateOptionError(name, key, file, line_number)
+		section[key] = [stripped[delimiter + 1:].lstrip()]
+	return {name: {key: "\n".join(value).rstrip() for key, value in options.items()} for name, options in sections.items()}
+
+def parse_json(file, contents=None):
 	"""
 	Parses a JSON file, creating a Profile instance with all settings from the
 	file.
+
+	Each object in the document is pruned as soon as the decoder has read it,
+	keeping only what is needed to find the values of the settings. The rest
+	of the document, such as the descriptions of all settings, is discarded
+	while decoding instead of being kept in memory for the whole document.
 	:param file: The file path of the file to parse.
+	:param contents: The contents of the file. If ``None``, the file is read
+	from disk.
 	:return: A Profile instance, instantiated with all the settings from the
 	file.
 	"""
 	result = Profile(filepath=file) #An empty profile.
-	with open(file) as json_file:
-		data = json.load(json_file)
+	if contents is None:
+		with open(file) as json_file:
+			data = json.load(json_file, object_pairs_hook=prune_json_object)
+	else:
+		data = json.loads(contents, object_pairs_hook=prune_json_object)
 
 	if "settings" in data:
-		for key, value in parse_json_setting(data["settings"]):
-			if key == track_setting:
-				logging.debug("Loading {key} from {file}: {value}.".format(key=key, value=value, file=file))
-			result.settings[key] = value
+		result.settings.update(parse_json_setting(data["settings"]))
 	if "overrides" in data:
-		for key, value in parse_json_setting(data["overrides"]):
-			if key == track_setting:
-				logging.debug("Loading {key} from {file}: {value}.".format(key=key, value=value, file=file))
-			result.settings[key] = value
+		result.settings.update(parse_json_setting(data["overrides"]))
+	track_setting = tracked_setting.get()
+	if track_setting and track_setting in result.settings:
+		logging.debug("Loading {key} from {file}: {value}.".format(key=track_setting, value=result.settings[track_setting], file=file))
 
 	return result
 
+def prune_json_object(pairs):
+	"""
+	Prunes an object from a JSON document while it is being decoded.
+
+	Objects are kept, since they may be settings or groups of settings. Of the
+	other members, only the values of settings are kept. This means that
+	setting values may not be objects themselves, which Cura's definitions
+	don't use.
+	:param pairs: The key-value pairs of the object, in the order in which they
+	appear in the document.
+	:return: A dictionary with the pairs that need to be kept.
+	"""
+	return {key: value for key, value in pairs if type(value) is dict or key == "value" or key == "default_value"}
+
 def parse_json_setting(setting_dict):
 	"""
 	Parses a setting in a JSON file.
@@ -365,53 +1501,1677 @@ def parse_json_setting(setting_dict):
 		if "children" in subdict: #Recursively yield from child settings.
 			yield from parse_json_setting(subdict["children"])
 
-def parse_xml(file):
+def parse_xml(file, contents=None):
 	"""
 	Parses an XML file, creating a Profile instance with all settings from the
 	file.
+
+	The file is read as a material file of Cura. Its settings for all printers
+	are converted from their names in material files to their setting keys
+	with ``material_settings``. The file is parsed incrementally and the
+	elements are discarded as soon as they are read, so that large files don't
+	need to be kept in memory as a whole.
 	:param file: The file path of the file to parse.
+	:param contents: The contents of the file. If ``None``, the file is read
+	from disk.
 	:return: A Profile instance, instantiated with all the settings from the
 	file.
 	"""
-	raise Exception("Not implemented yet.")
+	settings = {}
+	name = None
+	parser = xml.etree.ElementTree.XMLPullParser(events=("end",))
+
+	def read_element(element):
+		nonlocal name
+		tag = element.tag.rpartition("}")[2] #Without namespace.
+		if tag == "settings": #Only the settings for all printers are used. The printer-specific settings are in the machine elements, which were already cleared.
+			for setting in element:
+				key = material_setting_keys.get(setting.get("key")) if setting.tag.rpartition("}")[2] == "setting" else None
+				if key == "material_flow_temp_graph": #A list of flow rates and temperatures, as in the definitions.
+					settings[key] = "[" + ",".join("[{flow},{temperature}]".format(flow=point.get("flow"), temperature=point.get("temperature")) for point in setting) + "]"
+				elif key:
+					settings[key] = (setting.text or "").strip()
+		elif tag == "metadata":
+			for child in element:
+				if child.tag.rpartition("}")[2] == "name":
+					for part in child:
+						if part.tag.rpartition("}")[2] == "material":
+							name = (part.text or "").strip()
+		elif tag not in {"machine", "properties"}: #Everything else is read as part of the elements around it.
+			return
+		element.clear() #Nothing in this element is needed any more.
+
+	if contents is None:
+		with open(file, "rb") as xml_file:
+			for chunk in iter(lambda: xml_file.read(65536), b""):
+				parser.feed(chunk)
+				for _, element in parser.read_events():
+					read_element(element)
+	else:
+		parser.feed(contents)
+	parser.close()
+	for _, element in parser.read_events():
+		read_element(element)
+
+	baseconfig = (("metadata", (("type", "material"),)),)
+	if name:
+		baseconfig = (("general", (("name", name),)),) + baseconfig
+	result = Profile(filepath=file, settings=settings, baseconfig=baseconfig)
+	track_setting = tracked_setting.get()
+	if track_setting and track_setting in result.settings:
+		logging.debug("Loading {key} from {file}: {value}.".format(key=track_setting, value=result.settings[track_setting], file=file))
+	return result
 
-def write_cfg(profile, output_dir):
+def write_cfg(profile, sink, cache=None, skip_unchanged=False):
 	"""
 	Writes a CFG file from a profile.
 
 	The file is written to the filepath specified in the profile.
 	:param profile: The profile to write to a file.
-	:param output_dir: The root of the output directory to write the profiles
-	to.
+	:param sink: The sink to write the profiles to.
+	:param cache: A ``ProfileCache`` that remembers what was written in the
+	previous run. If the file would get the same contents, it is not rewritten.
+	If ``None``, the file is always written.
+	:param skip_unchanged: Whether to leave the file alone if it already has
+	the right contents, and to replace it atomically otherwise.
 	"""
-	config = profile.baseconfig #Use the base config as starting point.
+	contents = render_cfg(profile)
+	if cache and not cache.needs_writing(profile.filepath, contents, sink):
+		return
+	sink.write(profile.filepath, contents, skip_unchanged)
+
+def render_cfg(profile):
+	"""
+	Renders a profile as the contents of a CFG file.
 
-	if config.has_section("metadata") and config["metadata"]["type"] == "quality":
-		warning_settings = per_extruder_warning_settings & profile.settings.keys()
-		if warning_settings:
-			logging.warning("These settings may give problems in the profile {profile}: {settings}".format(profile=profile.filepath, settings=warning_settings))
+	The output is the same as what ``configparser.ConfigParser`` would write:
+	Keys are lower case and lines after the first line of a value are indented.
+	:param profile: The profile to render.
+	:return: The contents of the CFG file.
+	"""
+	for section, options in profile.baseconfig:
+		if section == "metadata" and dict(options).get("type") == "quality":
+			warning_settings = per_extruder_warning_settings & profile.settings.keys()
+			if warning_settings:
+				logging.warning("These settings may give problems in the profile {profile}: {settings}".format(profile=profile.filepath, settings=warning_settings))
 
-	config.add_section("values")
+	values = {}
+	material = is_material(profile)
 	for key in sorted(profile.settings): #Serialise the settings to the config.
-		if key in material_settings and is_material(profile):
-			config["values"][material_settings[key]] = profile.settings[key]
+		name = material_settings[key] if material and key in material_settings else key
+		values[name.lower()] = profile.settings[key]
+
+	rendered = []
+	for section, options in profile.baseconfig + (("values", values.items()),):
+		rendered.append("[" + section + "]\n")
+		for key, value in options:
+			rendered.append(key.lower() + " = " + value.replace("\n", "\n\t") + "\n")
+		rendered.append("\n")
+	return "".join(rendered)
+
+def estimate_cfg_size(profile):
+	"""
+	Estimates the size of the CFG file of a profile, without rendering it.
+
+	This counts the characters that ``render_cfg`` would produce, which is the
+	number of bytes if all settings are ASCII.
+	:param profile: The profile to estimate the size of.
+	:return: The number of characters in the CFG file of the profile.
+	"""
+	material = is_material(profile)
+	values = {}
+	for key, value in profile.settings.items():
+		name = material_settings[key] if material and key in material_settings else key
+		values[name.lower()] = value
+	size = 0
+	for section, options in profile.baseconfig + (("values", values.items()),):
+		size += len(section) + 4 #Brackets, newline and the empty line after the section.
+		for key, value in options:
+			size += len(key) + len(value) + value.count("\n") + 4 #Separator, newline and a tab for every continuation line.
+	return size
+
+def write_file(output_file, contents, skip_unchanged=False):
+	"""
+	Writes a file. The directory of the file must already exist.
+	:param output_file: The path of the file to write.
+	:param contents: The contents to write to the file.
+	:param skip_unchanged: Whether to leave the file alone if it already has
+	these contents, and otherwise to write to a temporary file first that then
+	replaces the file, so that the file is never partially written.
+	"""
+	if not skip_unchanged:
+		with open(output_file, "w") as config_file:
+			config_file.write(contents)
+		return
+
+	try:
+		with open(output_file) as config_file:
+			if config_file.read() == contents:
+				return
+	except (OSError, UnicodeDecodeError): #Doesn't exist yet, or isn't a readable text file.
+		pass
+	temporary_file = "{file}.{process}.{thread}.tmp".format(file=output_file, process=os.getpid(), thread=threading.get_ident()) #Unique for each thread that may write this file at the same time. Not made with tempfile, which would make it only readable by the owner.
+	with open(temporary_file, "w") as config_file:
+		config_file.write(contents)
+	os.replace(temporary_file, output_file)
+
+#################################SOURCES AND SINKS##############################
+
+tar_compressions = {".tar": "", ".tar.gz": "gz", ".tgz": "gz", ".tar.bz2": "bz2", ".tbz2": "bz2", ".tar.xz": "xz", ".txz": "xz"} #The compression of tar archives with each extension.
+
+@contextlib.contextmanager
+def open_source(source):
+	"""
+	Opens a source to read a profile structure from, while in this context.
+	:param source: A source, or a path. A path to a zip or tar archive is
+	opened as ``ZipSource`` or ``TarSource``, and any other path as
+	``DirectorySource``.
+	:return: The opened source. If it was opened from a path, it is closed
+	again when leaving the context.
+	"""
+	if not isinstance(source, (str, os.PathLike)): #Opened by the caller, who also closes it.
+		yield source
+		return
+	if not os.path.isfile(source):
+		yield DirectorySource(source)
+		return
+	opened = ZipSource(source) if zipfile.is_zipfile(source) else TarSource(source)
+	try:
+		yield opened
+	finally:
+		opened.close()
+
+@contextlib.contextmanager
+def open_sink(sink):
+	"""
+	Opens a sink to write a profile structure to, while in this context.
+	:param sink: A sink, or a path. A path ending in ".zip" or in one of the
+	extensions in ``tar_compressions`` is opened as ``ZipSink`` or
+	``TarSink``, and any other path as ``DirectorySink``.
+	:return: The opened sink. If it was opened from a path, it is closed again
+	when leaving the context, which completes the archive.
+	"""
+	if not isinstance(sink, (str, os.PathLike)): #Opened by the caller, who also closes it.
+		yield sink
+		return
+	name = os.fspath(sink).lower()
+	if name.endswith(".zip"):
+		opened = ZipSink(sink)
+	elif name.endswith(tuple(tar_compressions)):
+		opened = TarSink(sink)
+	else:
+		yield DirectorySink(sink)
+		return
+	try:
+		yield opened
+	finally:
+		opened.close()
+
+def index_directories(files):
+	"""
+	Finds the directory structure that a set of files are in.
+	:param files: The paths of the files. They must all be in the same root
+	directory.
+	:return: A tuple with the root directory and a dictionary with, for each
+	directory, a tuple of the list of names of its files and the list of names
+	of its subdirectories.
+	"""
+	root = os.path.commonpath([os.path.dirname(file) for file in files]) if files else ""
+	directories = {root: ([], [])}
+	for file in sorted(files):
+		directory, name = os.path.split(file)
+		if directory not in directories: #Also add it to all of its ancestors that don't know it yet.
+			directories[directory] = ([], [])
+			child = directory
+			while child != root:
+				parent, child_name = os.path.split(child)
+				is_new = parent not in directories
+				directories.setdefault(parent, ([], []))[1].append(child_name)
+				if not is_new:
+					break
+				child = parent
+		directories[directory][0].append(name)
+	return root, directories
+
+def archive_files(archive, members):
+	"""
+	Converts the names of the members of an archive to file paths.
+
+	Member names are normalised, so that members called ``./a/b`` and ``a/b``
+	get the same path. If the archive holds files at its top level, the archive
+	was made from inside the root directory, so the paths are placed in a root
+	directory named after the archive.
+	:param archive: The path to the archive.
+	:param members: A dictionary mapping the names of the files in the archive
+	to anything.
+	:return: A dictionary mapping the file paths to the same values.
+	"""
+	files = {}
+	for name, value in members.items():
+		path = os.path.normpath(os.path.join(*name.split("/"))) #Member names use slashes on every platform.
+		if path != ".": #The root directory itself.
+			files[path] = value
+	if any(not os.path.dirname(path) for path in files):
+		root = os.path.basename(archive).split(".")[0] #Without extensions like .tar.gz.
+		files = {os.path.join(root, path): value for path, value in files.items()}
+	return files
+
+class DirectorySource:
+	"""
+	Reads a profile structure from a directory.
+	"""
+
+	def __init__(self, directory):
+		"""
+		Creates a source for a directory.
+		:param directory: The root directory of the profile structure. The file
+		paths of the profiles start with this directory.
+		"""
+		self.root = directory
+
+	def __str__(self):
+		return str(self.root)
+
+	def list_directory(self, directory):
+		"""
+		Lists the contents of a directory in the profile structure.
+		:param directory: The path of the directory.
+		:return: A tuple with the sorted names of the files and the sorted names
+		of the subdirectories in the directory.
+		"""
+		files = []
+		directories = []
+		with os.scandir(directory) as entries: #Gets the type of each entry while listing, without a system call per entry.
+			for entry in entries:
+				if entry.is_dir():
+					directories.append(entry.name)
+				elif entry.is_file():
+					files.append(entry.name)
+		return sorted(files), sorted(directories)
+
+	def parse(self, file):
+		"""
+		Parses a file in the profile structure.
+		:param file: The path of the file.
+		:return: A ``Profile`` with the settings in the file.
+		"""
+		return parse(file)
+
+	def digest(self, file):
+		"""
+		Computes a digest of the contents of a file, to see if it changed.
+		:param file: The path of the file.
+		:return: The SHA-256 digest of the file, as hexadecimal string.
+		"""
+		with open(file, "rb") as input_file:
+			return hashlib.sha256(input_file.read()).hexdigest()
+
+class WatchedSource(DirectorySource):
+	"""
+	Reads a profile structure from a directory that is polled for changes.
+
+	The digest of each file is remembered together with its modification time
+	and size, so that files that weren't touched don't need to be read again to
+	see that they didn't change.
+	"""
+
+	def __init__(self, directory):
+		"""
+		Creates a source for a directory to watch.
+		:param directory: The root directory of the profile structure. The file
+		paths of the profiles start with this directory.
+		"""
+		super().__init__(directory)
+		self.digests = {} #For each file, its modification time and size when its digest was computed, and the digest.
+
+	def snapshot(self):
+		"""
+		Polls the modification time and size of every file in the directory.
+		:return: A dictionary with, for each file path, a tuple of its
+		modification time in nanoseconds and its size.
+		"""
+		snapshot = {}
+		for directory, _, files in os.walk(self.root):
+			for file in files:
+				path = os.path.join(directory, file)
+				try:
+					status = os.stat(path)
+				except OSError: #Removed while polling. The next poll will see it.
+					continue
+				snapshot[path] = (status.st_mtime_ns, status.st_size)
+		for file in self.digests.keys() - snapshot.keys(): #Forget removed files.
+			del self.digests[file]
+		return snapshot
+
+	def digest(self, file):
+		"""
+		Computes a digest of the contents of a file, to see if it changed.
+
+		The file is only read if it was modified since the previous digest.
+		:param file: The path of the file.
+		:return: The SHA-256 digest of the file, as hexadecimal string.
+		"""
+		status = os.stat(file)
+		modified = (status.st_mtime_ns, status.st_size)
+		entry = self.digests.get(file)
+		if entry and entry[0] == modified:
+			return entry[1]
+		digest = super().digest(file)
+		self.digests[file] = (modified, digest)
+		return digest
+
+class MemorySource:
+	"""
+	Reads a profile structure from files that are held in memory.
+	"""
+
+	def __init__(self, files):
+		"""
+		Creates a source for files in memory.
+		:param files: A dictionary with the contents of each file, by its path.
+		All files must be in the same root directory, such as
+		"fdmprinter/fdmprinter.def.json" and
+		"fdmprinter/ultimaker/ultimaker.inst.cfg".
+		"""
+		self.files = files
+		self.root, self.directories = index_directories(files) #The file paths of the profiles start with the root. For each directory, the names of the files and of the subdirectories in it.
+
+	def __str__(self):
+		return "{root} in memory".format(root=self.root)
+
+	def list_directory(self, directory):
+		"""
+		Lists the contents of a directory in the profile structure.
+		:param directory: The path of the directory.
+		:return: A tuple with the sorted names of the files and the sorted names
+		of the subdirectories in the directory.
+		"""
+		files, directories = self.directories[directory]
+		return sorted(files), sorted(directories)
+
+	def parse(self, file):
+		"""
+		Parses a file in the profile structure.
+		:param file: The path of the file.
+		:return: A ``Profile`` with the settings in the file.
+		"""
+		return parse(file, self.files[file])
+
+	def digest(self, file):
+		"""
+		Computes a digest of the contents of a file, to see if it changed.
+		:param file: The path of the file.
+		:return: The SHA-256 digest of the file, as hexadecimal string.
+		"""
+		return hashlib.sha256(self.files[file].encode("utf-8")).hexdigest()
+
+class ZipSource(MemorySource):
+	"""
+	Reads a profile structure from a zip archive.
+
+	The directory structure is found in the index of the archive, and files are
+	only read from the archive when they are parsed.
+	"""
+
+	def __init__(self, archive):
+		"""
+		Opens a zip archive.
+		:param archive: The path to the zip archive.
+		"""
+		self.archive = archive
+		self.zip_file = zipfile.ZipFile(archive)
+		members = {name: name for name in self.zip_file.namelist() if not name.endswith("/")} #Directories end in a slash.
+		super().__init__(archive_files(archive, members))
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		state["zip_file"] = None #Can't be sent to other processes. They open the archive again when they need it.
+		return state
+
+	def __str__(self):
+		return "{root} in {archive}".format(root=self.root, archive=self.archive)
+
+	def read(self, file):
+		"""
+		Reads a file from the archive.
+		:param file: The path of the file.
+		:return: The contents of the file.
+		"""
+		if self.zip_file is None:
+			self.zip_file = zipfile.ZipFile(self.archive)
+		return self.zip_file.read(self.files[file]).decode("utf-8")
+
+	def parse(self, file):
+		"""
+		Parses a file in the profile structure.
+		:param file: The path of the file.
+		:return: A ``Profile`` with the settings in the file.
+		"""
+		return parse(file, self.read(file))
+
+	def digest(self, file):
+		"""
+		Computes a digest of the contents of a file, to see if it changed.
+		:param file: The path of the file.
+		:return: The SHA-256 digest of the file, as hexadecimal string.
+		"""
+		return hashlib.sha256(self.read(file).encode("utf-8")).hexdigest()
+
+	def close(self):
+		"""
+		Closes the archive.
+		"""
+		if self.zip_file is not None:
+			self.zip_file.close()
+			self.zip_file = None
+
+class TarSource(MemorySource):
+	"""
+	Reads a profile structure from a tar archive, which may be compressed.
+
+	Compressed tar archives can only be read efficiently from start to end, so
+	all files are read into memory when the archive is opened.
+	"""
+
+	def __init__(self, archive):
+		"""
+		Reads all files from a tar archive.
+		:param archive: The path to the tar archive.
+		"""
+		self.archive = archive
+		files = {}
+		with tarfile.open(archive) as tar_file:
+			for member in tar_file:
+				if member.isfile():
+					files[member.name] = tar_file.extractfile(member).read().decode("utf-8")
+		super().__init__(archive_files(archive, files))
+
+	def __str__(self):
+		return "{root} in {archive}".format(root=self.root, archive=self.archive)
+
+	def close(self):
+		"""
+		Releases the files that were read from the archive.
+		"""
+		self.files = {}
+
+class DirectorySink:
+	"""
+	Writes a profile structure to a directory.
+	"""
+
+	def __init__(self, directory):
+		"""
+		Creates a sink for a directory.
+		:param directory: The root directory to write the profile structure to.
+		The file paths of the profiles are relative to this directory.
+		"""
+		self.directory = directory
+		self.created = set() #Directories that are known to exist, so they don't need to be created again.
+
+	def __str__(self):
+		return str(self.directory)
+
+	def write(self, file, contents, skip_unchanged=False):
+		"""
+		Writes a file. Its directory is created if it doesn't exist yet.
+
+		This may be called from multiple threads at the same time.
+		:param file: The path of the file, relative to the root directory.
+		:param contents: The contents to write to the file.
+		:param skip_unchanged: Whether to leave the file alone if it already has
+		these contents, and otherwise to replace it atomically.
+		"""
+		output_file = os.path.join(self.directory, file)
+		directory = os.path.dirname(output_file)
+		if directory not in self.created:
+			os.makedirs(directory, exist_ok=True)
+			self.created.add(directory)
+		write_file(output_file, contents, skip_unchanged)
+
+	def exists(self, file):
+		"""
+		Determines whether a file was already written.
+		:param file: The path of the file, relative to the root directory.
+		:return: ``True`` if the file exists, or ``False`` if it doesn't.
+		"""
+		return os.path.exists(os.path.join(self.directory, file))
+
+class MemorySink:
+	"""
+	Writes a profile structure to a dictionary in memory.
+	"""
+
+	def __init__(self):
+		"""
+		Creates a sink without any files.
+		"""
+		self.files = {} #The contents of each written file, by its path.
+
+	def __str__(self):
+		return "memory"
+
+	def write(self, file, contents, skip_unchanged=False):
+		"""
+		Stores the contents of a file.
+		:param file: The path of the file.
+		:param contents: The contents of the file.
+		:param skip_unchanged: Has no effect, since files in memory are never
+		partially written.
+		"""
+		self.files[file] = contents
+
+	def exists(self, file):
+		"""
+		Determines whether a file was already written.
+		:param file: The path of the file.
+		:return: ``True`` if the file was written, or ``False`` if it wasn't.
+		"""
+		return file in self.files
+
+class ZipSink:
+	"""
+	Writes a profile structure to a zip archive.
+
+	The archive is complete once the sink is closed. The files get a fixed
+	modification time, so that the same profiles always give the same archive.
+	"""
+
+	def __init__(self, archive):
+		"""
+		Creates a zip archive, replacing it if it exists.
+		:param archive: The path of the zip archive.
+		"""
+		self.archive = archive
+		self.zip_file = zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED)
+		self.written = set() #The paths of the files that were written.
+		self.lock = threading.Lock() #Files are written one at a time, even if this is called from multiple threads.
+
+	def __str__(self):
+		return str(self.archive)
+
+	def write(self, file, contents, skip_unchanged=False):
+		"""
+		Adds a file to the archive.
+
+		This may be called from multiple threads at the same time.
+		:param file: The path of the file.
+		:param contents: The contents of the file.
+		:param skip_unchanged: Has no effect, since the whole archive is
+		written anew.
+		"""
+		member = zipfile.ZipInfo("/".join(file.split(os.sep)), date_time=(1980, 1, 1, 0, 0, 0))
+		member.compress_type = zipfile.ZIP_DEFLATED
+		data = contents.encode("utf-8")
+		with self.lock:
+			self.zip_file.writestr(member, data)
+			self.written.add(file)
+
+	def exists(self, file):
+		"""
+		Determines whether a file was already written.
+		:param file: The path of the file.
+		:return: ``True`` if the file was written, or ``False`` if it wasn't.
+		"""
+		return file in self.written
+
+	def close(self):
+		"""
+		Completes the archive.
+		"""
+		self.zip_file.close()
+
+class TarSink:
+	"""
+	Writes a profile structure to a tar archive, compressed according to its
+	extension as listed in ``tar_compressions``.
+
+	The archive is complete once the sink is closed. The files get a fixed
+	modification time, so that the same profiles always give the same archive.
+	"""
+
+	def __init__(self, archive):
+		"""
+		Creates a tar archive, replacing it if it exists.
+		:param archive: The path of the tar archive.
+		"""
+		self.archive = archive
+		name = os.fspath(archive).lower()
+		compression = next(compression for extension, compression in tar_compressions.items() if name.endswith(extension))
+		self.tar_file = tarfile.open(archive, "w:" + compression)
+		self.written = set() #The paths of the files that were written.
+		self.lock = threading.Lock() #Files are written one at a time, even if this is called from multiple threads.
+
+	def __str__(self):
+		return str(self.archive)
+
+	def write(self, file, contents, skip_unchanged=False):
+		"""
+		Adds a file to the archive.
+
+		This may be called from multiple threads at the same time.
+		:param file: The path of the file.
+		:param contents: The contents of the file.
+		:param skip_unchanged: Has no effect, since the whole archive is
+		written anew.
+		"""
+		member = tarfile.TarInfo("/".join(file.split(os.sep)))
+		data = contents.encode("utf-8")
+		member.size = len(data)
+		member.mode = 0o644
+		with self.lock:
+			self.tar_file.addfile(member, io.BytesIO(data))
+			self.written.add(file)
+
+	def exists(self, file):
+		"""
+		Determines whether a file was already written.
+		:param file: The path of the file.
+		:return: ``True`` if the file was written, or ``False`` if it wasn't.
+		"""
+		return file in self.written
+
+	def close(self):
+		"""
+		Completes the archive.
+		"""
+		self.tar_file.close()
+
+#################################TRAVERSAL######################################
+
+class ProfileTraversal:
+	"""
+	The order in which to visit the profiles of a profile structure.
+
+	The order is computed once, after which each stage visits the profiles in a
+	flat loop instead of recursing through the profile structure. That way,
+	deep profile structures can't exceed the recursion limit either.
+	"""
+	__slots__ = ("profiles", "parents", "depths", "post_order")
+
+	def __init__(self, profile_root):
+		"""
+		Computes the order in which to visit a profile structure.
+		:param profile_root: The root profile, containing all profiles as
+		subprofiles.
+		"""
+		self.profiles = [] #All profiles in pre-order: Each profile comes before its subprofiles.
+		self.parents = [] #For each profile, the index of its parent, or -1 for the root.
+		self.depths = [] #For each profile, how many profiles are above it.
+		pending = [(profile_root, -1, 0)]
+		while pending:
+			profile, parent, depth = pending.pop()
+			index = len(self.profiles)
+			self.profiles.append(profile)
+			self.parents.append(parent)
+			self.depths.append(depth)
+			pending.extend((subprofile, index, depth + 1) for subprofile in reversed(list(profile.subprofiles))) #Reversed, so that they are visited in order.
+
+		self.post_order = [] #The indices of all profiles in post-order: Each profile comes after its subprofiles.
+		ancestors = [] #The indices of the profiles above the current one whose subtree hasn't been completed yet.
+		for index, parent in enumerate(self.parents):
+			while ancestors and ancestors[-1] != parent: #All profiles in the subtree of these ancestors have been seen.
+				self.post_order.append(ancestors.pop())
+			ancestors.append(index)
+		self.post_order.extend(reversed(ancestors))
+
+#################################INSTRUMENTATION################################
+
+class StageProfiler:
+	"""
+	Measures the time and memory that each stage of the optimisation takes.
+
+	For each stage, it records the wall time, the processor time, the peak
+	memory allocated by Python during the stage, the peak memory usage of the
+	process so far and how many profiles and settings there are after the stage.
+	"""
+
+	def __init__(self, enabled=True):
+		"""
+		Creates a profiler without any measurements.
+		:param enabled: Whether to measure anything at all. If not, the stages
+		run without any overhead.
+		"""
+		self.enabled = enabled
+		self.stages = [] #For each measured stage, a dictionary of measurements.
+
+	@contextlib.contextmanager
+	def stage(self, name, counter):
+		"""
+		Measures a stage of the optimisation, while in this context.
+		:param name: The name of the stage.
+		:param counter: A function that returns how many profiles and settings
+		there are, to call after the stage is completed.
+		"""
+		if not self.enabled:
+			yield
+			return
+		was_tracing = tracemalloc.is_tracing()
+		if not was_tracing:
+			tracemalloc.start()
+		tracemalloc.reset_peak()
+		start_wall = time.perf_counter()
+		start_cpu = time.process_time()
+		yield
+		wall_time = time.perf_counter() - start_wall
+		cpu_time = time.process_time() - start_cpu
+		_, peak_traced = tracemalloc.get_traced_memory()
+		if not was_tracing:
+			tracemalloc.stop()
+		num_profiles, num_settings = counter()
+		self.stages.append({
+			"stage": name,
+			"wall_time": wall_time,
+			"cpu_time": cpu_time,
+			"peak_traced_memory": peak_traced,
+			"peak_rss": peak_rss(),
+			"profiles": num_profiles,
+			"settings": num_settings
+		})
+
+	def report(self):
+		"""
+		Creates a report of all measured stages.
+		:return: A dictionary with the measurements of each stage and the totals
+		over all stages, which can be serialised to JSON.
+		"""
+		return {
+			"stages": self.stages,
+			"total": {
+				"wall_time": sum(stage["wall_time"] for stage in self.stages),
+				"cpu_time": sum(stage["cpu_time"] for stage in self.stages),
+				"peak_traced_memory": max((stage["peak_traced_memory"] for stage in self.stages), default=0),
+				"peak_rss": peak_rss()
+			}
+		}
+
+	def write(self, file):
+		"""
+		Writes the report of all measured stages to a JSON file.
+		:param file: The path of the file to write the report to.
+		"""
+		with open(file, "w") as report_file:
+			json.dump(self.report(), report_file, indent="\t")
+
+class SizeReport:
+	"""
+	Records how many settings each profile has and how large its file is,
+	before and after the optimisation.
+	"""
+
+	def __init__(self):
+		"""
+		Creates a report without any profiles.
+		"""
+		self.profiles = {} #For each file path, the number of settings and the estimated size before and after optimising.
+
+	def before(self, profile):
+		"""
+		Records the size of a profile as it was read.
+		:param profile: The profile, before it is flattened.
+		"""
+		self.profiles[profile.filepath] = [len(profile.settings), estimate_cfg_size(profile), 0, 0]
+
+	def after(self, profile):
+		"""
+		Records the size of a profile as it would be written.
+		:param profile: The optimised profile.
+		"""
+		self.profiles.setdefault(profile.filepath, [0, 0, 0, 0])[2:] = [len(profile.settings), estimate_cfg_size(profile)]
+
+	def report(self):
+		"""
+		Creates a report of all recorded profiles.
+		:return: A dictionary with the sizes of each profile and the totals over
+		all profiles, which can be serialised to JSON.
+		"""
+		rows = [{
+			"file": filepath,
+			"settings_before": sizes[0],
+			"settings_after": sizes[2],
+			"bytes_before": sizes[1],
+			"bytes_after": sizes[3]
+		} for filepath, sizes in sorted(self.profiles.items())]
+		return {
+			"profiles": rows,
+			"total": {field: sum(row[field] for row in rows) for field in ("settings_before", "settings_after", "bytes_before", "bytes_after")}
+		}
+
+	def write(self, file):
+		"""
+		Writes the report to a file.
+
+		If the file name ends in ".csv", the report is written as CSV with a row
+		for each profile. Otherwise it is written as JSON.
+		:param file: The path of the file to write the report to.
+		"""
+		report = self.report()
+		total = report["total"]
+		logging.info("Optimising reduces {settings_before} settings in {bytes_before} bytes to {settings_after} settings in {bytes_after} bytes.".format(**total))
+		with open(file, "w", newline="") as report_file:
+			if file.lower().endswith(".csv"):
+				writer = csv.DictWriter(report_file, fieldnames=["file", "settings_before", "settings_after", "bytes_before", "bytes_after"])
+				writer.writeheader()
+				writer.writerows(report["profiles"])
+			else:
+				json.dump(report, report_file, indent="\t")
+
+def peak_rss():
+	"""
+	Gets the peak memory usage of this process so far.
+	:return: The peak resident set size in bytes, or ``None`` if it can't be
+	measured on this platform.
+	"""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform != "darwin": #Linux reports kilobytes, macOS reports bytes.
+		peak *= 1024
+	return peak
+
+#################################CACHE##########################################
+
+class ProfileCache:
+	"""
+	Remembers parsed profiles and optimisation results between runs, so that
+	only what changed needs to be recomputed.
+
+	Parsed profiles are stored by file path and a digest of the file's contents.
+	The changes that bubbling made are stored by a digest of the subtree they
+	were computed from. The digests of the written files are stored by path.
+	Entries that were not used in a run are dropped when saving.
+	"""
+	version = 2
+	"""
+	The version of the cache format. Caches of other versions are discarded.
+	"""
+
+	def __init__(self, filepath):
+		"""
+		Loads the cache from a file, if it exists.
+		:param filepath: The file to store the cache in. If ``None``, the cache
+		is only kept in memory.
+		"""
+		self.filepath = filepath
+		self.digests = {} #For each file read in this run, the digest of its contents.
+		self.parsed = {} #Parsed profiles from the previous run, by file path.
+		self.bubbled = {} #Changes made by bubbling in the previous run, by subtree digest.
+		self.written = {} #Digests of written files from the previous run, by file path.
+		self.used_parsed = {} #The same, but only the entries used in this run.
+		self.used_bubbled = {}
+		self.used_written = {}
+		if filepath is None:
+			return
+		try:
+			with open(filepath, "rb") as cache_file:
+				data = pickle.load(cache_file)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return #No usable cache yet.
+		if data.get("version") != self.version:
+			return
+		self.parsed = data["parsed"]
+		self.bubbled = data["bubbled"]
+		self.written = data["written"]
+
+	def save(self):
+		"""
+		Stores the entries used in this run in the cache file.
+		"""
+		if self.filepath is None:
+			return
+		with open(self.filepath, "wb") as cache_file:
+			pickle.dump({
+				"version": self.version,
+				"parsed": self.used_parsed,
+				"bubbled": self.used_bubbled,
+				"written": self.used_written
+			}, cache_file)
+
+	def keep_unused(self):
+		"""
+		Keeps the entries of the previous run that were not used in this run,
+		as if they were used.
+
+		Runs that only look at part of the profile structure use this to keep
+		the entries of the rest.
+		"""
+		for used, previous in ((self.used_parsed, self.parsed), (self.used_bubbled, self.bubbled), (self.used_written, self.written)):
+			for key, entry in previous.items():
+				used.setdefault(key, entry)
+
+	def next_run(self):
+		"""
+		Starts a new run in the same process, with the entries used in this run
+		as the entries of the previous run.
+		"""
+		self.digests = {}
+		self.parsed, self.used_parsed = self.used_parsed, {}
+		self.bubbled, self.used_bubbled = self.used_bubbled, {}
+		self.written, self.used_written = self.used_written, {}
+
+	def load(self, file, source):
+		"""
+		Gets the profile parsed from a file, if the file didn't change since it
+		was parsed.
+		:param file: The path of the file to get the profile of.
+		:param source: The source that contains the file.
+		:return: A new profile with the settings from the file, or ``None`` if
+		the file needs to be parsed.
+		"""
+		digest = source.digest(file)
+		self.digests[file] = digest
+		entry = self.parsed.get(file)
+		if not entry or entry[0] != digest:
+			return None
+		self.used_parsed[file] = entry
+		_, settings, baseconfig = entry
+		return Profile(filepath=file, settings=dict(settings), baseconfig=baseconfig) #Copies the settings, since the optimisation modifies them. The base config is immutable.
+
+	def store(self, file, profile):
+		"""
+		Stores a newly parsed profile in the cache.
+
+		The file must have been given to ``load`` first, to compute its digest.
+		:param file: The path of the file that the profile was parsed from.
+		:param profile: The profile parsed from that file.
+		"""
+		self.used_parsed[file] = (self.digests[file], dict(profile.settings), profile.baseconfig)
+
+	def bubble_memo(self, subtree_digests):
+		"""
+		Creates a memo for ``bubble_common_values`` from this cache.
+		:param subtree_digests: The digest of the subtree of each profile, as
+		computed by ``subtree_digests``.
+		:return: A ``BubbleMemo``.
+		"""
+		return BubbleMemo(subtree_digests, self.bubbled, self.used_bubbled)
+
+	def needs_writing(self, file, contents, sink):
+		"""
+		Determines whether a file needs to be written, because it doesn't exist
+		or because it was written with different contents in the previous run.
+		:param file: The path of the file to write, relative to the sink.
+		:param contents: The new contents of the file.
+		:param sink: The sink to write the file to.
+		:return: ``True`` if the file needs to be written, or ``False`` if it
+		already has these contents.
+		"""
+		digest = hashlib.sha256(contents.encode("utf-8")).hexdigest()
+		self.used_written[file] = digest
+		return self.written.get(file) != digest or not sink.exists(file)
+
+class BubbleMemo:
+	"""
+	The changes that bubbling made to profiles whose subtrees haven't changed.
+	"""
+
+	def __init__(self, subtree_digests, previous, current):
+		"""
+		Creates the memo.
+		:param subtree_digests: The digest of the subtree of each profile.
+		:param previous: The changes made in the previous run, by subtree
+		digest.
+		:param current: A dictionary to store the changes made in this run in,
+		by subtree digest.
+		"""
+		self.subtree_digests = subtree_digests
+		self.previous = previous
+		self.current = current
+
+	def get(self, profile):
+		"""
+		Gets the changes that bubbling made to a profile in the previous run.
+		:param profile: The profile to bubble.
+		:return: A dictionary with the new values of the settings that changed,
+		or ``None`` if the profile's subtree changed since the previous run.
+		"""
+		digest = self.subtree_digests[profile]
+		changes = self.previous.get(digest)
+		if changes is not None:
+			self.current[digest] = changes
+		return changes
+
+	def put(self, profile, changes):
+		"""
+		Remembers the changes that bubbling made to a profile.
+		:param profile: The profile that was bubbled.
+		:param changes: A dictionary with the new values of the settings that
+		changed.
+		"""
+		self.current[self.subtree_digests[profile]] = changes
+
+#################################INCREMENTAL####################################
+
+class BubbleHistograms:
+	"""
+	Keeps a bubbled profile structure up to date when the settings of a profile
+	change, without bubbling the whole profile structure again.
+
+	For each profile that is bubbled and each setting, it keeps a histogram of
+	the total weight of the subprofiles that vote for each value, as counted by
+	``find_common_values``. When a setting of a profile changes, only the
+	histograms of the profiles above it change, so only those get a new most
+	common value, and only for the settings whose histograms changed.
+	"""
+
+	def __init__(self, profile_root, bubble_from_depth, traversal=None):
+		"""
+		Bubbles the common values up, like ``bubble_common_values``, and keeps
+		the histograms of the votes.
+		:param profile_root: The root profile, containing all profiles as
+		subprofiles. It must be flattened, but not lazily, and its redundancies
+		must not be removed. Its profiles are modified to this end.
+		:param bubble_from_depth: How many layers of profiles below the root
+		should be exempt from bubbling.
+		:param traversal: The ``ProfileTraversal`` of the root profile, if it
+		was already computed.
+		"""
+		self.traversal = traversal or ProfileTraversal(profile_root)
+		profiles = self.traversal.profiles
+		parents = self.traversal.parents
+		self.indices = {id(profile): index for index, profile in enumerate(profiles)}
+		self.materials = [is_material(profile) for profile in profiles]
+		self.children = [[] for _ in profiles]
+		self.material_voters = [[] for _ in profiles] #For each profile, the indices of the profiles that vote on its material settings.
+		self.nonmaterial_voters = [[] for _ in profiles] #The same for non-material settings, which skip material profiles.
+		self.nonmaterial_parents = [] #For each profile, the index of the profile it compares non-material settings with, as in ``remove_profile_redundancies``.
+		for index, parent in enumerate(parents):
+			self.nonmaterial_parents.append(parents[parent] if parent != -1 and self.materials[parent] and parents[parent] != -1 else parent)
+			if parent == -1:
+				continue
+			self.children[parent].append(index)
+			self.material_voters[parent].append(index)
+			if not self.materials[index]:
+				self.nonmaterial_voters[parent].append(index)
+			if self.materials[parent] and parents[parent] != -1: #Votes in the profile above the material profile instead.
+				self.nonmaterial_voters[parents[parent]].append(index)
+		self.material_votes = [[] for _ in profiles] #For each profile, the indices of the profiles whose material settings it votes on.
+		self.nonmaterial_votes = [[] for _ in profiles]
+		for voters, votes in ((self.material_voters, self.material_votes), (self.nonmaterial_voters, self.nonmaterial_votes)):
+			for index, profile_voters in enumerate(voters):
+				for voter in profile_voters:
+					votes[voter].append(index)
+
+		self.histograms = [None] * len(profiles) #For each bubbled profile, the total weight of each value of each setting among its voters.
+		for index in self.traversal.post_order: #Subprofiles are bubbled before their parents.
+			profile = profiles[index]
+			if not profile.subprofiles or self.traversal.depths[index] < bubble_from_depth:
+				continue
+			histograms = {}
+			for key in profile.settings:
+				if key in material_settings:
+					voters = self.material_voters[index]
+				elif self.materials[index]: #We can't store the setting in this profile.
+					continue
+				else:
+					voters = self.nonmaterial_voters[index]
+				histogram = {}
+				for voter in voters:
+					value = profiles[voter].settings[key]
+					histogram[value] = histogram.get(value, 0) + profiles[voter].weight
+				histograms[key] = histogram
+				profile.settings[key] = most_common_value(histogram)
+			self.histograms[index] = histograms
+
+	def update(self, profile, changes):
+		"""
+		Changes the settings of one profile and bubbles the new values up.
+
+		Only the profiles above the profile are bubbled again, and only for the
+		settings whose histograms changed.
+		:param profile: The profile whose settings changed.
+		:param changes: A dictionary with the new values of the settings that
+		changed, as they would be after flattening. Settings that the profile
+		gets by bubbling keep their bubbled value.
+		:return: The profiles whose settings after removing redundancies are
+		different now, in the order of the profile structure.
+		"""
+		profiles = self.traversal.profiles
+		parents = self.traversal.parents
+		track_setting = tracked_setting.get()
+		old_values = {} #For each profile index and setting that changed, the value before the update.
+		pending = {} #For each profile index, the settings whose histograms changed.
+
+		def set_value(index, key, value):
+			"""
+			Changes a setting of a profile, and its votes in the histograms.
+			:param index: The index of the profile.
+			:param key: The setting to change.
+			:param value: The new value of the setting.
+			"""
+			settings = profiles[index].settings
+			old_value = settings[key]
+			if old_value == value:
+				return
+			old_values.setdefault((index, key), old_value)
+			settings[key] = value
+			weight = profiles[index].weight
+			for voted in (self.material_votes if key in material_settings else self.nonmaterial_votes)[index]:
+				histogram = self.histograms[voted].get(key) if self.histograms[voted] is not None else None
+				if histogram is None: #Not bubbled.
+					continue
+				histogram[old_value] -= weight
+				if not histogram[old_value]:
+					del histogram[old_value]
+				histogram[value] = histogram.get(value, 0) + weight
+				pending.setdefault(voted, set()).add(key)
+
+		index = self.indices[id(profile)]
+		histograms = self.histograms[index] or {}
+		for key, value in changes.items():
+			if key not in histograms:
+				set_value(index, key, value)
+		ancestor = parents[index]
+		while ancestor != -1: #The profiles it votes in are all above it, so bubble them bottom-up.
+			for key in pending.pop(ancestor, ()):
+				value = most_common_value(self.histograms[ancestor][key])
+				if key == track_setting and value != profiles[ancestor].settings[key]:
+					logging.debug("Bubbling set {key} to {value} in {file}.".format(key=key, value=value, file=profiles[ancestor].filepath))
+				set_value(ancestor, key, value)
+			ancestor = parents[ancestor]
+
+		affected = set()
+		for (index, key), old_value in old_values.items():
+			comparing = [index] #The profiles whose output for this setting depends on this profile.
+			for child in self.children[index]:
+				if key in material_settings or self.nonmaterial_parents[child] == index:
+					comparing.append(child)
+				if key not in material_settings and self.materials[child]:
+					comparing.extend(grandchild for grandchild in self.children[child] if self.nonmaterial_parents[grandchild] == index)
+			for candidate in comparing:
+				if candidate not in affected and self.written_value(candidate, key, old_values) != self.written_value(candidate, key, {}):
+					affected.add(candidate)
+		return [profiles[index] for index in sorted(affected)]
+
+	def written_value(self, index, key, old_values):
+		"""
+		Finds the value that remains of a setting in a profile after removing
+		redundancies.
+		:param index: The index of the profile.
+		:param key: The setting to find the value of.
+		:param old_values: The values to use instead of the current values, by
+		profile index and setting.
+		:return: A tuple with the value of the setting if it remains, or an empty
+		tuple if it is removed.
+		"""
+		value = old_values.get((index, key), self.traversal.profiles[index].settings[key])
+		parent = self.traversal.parents[index]
+		if parent == -1: #Edge case: Root file has no redundancies.
+			return (value,)
+		if key in material_settings:
+			compared = parent
+		elif self.materials[index]:
+			return ()
 		else:
-			config["values"][key] = profile.settings[key]
+			compared = self.nonmaterial_parents[index]
+		return () if value == old_values.get((compared, key), self.traversal.profiles[compared].settings[key]) else (value,)
+
+	def written_settings(self, profile):
+		"""
+		Finds the settings that remain in a profile after removing redundancies,
+		without changing the profile.
+		:param profile: The profile to find the settings of.
+		:return: A dictionary with the settings that remain.
+		"""
+		index = self.indices[id(profile)]
+		settings = {}
+		for key in profile.settings:
+			for value in self.written_value(index, key, {}): #Empty if it is removed.
+				settings[key] = value
+		return settings
+
+class WatchedProfiles:
+	"""
+	A profile structure that is kept optimised in memory while its files
+	change, for ``watch``.
+
+	The profiles stay flattened and bubbled in a ``BubbleHistograms``. When
+	only the contents of leaf profiles change, the changes are bubbled along
+	the path to the root and only the profiles whose output changes are
+	written. Any other change reads and optimises the whole profile structure
+	again.
+	"""
+
+	def __init__(self, source, sink, options, cache):
+		"""
+		Reads, optimises and writes a profile structure.
+		:param source: The source to read the profile structure from.
+		:param sink: Where to write the optimised profiles to, as accepted by
+		``open_sink``.
+		:param options: The ``Options`` to optimise with. The engine, optimise
+		jobs, solver, report file and stages file are not used.
+		:param cache: The ``ProfileCache`` to get the profiles of files that
+		didn't change from, and to remember what was written in.
+		"""
+		self.source = source
+		self.sink = sink
+		self.options = options
+		self.cache = cache
+		self.reload()
+
+	def reload(self):
+		"""
+		Reads, optimises and writes the whole profile structure again.
+		"""
+		profile_root = get_profiles(self.source, self.options.jobs, self.cache)
+		traversal = ProfileTraversal(profile_root)
+		num_profiles, num_settings = count_settings(profile_root)
+		logging.info("Read {profiles} profiles with {settings} settings from {source}.".format(profiles=num_profiles, settings=num_settings, source=self.source))
+		self.leaves = {profile.filepath: profile for profile in traversal.profiles if not profile.subprofiles} #The profiles that can be updated without reading everything again, by file.
+		self.own_settings = {profile: dict(profile.settings) for profile in traversal.profiles if profile.subprofiles} #The settings in the files of the other profiles, to find what leaves inherit.
+		flatten_profiles(profile_root, traversal=traversal)
+		self.histograms = BubbleHistograms(profile_root, self.options.bubble_from_depth, traversal)
+		self.write(traversal.profiles)
+
+	def update(self, changed_files):
+		"""
+		Optimises the profile structure again after some of its files changed.
+		:param changed_files: The paths of the files that were changed, added
+		or removed.
+		"""
+		if any(file not in self.leaves or not os.path.isfile(file) for file in changed_files):
+			logging.info("The structure changed, so all profiles are optimised again.")
+			self.reload()
+			return
+		traversal = self.histograms.traversal
+		changed_profiles = set()
+		for file in changed_files:
+			profile = self.leaves[file]
+			parsed = self.cache.load(file, self.source)
+			if parsed is None:
+				parsed = self.source.parse(file)
+				self.cache.store(file, parsed)
+			if parsed.baseconfig != profile.baseconfig or parsed.settings.keys() - profile.settings.keys(): #Could change whether it is a material, or needs a setting that isn't in the root.
+				logging.info("{file} changed its metadata or settings, so all profiles are optimised again.".format(file=file))
+				self.reload()
+				return
+			changes = {}
+			parent = traversal.parents[self.histograms.indices[id(profile)]]
+			for key, value in profile.settings.items():
+				new_value = parsed.settings.get(key)
+				ancestor = parent
+				while new_value is None and ancestor != -1: #No longer in its own file, so it inherits the value again.
+					new_value = self.own_settings[traversal.profiles[ancestor]].get(key)
+					ancestor = traversal.parents[ancestor]
+				if new_value is None: #Was only in this file.
+					self.reload()
+					return
+				if new_value != value:
+					changes[key] = new_value
+			changed_profiles.update(self.histograms.update(profile, changes))
+		logging.info("The optimised settings of {profiles} profiles changed.".format(profiles=len(changed_profiles)))
+		self.write([profile for profile in traversal.profiles if profile in changed_profiles])
+
+	def write(self, profiles):
+		"""
+		Writes the optimised settings of profiles, and remembers what was
+		written in the cache.
+		:param profiles: The profiles to write. Archives are written again
+		completely, since they can't be changed in place.
+		"""
+		if not self.options.dry_run:
+			with open_sink(self.sink) as sink:
+				if isinstance(sink, (ZipSink, TarSink)):
+					profiles = self.histograms.traversal.profiles
+				outputs = [Profile(filepath=profile.filepath, settings=self.histograms.written_settings(profile), baseconfig=profile.baseconfig, kind=profile.kind) for profile in profiles]
+				write_profile_files(sink, outputs, self.cache, self.options.skip_unchanged, self.options.write_jobs)
+			logging.info("Wrote {profiles} profiles to {sink}.".format(profiles=len(profiles), sink=self.sink))
+		self.cache.keep_unused()
+		self.cache.save()
+		self.cache.next_run()
+
+#################################COMPACT ENGINE#################################
+
+class CompactProfiles:
+	"""
+	Stores the settings of a whole profile structure compactly.
+
+	Each setting key gets a column in a global key index and each distinct value
+	gets an ID in a global value table. The settings of each profile are then
+	an array of value IDs, with ``-1`` for settings that the profile doesn't
+	have. The optimisation stages can then compare and count integers instead
+	of looking up strings in a dictionary per profile.
+	"""
+	__slots__ = ("profiles", "parents", "children", "depths", "materials", "weights", "keys", "key_index", "material_columns", "values", "value_index", "rows")
+
+	def __init__(self, profile_root):
+		"""
+		Encodes the settings of a profile structure.
+		:param profile_root: The root profile, containing all profiles as
+		subprofiles.
+		"""
+		self.profiles = [] #All profiles in pre-order, so parents come before their children.
+		self.parents = [] #For each profile, the index of its parent, or -1 for the root.
+		self.children = [] #For each profile, the indices of its subprofiles.
+		self.depths = [] #For each profile, how many levels it is below the root.
+		pending = [(profile_root, -1, 0)]
+		while pending:
+			profile, parent, depth = pending.pop()
+			index = len(self.profiles)
+			self.profiles.append(profile)
+			self.parents.append(parent)
+			self.children.append([])
+			self.depths.append(depth)
+			if parent != -1:
+				self.children[parent].append(index)
+			pending.extend((subprofile, index, depth + 1) for subprofile in reversed(list(profile.subprofiles)))
+		self.materials = [is_material(profile) for profile in self.profiles]
+		self.weights = [profile.weight for profile in self.profiles]
+
+		self.keys = [] #For each column, the setting key.
+		self.key_index = {} #For each setting key, the column.
+		for profile in self.profiles:
+			for key in profile.settings:
+				if key not in self.key_index:
+					self.key_index[key] = len(self.keys)
+					self.keys.append(key)
+		self.material_columns = [key in material_settings for key in self.keys]
+
+		self.values = [] #For each value ID, the value.
+		self.value_index = {} #For each value, the value ID.
+		self.rows = [self.encode(profile.settings) for profile in self.profiles]
+
+	def value_id(self, value):
+		"""
+		Gets the ID of a value, interning it if it wasn't known yet.
+		:param value: The value of a setting.
+		:return: The ID of the value.
+		"""
+		try:
+			return self.value_index[value]
+		except KeyError:
+			self.value_index[value] = len(self.values)
+			self.values.append(value)
+			return self.value_index[value]
+
+	def encode(self, settings):
+		"""
+		Encodes a dictionary of settings as an array of value IDs.
+		:param settings: The dictionary of settings to encode.
+		:return: An array with the ID of the value of each column, or -1 if the
+		setting is not in the dictionary.
+		"""
+		row = array.array("i", [-1]) * len(self.keys)
+		for key, value in settings.items():
+			row[self.key_index[key]] = self.value_id(value)
+		return row
+
+	def decode(self, row):
+		"""
+		Decodes an array of value IDs to a dictionary of settings.
+		:param row: The array of value IDs to decode.
+		:return: A dictionary of settings.
+		"""
+		return {self.keys[column]: self.values[value] for column, value in enumerate(row) if value != -1}
+
+	def store(self):
+		"""
+		Replaces the settings of all profiles by the decoded settings in this
+		table.
+		"""
+		for profile, row in zip(self.profiles, self.rows):
+			profile.settings = self.decode(row)
+
+	def flatten_profiles(self):
+		"""
+		Flattens all profiles, filling in the settings that they inherit from
+		their parents.
+
+		This is the equivalent of ``flatten_profiles`` on the compact table.
+		"""
+		for index in range(1, len(self.profiles)): #Parents come before their children, so they are already flat.
+			row = self.rows[index]
+			for column, value in enumerate(self.rows[self.parents[index]]):
+				if row[column] == -1: #Only inherit settings that are not specified in the profile itself.
+					row[column] = value
+
+	def bubble_common_values(self, bubble_from_depth):
+		"""
+		Finds the common denominator of the profiles in each subgroup, and
+		bubbles them up.
+
+		This is the equivalent of ``bubble_common_values`` on the compact table.
+		:param bubble_from_depth: How many layers of profiles below the root
+		should not get bubbled.
+		"""
+		for index in reversed(range(len(self.profiles))): #Children come after their parents, so in reverse they are bubbled first.
+			if self.depths[index] < bubble_from_depth or not self.children[index]:
+				continue
+			self.bubble_profile(index)
+
+	def voters(self, index):
+		"""
+		Finds the profiles that vote on the values of a profile when bubbling.
+		:param index: The index of the profile that is being bubbled.
+		:return: A tuple with the indices of the profiles that vote on material
+		settings and the indices of the profiles that vote on other settings.
+		For other settings, material profiles are skipped in favour of their
+		subprofiles.
+		"""
+		nonmaterial_voters = []
+		for child in self.children[index]:
+			if self.materials[child]:
+				nonmaterial_voters.extend(self.children[child]) #TODO: Make it possible to have multiple material profiles in the chain.
+			else:
+				nonmaterial_voters.append(child)
+		return self.children[index], nonmaterial_voters
+
+	def bubble_profile(self, index):
+		"""
+		Sets each setting of one profile to the most common value among the
+		profiles below it.
+		:param index: The index of the profile to bubble.
+		"""
+		material_voters, nonmaterial_voters = self.voters(index)
+		material_voters = [(self.rows[voter], self.weights[voter]) for voter in material_voters]
+		nonmaterial_voters = [(self.rows[voter], self.weights[voter]) for voter in nonmaterial_voters]
+
+		row = self.rows[index]
+		for column, value in enumerate(row):
+			if value == -1: #Profile doesn't have this setting.
+				continue
+			if self.material_columns[column]:
+				column_voters = material_voters
+			elif self.materials[index]: #We can't store the setting in this profile, so don't update the profile.
+				continue
+			else:
+				column_voters = nonmaterial_voters
+			value_counts = {}
+			for voter_row, weight in column_voters:
+				voter_value = voter_row[column]
+				value_counts[voter_value] = value_counts.get(voter_value, 0) + weight
+			row[column] = self.most_common(value_counts)
+
+	def count_settings(self):
+		"""
+		Counts the profiles in the table and the settings stored for them.
+		:return: A tuple with the number of profiles and the number of settings.
+		"""
+		return len(self.rows), sum(len(row) - row.count(-1) for row in self.rows)
+
+	def most_common(self, value_counts):
+		"""
+		Finds the most common value ID, breaking ties in the same way as
+		``bubble_common_values``.
+		:param value_counts: A dictionary mapping value IDs to their weights.
+		:return: The ID of the value with the highest weight.
+		"""
+		most_common_value = None
+		highest_count = -1
+		for value, count in value_counts.items():
+			if count > highest_count:
+				most_common_value = value
+				highest_count = count
+			elif count == highest_count: #We have a tie.
+				if self.values[value] < self.values[most_common_value]: #Just to make it deterministic.
+					most_common_value = value
+		if most_common_value is None: #No votes at all.
+			return self.value_id(None)
+		return most_common_value
+
+	def remove_redundancies(self):
+		"""
+		Removes the settings in each profile that have the same value as its
+		parent.
+
+		This is the equivalent of ``remove_redundancies`` on the compact table.
+		"""
+		for index in reversed(range(1, len(self.profiles))): #Children before their parents, since they compare with the settings of their parents. Root has no redundancies.
+			parent = self.parents[index]
+			grandparent = self.parents[parent]
+			parent_row = self.rows[parent]
+			nonmaterial_parent_row = self.rows[grandparent] if self.materials[parent] and grandparent != -1 else parent_row
+			is_material_profile = self.materials[index]
+			row = self.rows[index]
+			for column, value in enumerate(row):
+				if value == -1:
+					continue
+				if self.material_columns[column]:
+					if value == parent_row[column]:
+						row[column] = -1
+				elif is_material_profile or value == nonmaterial_parent_row[column]: #Non-material setting in a material profile, or same as parent.
+					row[column] = -1
+
+class NumpyProfiles(CompactProfiles):
+	"""
+	Compact storage of the settings of a profile structure that bubbles common
+	values with NumPy.
+
+	For each profile, the value IDs of the profiles that vote on it are put in a
+	matrix with a row per voter and a column per setting. The weighted most
+	common value of every column is then computed in one batch, with the same
+	tie-breaking as ``bubble_common_values``.
+	"""
+	__slots__ = ("material_column_mask", "ranks")
+
+	def __init__(self, profile_root):
+		"""
+		Encodes the settings of a profile structure.
+		:param profile_root: The root profile, containing all profiles as
+		subprofiles.
+		"""
+		if numpy is None:
+			raise ImportError("The numpy engine requires NumPy to be installed.")
+		super().__init__(profile_root)
+		self.material_column_mask = numpy.array(self.material_columns, dtype=bool)
+		self.ranks = numpy.empty(0, dtype=numpy.int64) #For each value ID, its position when the values are sorted. Used to break ties.
+
+	def update_ranks(self):
+		"""
+		Sorts the values to be able to break ties, if values were added since
+		the last time they were sorted.
+		:return: ``True`` if the values could be sorted, or ``False`` if they
+		can't be compared with each other.
+		"""
+		if len(self.ranks) == len(self.values):
+			return True
+		try:
+			order = sorted(range(len(self.values)), key=self.values.__getitem__)
+		except TypeError: #Values of different types.
+			return False
+		self.ranks = numpy.empty(len(order), dtype=numpy.int64)
+		self.ranks[order] = numpy.arange(len(order))
+		return True
+
+	def bubble_profile(self, index):
+		"""
+		Sets each setting of one profile to the most common value among the
+		profiles below it.
+		:param index: The index of the profile to bubble.
+		"""
+		if not self.update_ranks(): #Can't break ties in batches, so do it one by one.
+			super().bubble_profile(index)
+			return
+		material_voters, nonmaterial_voters = self.voters(index)
+		row = numpy.frombuffer(self.rows[index], dtype=numpy.int32) #Writes go straight to the row.
+		columns = numpy.flatnonzero(row != -1)
+		material_columns = self.material_column_mask[columns]
+		groups = [(columns[material_columns], material_voters)]
+		if not self.materials[index]: #Material profiles can't store other settings.
+			groups.append((columns[~material_columns], nonmaterial_voters))
+
+		for group_columns, voters in groups:
+			if len(group_columns) == 0:
+				continue
+			if not voters: #No votes at all.
+				row[group_columns] = self.value_id(None)
+				continue
+			matrix = numpy.stack([numpy.frombuffer(self.rows[voter], dtype=numpy.int32) for voter in voters])[:, group_columns]
+			weights = numpy.array([self.weights[voter] for voter in voters], dtype=numpy.int64)
+			row[group_columns] = self.weighted_modes(matrix, weights)
+
+	def weighted_modes(self, matrix, weights):
+		"""
+		Finds the weighted most common value in each column of a matrix of value
+		IDs.
+
+		Ties are broken in favour of the value that sorts first, just like in
+		``bubble_common_values``.
+		:param matrix: A matrix of value IDs, with one row per voter.
+		:param weights: The weight of each voter.
+		:return: For each column, the most common value ID.
+		"""
+		num_values = len(self.values)
+		column_ids = numpy.broadcast_to(numpy.arange(matrix.shape[1], dtype=numpy.int64), matrix.shape).ravel()
+		pairs = column_ids * num_values + matrix.ravel() #Unique number for each combination of column and value.
+		unique_pairs, inverse = numpy.unique(pairs, return_inverse=True)
+		counts = numpy.zeros(len(unique_pairs), dtype=numpy.int64)
+		numpy.add.at(counts, inverse.ravel(), numpy.broadcast_to(weights[:, numpy.newaxis], matrix.shape).ravel())
 
-	if not os.path.exists(os.path.dirname(os.path.join(output_dir, profile.filepath))):
-		os.makedirs(os.path.dirname(os.path.join(output_dir, profile.filepath)))
-	with open(os.path.join(output_dir, profile.filepath), "w") as config_file: #Write the config file itself.
-		config.write(config_file)
+		pair_columns = unique_pairs // num_values
+		pair_values = unique_pairs % num_values
+		order = numpy.lexsort((self.ranks[pair_values], -counts, pair_columns)) #Per column, the highest count first and then the value that sorts first.
+		sorted_columns = pair_columns[order]
+		first = numpy.ones(len(order), dtype=bool)
+		first[1:] = sorted_columns[1:] != sorted_columns[:-1]
+		modes = numpy.empty(matrix.shape[1], dtype=numpy.int32)
+		modes[sorted_columns[first]] = pair_values[order[first]]
+		return modes
 
 if __name__ == "__main__":
 	argument_parser = argparse.ArgumentParser(description="Optimise a set of profiles for Cura.")
-	argument_parser.add_argument("-i", dest="input_dir", help="Root directory of input profile structure.", default=os.getcwd())
-	argument_parser.add_argument("-o", dest="output_dir", help="Root directory of output profile structure.", default=os.getcwd())
+	argument_parser.add_argument("-i", dest="input_dir", help="Root directory of input profile structure, or a zip or tar archive containing it.", default=os.getcwd())
+	argument_parser.add_argument("-o", dest="output_dir", help="Root directory of output profile structure, or a zip or tar archive to write it to (.zip, .tar, .tar.gz, .tar.bz2 or .tar.xz).", default=os.getcwd())
 	argument_parser.add_argument("-b", dest="bubble_from_depth", help="How many levels of profiles to retain. These levels will remain unmodified by bubbling. Set to 0 to bubble settings all the way up to fdmprinter, or 1 to exclude just fdmprinter. Set it very high to prevent bubbling at all.", default="1")
-	argument_parser.add_argument("--track", dest="track_setting", help="To debug. Logs messages whenever the specified setting key is touched.", default="")
+	argument_parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="How many processes to parse the input files with.", default=1)
+	argument_parser.add_argument("--engine", dest="engine", choices=["dict", "lazy", "fused", "streaming", "compact", "numpy"], help="How to store settings while optimising. The lazy engine doesn't copy inherited settings to every profile. The fused engine bubbles and removes redundancies in a single pass. The streaming engine does that while reading and writing, keeping only a few directories in memory, but it can't be combined with --cache, --jobs or --write-jobs. The compact engine uses less memory on large profile structures. The numpy engine is like the compact engine, but bubbles with NumPy.", default="dict")
+	argument_parser.add_argument("--solver", dest="solver", choices=["greedy", "exact"], help="How to choose the values to bubble up. The greedy solver takes the most common value of the subprofiles. The exact solver finds the values with which the fewest settings remain, but is slower and only works with the dict, lazy and fused engines, without --optimise-jobs.", default="greedy")
+	argument_parser.add_argument("--cache", dest="cache_file", help="File to cache parsed profiles and results in between runs. Only files that changed are parsed again, and only outputs that changed are written again.", default=None)
+	argument_parser.add_argument("--skip-unchanged", dest="skip_unchanged", action="store_true", help="Don't rewrite output files that already have the right contents. Other output files are replaced atomically.")
+	argument_parser.add_argument("--optimise-jobs", dest="optimise_jobs", type=int, help="How many processes to bubble common values and remove redundancies with. Each subtree below the root is optimised in one process.", default=1)
+	argument_parser.add_argument("--write-jobs", dest="write_jobs", type=int, help="How many threads to write the output files with.", default=1)
+	argument_parser.add_argument("--watch", dest="watch", action="store_true", help="Keep running, and optimise the profiles again whenever a file in the input directory changes. The optimised profiles stay in memory, so when only leaf profiles change, only the profiles above them are optimised again and only changed outputs are written. Other changes optimise everything again, but only parse the changed files. The engine and --optimise-jobs are not used in watch mode. With --solver exact, --report or --profile-stages, everything is optimised again after every change.")
+	argument_parser.add_argument("--watch-interval", dest="watch_interval", type=float, help="How many seconds to wait between checking the input directory for changes in watch mode.", default=1)
+	argument_parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="Optimise the profiles without writing them.")
+	argument_parser.add_argument("--report", dest="report_file", help="File to write a report to with the number of settings and the estimated size of each profile before and after the optimisation. Written as CSV if the file name ends in .csv, or as JSON otherwise.", default=None)
+	argument_parser.add_argument("--profile-stages", dest="stages_file", help="File to write a JSON report to with the time and memory that each stage of the optimisation took. Measuring memory slows down the optimisation.", default=None)
+	argument_parser.add_argument("--track", dest="track_setting", help="To debug. Logs messages whenever the specified setting key is touched. Implies --log-level DEBUG unless another level is given.", default="")
+	argument_parser.add_argument("--log-level", dest="log_level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Which messages to log. INFO only logs a summary of each stage, DEBUG logs every directory and tracked setting.", default=None)
+	argument_parser.add_argument("-q", "--quiet", dest="log_level", action="store_const", const="WARNING", help="Only log warnings and errors. Same as --log-level WARNING.")
 	arguments = argument_parser.parse_args()
+	logging.basicConfig(level=arguments.log_level or ("DEBUG" if arguments.track_setting else "INFO"))
 	if arguments.input_dir == arguments.output_dir:
 		raise Exception("Input and output directories may not be the same (both were \"{dir}\").".format(dir=arguments.input_dir))
-	bubble_from_depth = int(arguments.bubble_from_depth)
-	track_setting = arguments.track_setting
-	optimise(arguments.input_dir, arguments.output_dir)
\ No newline at end of file
+	options = Options(
+		bubble_from_depth=int(arguments.bubble_from_depth),
+		track_setting=arguments.track_setting,
+		jobs=arguments.jobs,
+		engine=arguments.engine,
+		cache_file=arguments.cache_file,
+		skip_unchanged=arguments.skip_unchanged,
+		write_jobs=arguments.write_jobs,
+		stages_file=arguments.stages_file,
+		optimise_jobs=arguments.optimise_jobs,
+		dry_run=arguments.dry_run,
+		report_file=arguments.report_file,
+		solver=arguments.solver
+	)
+	if arguments.watch:
+		if os.path.isfile(arguments.input_dir):
+			raise Exception("Only input directories can be watched, not archives (got \"{input}\").".format(input=arguments.input_dir))
+		try:
+			watch(arguments.input_dir, arguments.output_dir, options, arguments.watch_interval)
+		except KeyboardInterrupt: #The way to stop watching.
+			pass
+	else:
+		optimise(arguments.input_dir, arguments.output_dir, options)
\ No newline at end of file
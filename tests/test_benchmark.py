@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+#This software is distributed under the Creative Commons license (CC0) version 1.0. A copy of this license should have been distributed with this software.
+#The license can also be read online: <https://creativecommons.org/publicdomain/zero/1.0/>. If this online license differs from the license provided with this software, the license provided with this software should be applied.
+
+import os.path #To find the generated profiles.
+import tempfile #To generate profile structures in a temporary directory.
+import unittest #The testing suite.
+
+import benchmark #The module we're testing.
+import optimise #To load the generated profile structures.
+
+class TestBenchmark(unittest.TestCase):
+	"""
+	Tests the components of the benchmark script.
+	"""
+
+	def test_benchmark_reports(self):
+		"""
+		Tests whether the benchmark reports on each stage for each engine.
+		"""
+		reports = benchmark.benchmark(["dict", "compact"], depth=1, fan_out=2, num_settings=10)
+		self.assertEqual(list(reports), ["dict", "compact"], "There must be a report for each engine.")
+		for report in reports.values():
+			self.assertEqual(len(report["stages"]), 5, "There are five stages in the optimisation.")
+
+	def test_benchmark_memory_shares_strings(self):
+		"""
+		Tests whether the memory benchmark finds that equal strings and base
+		configs are shared between profiles.
+		"""
+		report = benchmark.benchmark_memory(depth=1, fan_out=2, num_settings=10, cardinality=2)
+		self.assertEqual(report["profiles"], 7, "The root, two directories and two leaves in each of them.")
+		self.assertLess(report["distinct_objects"], report["objects"], "The keys and values are repeated in many profiles, but must be stored once.")
+		self.assertLess(report["distinct_bytes"], report["bytes"])
+
+	def test_benchmark_parsers_reports(self):
+		"""
+		Tests whether the parser benchmark reports on both parsers.
+		"""
+		report = benchmark.benchmark_parsers(depth=1, fan_out=2, num_settings=10)
+		self.assertEqual(report["files"], 7, "The root, two directories and two leaves in each of them.")
+		self.assertGreater(report["optimise"], 0)
+		self.assertGreater(report["configparser"], 0)
+
+	def test_generate_tree_materials(self):
+		"""
+		Tests whether the generated profile structure has material profiles
+		above the leaf profiles.
+		"""
+		temporary_directory = tempfile.TemporaryDirectory()
+		self.addCleanup(temporary_directory.cleanup)
+		root = benchmark.generate_tree(temporary_directory.name, depth=2, fan_out=4, material_share=0.5)
+		profile = optimise.get_profiles(root)
+		for child in profile.subprofiles:
+			materials = [grandchild for grandchild in child.subprofiles if optimise.is_material(grandchild)]
+			self.assertEqual(len(materials), 2, "Half of the directories above the leaves must be materials.")
+
+	def test_generate_tree_shape(self):
+		"""
+		Tests whether the generated profile structure has the requested size.
+		"""
+		temporary_directory = tempfile.TemporaryDirectory()
+		self.addCleanup(temporary_directory.cleanup)
+		root = benchmark.generate_tree(temporary_directory.name, depth=2, fan_out=3, num_settings=20)
+		profile = optimise.get_profiles(root)
+		self.assertEqual(profile.filepath, os.path.join(root, "fdmprinter.inst.cfg"), "The root profile is like fdmprinter.")
+		self.assertEqual(profile.weight, 27, "Three levels of three-fold fan-out give 27 leaf profiles.")
+		self.assertEqual(len(profile.settings), 20, "The root profile must have a value for every setting.")
@@ -4,9 +4,19 @@
 #This software is distributed under the Creative Commons license (CC0) version 1.0. A copy of this license should have been distributed with this software.
 #The license can also be read online: <https://creativecommons.org/publicdomain/zero/1.0/>. If this online license differs from the license provided with this software, the license provided with this software should be applied.
 
+import concurrent.futures #To write files from multiple threads.
+import configparser #To compare the parser with.
+import csv #To read reports.
+import io #To render CFG files with ConfigParser for comparison.
+import json #To read reports.
 import os.path #To get a directory with test files.
+import shutil #To copy test files to a temporary directory where they can be modified.
+import tarfile #To test reading and writing tar archives.
 import tempfile #To create a temporary empty directory. You can't have empty directory in Git.
+import threading #To let threads write files at the same time.
 import unittest #The testing suite.
+import unittest.mock #To check which files get parsed.
+import zipfile #To test reading and writing zip archives.
 
 import optimise #The module we're testing.
 import tests.tests #To allow parametrised tests.
@@ -21,6 +31,117 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 	A data directory to load test files from.
 	"""
 
+	def assertProfilesEqual(self, actual_root, expected_root):
+		"""
+		Asserts that two profile structures have the same structure and
+		settings.
+		:param actual_root: The root of the profile structure to check.
+		:param expected_root: The root of the profile structure that it should
+		be equal to.
+		"""
+		actual_profiles = [actual_root]
+		expected_profiles = [expected_root]
+		while expected_profiles:
+			actual = actual_profiles.pop()
+			expected = expected_profiles.pop()
+			self.assertEqual(actual.filepath, expected.filepath, "The profiles must be in the same order.")
+			self.assertDictEqual(dict(actual.settings), dict(expected.settings), "The settings of {file} must be equal.".format(file=expected.filepath))
+			self.assertEqual(len(actual.subprofiles), len(expected.subprofiles), "The structure must be equal.")
+			actual_profiles.extend(actual.subprofiles)
+			expected_profiles.extend(expected.subprofiles)
+
+	def enter_temporary_directory(self, copy_simple_tree=True):
+		"""
+		Makes a temporary directory the working directory until the end of the
+		test.
+
+		Profiles are written to their file path relative to the output
+		directory, so tests that write a profile structure from disk need to
+		read it from a relative path.
+		:param copy_simple_tree: Whether to copy the simple tree from the test
+		data into the temporary directory, so that it can be modified.
+		"""
+		temporary_directory = tempfile.TemporaryDirectory()
+		self.addCleanup(temporary_directory.cleanup)
+		self.addCleanup(os.chdir, os.getcwd()) #Cleaned up first, since the directory can't be removed while it's the working directory on some platforms.
+		os.chdir(temporary_directory.name)
+		if copy_simple_tree:
+			shutil.copytree(os.path.join(self.data_directory, "simple_tree"), "simple_tree")
+
+	def material_tree(self):
+		"""
+		Creates a small profile structure with a material profile in it, to
+		compare different ways of optimising it.
+		:return: The root of the profile structure.
+		"""
+		quality1 = optimise.Profile(filepath="quality1.inst.cfg", settings={"material_bed_temperature": "70", "layer_height": "0.1", "pears": "9"})
+		quality2 = optimise.Profile(filepath="quality2.inst.cfg", settings={"layer_height": "0.2"})
+		material = optimise.Profile(filepath="PLA.inst.cfg", settings={"material_bed_temperature": "60", "layer_height": "0.3"}, subprofiles=[quality1, quality2], weight=2)
+		quality3 = optimise.Profile(filepath="quality3.inst.cfg", settings={"layer_height": "0.2", "apples": "4", "pears": "9"})
+		quality4 = optimise.Profile(filepath="quality4.inst.cfg", settings={"apples": "5", "pears": "9"})
+		other = optimise.Profile(filepath="other.inst.cfg", subprofiles=[quality3, quality4], weight=2)
+		variant = optimise.Profile(filepath="variant.inst.cfg", settings={"material_bed_temperature": "50", "layer_height": "0.15", "apples": "3"}, subprofiles=[material, other], weight=4)
+		return optimise.Profile(filepath="root.inst.cfg", settings={"material_bed_temperature": "40", "layer_height": "0.15", "apples": "3", "pears": "2"}, subprofiles=[variant], weight=4)
+
+	def test_bubble_and_remove_redundancies(self):
+		"""
+		Tests whether bubbling and removing redundancies in one pass gives the
+		same result as doing them one after another.
+		"""
+		for bubble_from_depth in range(3):
+			expected_root = self.material_tree()
+			optimise.flatten_profiles(expected_root)
+			optimise.bubble_common_values(expected_root, bubble_from_depth)
+			optimise.remove_redundancies(expected_root)
+			actual_root = self.material_tree()
+			optimise.flatten_profiles(actual_root)
+			optimise.bubble_and_remove_redundancies(actual_root, bubble_from_depth)
+			self.assertProfilesEqual(actual_root, expected_root)
+
+	def test_bubble_and_remove_redundancies_nested_materials(self):
+		"""
+		Tests bubbling and removing redundancies in one pass with a material
+		profile in a material profile.
+		"""
+		def nested_tree():
+			tree = self.material_tree()
+			quality5 = optimise.Profile(filepath="quality5.inst.cfg", settings={"layer_height": "0.4"})
+			tree.subprofiles[0].subprofiles[0].subprofiles.append(optimise.Profile(filepath="ABS.inst.cfg", settings={"material_bed_temperature": "80", "apples": "6"}, subprofiles=[quality5])) #A material in the material.
+			for profile in [tree.subprofiles[0].subprofiles[0], tree.subprofiles[0], tree]:
+				profile.weight += 1
+			return tree
+		expected_root = nested_tree()
+		optimise.flatten_profiles(expected_root)
+		optimise.bubble_common_values(expected_root, 0)
+		optimise.remove_redundancies(expected_root)
+		actual_root = nested_tree()
+		optimise.flatten_profiles(actual_root)
+		optimise.bubble_and_remove_redundancies(actual_root, 0)
+		self.assertProfilesEqual(actual_root, expected_root)
+
+	def test_bubble_and_remove_redundancies_parallel(self):
+		"""
+		Tests whether optimising the subtrees below the root in parallel gives
+		the same result as bubbling and removing redundancies in this process.
+		"""
+		def two_subtrees():
+			tree = self.material_tree()
+			other_tree = self.material_tree()
+			other_tree.subprofiles[0].subprofiles[1].settings["apples"] = "8"
+			tree.subprofiles.append(other_tree.subprofiles[0])
+			tree.weight += other_tree.weight
+			return tree
+		for bubble_from_depth in range(3):
+			expected_root = two_subtrees()
+			optimise.flatten_profiles(expected_root)
+			optimise.bubble_common_values(expected_root, bubble_from_depth)
+			optimise.remove_redundancies(expected_root)
+			actual_root = two_subtrees()
+			keys_below = optimise.find_keys_below(actual_root)
+			optimise.flatten_profiles(actual_root)
+			optimise.bubble_and_remove_redundancies_parallel(actual_root, bubble_from_depth, 2, keys_below=keys_below)
+			self.assertProfilesEqual(actual_root, expected_root)
+
 	def test_bubble_common_values_1v1(self):
 		"""
 		Tests bubbling with two children, each saying something different.
@@ -96,6 +217,17 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		self.assertDictEqual(parent.settings, {"apples": 1}, "The profile at level 0 should not be bubbled to.")
 		self.assertDictEqual(child.settings, {"apples": 3}, "The profile at level 1 should be bubbled to.")
 
+	def test_bubble_common_values_sparse(self):
+		"""
+		Tests whether bubbling only looks at the settings that are specified
+		below each profile, if it's told which those are.
+		"""
+		child1 = optimise.Profile(settings={"apples": 3, "pears": 5})
+		child2 = optimise.Profile(settings={"apples": 3, "pears": 5})
+		parent = optimise.Profile(settings={"apples": 2, "pears": 4}, subprofiles=[child1, child2], weight=2)
+		optimise.bubble_common_values(parent, 0, keys_below={parent: {"apples"}})
+		self.assertDictEqual(parent.settings, {"apples": 3, "pears": 4}, "Pears isn't specified below the parent, so it isn't bubbled.")
+
 	def test_bubble_common_values_weighted(self):
 		"""
 		Tests whether bubbling properly takes weights of profiles into account.
@@ -107,6 +239,220 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		optimise.bubble_common_values(parent, 0)
 		self.assertDictEqual(parent.settings, {"apples": 4}, "The profile that says that apples=4 weighs more than the other child profiles together.")
 
+	def test_bubble_histograms(self):
+		"""
+		Tests whether changing a profile in a bubbled profile structure gives
+		the same result as bubbling it again, and finds exactly the profiles
+		whose settings after removing redundancies change.
+		"""
+		expected_root = self.material_tree()
+		optimise.flatten_profiles(expected_root)
+		optimise.bubble_common_values(expected_root, 0)
+		actual_root = self.material_tree()
+		optimise.flatten_profiles(actual_root)
+		histograms = optimise.BubbleHistograms(actual_root, 0)
+		self.assertProfilesEqual(actual_root, expected_root)
+
+		variant = actual_root.subprofiles[0]
+		material = variant.subprofiles[0]
+		other = variant.subprofiles[1]
+		quality3, quality4 = other.subprofiles
+		changed = histograms.update(quality4, {"apples": "4", "material_bed_temperature": "80"})
+		self.assertEqual(changed, [quality4], "The bed temperature loses the tie in the other profile, so only this profile changes.")
+		self.assertDictEqual(histograms.written_settings(quality4), {"material_bed_temperature": "80"}, "The apples are now the same as in the other profile.")
+
+		changed = histograms.update(quality3, {"material_bed_temperature": "80"})
+		self.assertEqual(changed, [actual_root, material, other, quality4], "The bed temperature bubbles up to the other profile and changes the tie in the variant profile, which changes the root.")
+		expected_root = self.material_tree()
+		optimise.flatten_profiles(expected_root)
+		expected_root.subprofiles[0].subprofiles[1].subprofiles[0].settings.update({"material_bed_temperature": "80"})
+		expected_root.subprofiles[0].subprofiles[1].subprofiles[1].settings.update({"apples": "4", "material_bed_temperature": "80"})
+		optimise.bubble_common_values(expected_root, 0)
+		self.assertProfilesEqual(actual_root, expected_root)
+		optimise.remove_redundancies(expected_root)
+		for actual, expected in zip(optimise.ProfileTraversal(actual_root).profiles, optimise.ProfileTraversal(expected_root).profiles):
+			self.assertDictEqual(histograms.written_settings(actual), expected.settings, "{file} must have the same settings as after removing redundancies.".format(file=expected.filepath))
+
+	def test_bubble_optimal_values(self):
+		"""
+		Tests choosing the values to bubble such that the fewest settings
+		remain, where the most common value of each profile is not the best
+		choice.
+
+		Taking the most common value would break the tie in the first middle
+		profile with apples=3, while apples=4 lets that profile inherit the
+		value of the top profile.
+		"""
+		def tied_tree():
+			middles = [optimise.Profile(filepath="middle{index}.inst.cfg".format(index=index), settings={"apples": "1"}, subprofiles=[optimise.Profile(filepath="leaf{index}.inst.cfg".format(index=index * 2 + offset), settings={"apples": value}) for offset, value in enumerate(values)], weight=2) for index, values in enumerate([("3", "4"), ("4", "5"), ("4", "6")])]
+			top = optimise.Profile(filepath="top.inst.cfg", settings={"apples": "1"}, subprofiles=middles, weight=6)
+			return optimise.Profile(filepath="root.inst.cfg", settings={"apples": "1"}, subprofiles=[top], weight=6)
+		greedy_root = tied_tree()
+		optimise.flatten_profiles(greedy_root)
+		optimise.bubble_common_values(greedy_root, 1)
+		optimise.remove_redundancies(greedy_root)
+		exact_root = tied_tree()
+		optimise.flatten_profiles(exact_root)
+		optimise.bubble_optimal_values(exact_root, 1)
+		optimise.remove_redundancies(exact_root)
+		self.assertEqual(optimise.count_settings(greedy_root), (11, 6))
+		self.assertEqual(optimise.count_settings(exact_root), (11, 5), "Only the top profile and one leaf below each middle profile need to specify apples.")
+		self.assertDictEqual(exact_root.subprofiles[0].settings, {"apples": "4"})
+		self.assertDictEqual(exact_root.subprofiles[0].subprofiles[0].settings, {}, "The first middle profile inherits apples=4 from the top profile.")
+		self.assertDictEqual(exact_root.subprofiles[0].subprofiles[0].subprofiles[0].settings, {"apples": "3"})
+
+	def test_bubble_optimal_values_materials(self):
+		"""
+		Tests that choosing the values to bubble such that the fewest settings
+		remain never leaves more settings than taking the most common values, in
+		a profile structure with materials, and that every profile keeps its
+		settings.
+		"""
+		for bubble_from_depth in range(3):
+			expected_root = self.material_tree()
+			optimise.flatten_profiles(expected_root)
+			greedy_root = self.material_tree()
+			optimise.flatten_profiles(greedy_root)
+			optimise.bubble_common_values(greedy_root, bubble_from_depth)
+			optimise.remove_redundancies(greedy_root)
+			exact_root = self.material_tree()
+			optimise.flatten_profiles(exact_root)
+			optimise.bubble_optimal_values(exact_root, bubble_from_depth)
+			optimise.remove_redundancies(exact_root)
+			self.assertLessEqual(optimise.count_settings(exact_root)[1], optimise.count_settings(greedy_root)[1])
+			optimise.flatten_profiles(exact_root)
+			for expected, actual in zip(optimise.ProfileTraversal(expected_root).profiles, optimise.ProfileTraversal(exact_root).profiles):
+				if not actual.subprofiles: #The leaves are what Cura uses.
+					self.assertDictEqual(dict(actual.settings), dict(expected.settings), "{file} must keep its settings.".format(file=expected.filepath))
+
+	def test_cache_only_parses_changed_files(self):
+		"""
+		Tests whether optimising with a cache only parses the files that changed
+		since the previous run, and gives the same result as without the cache.
+		"""
+		self.enter_temporary_directory()
+		optimise.optimise("simple_tree", "output", cache_file="cache")
+
+		with unittest.mock.patch("optimise.parse", wraps=optimise.parse) as parse:
+			optimise.optimise("simple_tree", "output", cache_file="cache")
+			self.assertEqual(parse.call_count, 0, "Nothing changed, so nothing needs to be parsed.")
+
+			leaf_file = os.path.join("simple_tree", "subdirectory", "leaf1.inst.cfg")
+			with open(leaf_file, "w") as leaf:
+				leaf.write("[values]\napples = 7\n")
+			optimise.optimise("simple_tree", "output", cache_file="cache")
+			parse.assert_called_once_with(leaf_file)
+
+		optimise.optimise("simple_tree", "uncached")
+		for directory, _, files in os.walk("uncached"):
+			for file in files:
+				with open(os.path.join(directory, file)) as uncached_file, open(os.path.join("output", os.path.relpath(directory, "uncached"), file)) as cached_file:
+					self.assertEqual(cached_file.read(), uncached_file.read(), "Caching must not change the result.")
+
+	@tests.tests.parametrise({
+		"leaf": {
+			"filepath": os.path.join("printer", "normal.inst.cfg"),
+			"baseconfig": (("metadata", (("type", "quality"),)),),
+			"kind": "leaf"
+		},
+		"material_name": {
+			"filepath": os.path.join("printer", "PLA", "PLA.inst.cfg"),
+			"baseconfig": (),
+			"kind": "material"
+		},
+		"material_metadata": {
+			"filepath": os.path.join("printer", "generic_wood.inst.cfg"),
+			"baseconfig": (("general", (("name", "Wood"),)), ("metadata", (("type", "material"),))),
+			"kind": "material"
+		},
+		"material_extension": {
+			"filepath": os.path.join("materials", "generic_wood.fdm_material"),
+			"baseconfig": (),
+			"kind": "material"
+		}
+	})
+	def test_classify_profile(self, filepath, baseconfig, kind):
+		"""
+		Tests whether material profiles are recognised.
+		:param filepath: The file path of the profile.
+		:param baseconfig: The sections of the profile without the settings.
+		:param kind: The kind of profile that it should be classified as.
+		"""
+		self.assertEqual(optimise.classify_profile(filepath, baseconfig), kind)
+		self.assertEqual(optimise.Profile(filepath=filepath, baseconfig=baseconfig).kind, kind, "The profile must be classified when it is created.")
+
+	def test_compact_profiles_interned(self):
+		"""
+		Tests whether the compact engine stores each distinct value only once.
+		"""
+		child1 = optimise.Profile(settings={"apples": "3", "pears": "3"})
+		child2 = optimise.Profile(settings={"apples": "3", "pears": "4"})
+		parent = optimise.Profile(settings={"apples": "3"}, subprofiles=[child1, child2], weight=2)
+		compact = optimise.CompactProfiles(parent)
+		self.assertEqual(compact.keys, ["apples", "pears"], "Every key gets one column.")
+		self.assertEqual(len(compact.values), 2, "There are only two distinct values, 3 and 4.")
+		compact.store()
+		self.assertDictEqual(child2.settings, {"apples": "3", "pears": "4"}, "Storing the encoded settings must give the original settings back.")
+
+	def test_compact_profiles_same_as_dict(self):
+		"""
+		Tests whether the compact engine gives the same result as optimising
+		with dictionaries of settings.
+		"""
+		for bubble_from_depth in range(3):
+			expected_root = self.material_tree()
+			optimise.flatten_profiles(expected_root)
+			optimise.bubble_common_values(expected_root, bubble_from_depth)
+			optimise.remove_redundancies(expected_root)
+
+			actual_root = self.material_tree()
+			compact = optimise.CompactProfiles(actual_root)
+			compact.flatten_profiles()
+			compact.bubble_common_values(bubble_from_depth)
+			compact.remove_redundancies()
+			compact.store()
+
+			self.assertProfilesEqual(actual_root, expected_root)
+
+	def test_estimate_cfg_size(self):
+		"""
+		Tests whether the estimated size of a profile is the size of its
+		rendered CFG file.
+		"""
+		material = optimise.Profile(filepath=os.path.join("printer", "PLA", "PLA.inst.cfg"), settings={"material_flow": "100", "Bar": "first\nsecond", "default_material_print_temperature": "210"}, baseconfig=(("general", (("name", "PLA"),)), ("metadata", (("type", "material"),))))
+		empty = optimise.Profile()
+		for profile in (material, empty):
+			self.assertEqual(optimise.estimate_cfg_size(profile), len(optimise.render_cfg(profile)))
+
+	def test_find_keys_below(self):
+		"""
+		Tests finding which settings are specified below each profile.
+		"""
+		root = self.material_tree()
+		variant = root.subprofiles[0]
+		material, other = variant.subprofiles
+		keys_below = optimise.find_keys_below(root)
+		self.assertEqual(keys_below[material], {"material_bed_temperature", "layer_height", "pears"})
+		self.assertEqual(keys_below[other], {"layer_height", "apples", "pears"})
+		self.assertEqual(keys_below[variant], {"material_bed_temperature", "layer_height", "apples", "pears"}, "Includes the settings of the material profile itself.")
+		self.assertEqual(keys_below[root], {"material_bed_temperature", "layer_height", "apples", "pears"})
+		self.assertNotIn(other.subprofiles[0], keys_below, "Leaves have nothing below them.")
+
+	def test_find_keys_below_only_materials(self):
+		"""
+		Tests finding the settings below a profile with only material profiles
+		without subprofiles below it.
+
+		Nothing votes on the non-material settings of that profile, so all of
+		its settings can change.
+		"""
+		material = optimise.Profile(filepath="PLA.inst.cfg", settings={"material_bed_temperature": "60"})
+		variant = optimise.Profile(filepath="variant.inst.cfg", subprofiles=[material])
+		root = optimise.Profile(filepath="root.inst.cfg", settings={"material_bed_temperature": "40", "layer_height": "0.1"}, subprofiles=[variant])
+		keys_below = optimise.find_keys_below(root)
+		self.assertIsNone(keys_below[variant])
+		self.assertIsNone(keys_below[root], "All settings can change in the variant, so also in its parent.")
+
 	def test_flatten_profiles_empty(self):
 		"""
 		Tests flattening an empty profile.
@@ -126,6 +472,39 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		optimise.flatten_profiles(parent)
 		self.assertDictEqual(grandchild.settings, {"foo": "bar"}, "The foo setting must've been inherited via the child to the grandchild.")
 
+	def test_flatten_profiles_lazy(self):
+		"""
+		Tests whether lazily flattening profiles looks up the settings in the
+		parents without copying them.
+		"""
+		grandchild = optimise.Profile(settings={"apples": 4})
+		child = optimise.Profile(subprofiles=[grandchild])
+		parent = optimise.Profile(settings={"apples": 3, "pears": 8}, subprofiles=[child])
+		optimise.flatten_profiles(parent, lazy=True)
+		self.assertDictEqual(dict(grandchild.settings), {"apples": 4, "pears": 8}, "The pears are inherited via the child, but the apples are overwritten.")
+		self.assertDictEqual(child.settings.maps[0], {}, "The child itself must not have gotten a copy of the settings of the parent.")
+
+	def test_flatten_profiles_lazy_same_as_eager(self):
+		"""
+		Tests whether optimising lazily flattened profiles gives the same result
+		as optimising profiles that were flattened by copying.
+
+		When bubbling changes a setting of a profile, its subprofiles must keep
+		the value they inherited before.
+		"""
+		for bubble_from_depth in range(3):
+			expected_root = self.material_tree()
+			optimise.flatten_profiles(expected_root)
+			optimise.bubble_common_values(expected_root, bubble_from_depth)
+			optimise.remove_redundancies(expected_root)
+
+			actual_root = self.material_tree()
+			optimise.flatten_profiles(actual_root, lazy=True)
+			optimise.bubble_common_values(actual_root, bubble_from_depth)
+			optimise.remove_redundancies(actual_root)
+
+			self.assertProfilesEqual(actual_root, expected_root)
+
 	def test_flatten_profiles_merge(self):
 		"""
 		Tests flattening a profile that inherits one setting from a parent but
@@ -184,6 +563,7 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		Tests getting profiles from a directory that is empty.
 		"""
 		temporary_directory = tempfile.TemporaryDirectory()
+		self.addCleanup(temporary_directory.cleanup)
 		with self.assertRaises(FileNotFoundError):
 			optimise.get_profiles(temporary_directory.name) #Because it's an empty directory.
 
@@ -206,6 +586,51 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		self.assertEqual(profile.subprofiles[0].subprofiles[0].filepath, os.path.join(input_directory, "subdirectory", "leaf1.inst.cfg"), "The first grandchild is leaf1. It must be sorted.")
 		self.assertEqual(profile.subprofiles[0].subprofiles[1].filepath, os.path.join(input_directory, "subdirectory", "leaf2.inst.cfg"), "The second grandchild is leaf2. It must be sorted.")
 
+	def test_get_profiles_interned(self):
+		"""
+		Tests whether equal setting keys and values of different profiles share
+		the same string, but only within one profile structure.
+		"""
+		input_directory = os.path.join(self.data_directory, "simple_tree")
+		profile = optimise.get_profiles(input_directory)
+		leaf1, leaf2 = profile.subprofiles[0].subprofiles
+		apples1 = next(key for key in leaf1.settings if key == "apples")
+		apples2 = next(key for key in leaf2.settings if key == "apples")
+		self.assertIs(apples1, apples2, "Both leaves have apples, which must be stored once.")
+
+		other_profile = optimise.get_profiles(input_directory)
+		other_apples = next(key for key in other_profile.subprofiles[0].subprofiles[0].settings if key == "apples")
+		self.assertIsNot(other_apples, apples1, "Nothing may be kept between runs.")
+
+	def test_get_profiles_kind(self):
+		"""
+		Tests whether the main profiles of directories are recognised when
+		loading profiles.
+		"""
+		input_directory = os.path.join(self.data_directory, "simple_tree")
+		profile = optimise.get_profiles(input_directory)
+		self.assertEqual(profile.kind, "main")
+		self.assertEqual(profile.subprofiles[0].kind, "main")
+		self.assertEqual([leaf.kind for leaf in profile.subprofiles[0].subprofiles], ["leaf", "leaf"])
+
+	def test_get_profiles_parallel(self):
+		"""
+		Tests whether loading profiles in parallel gives the same profile
+		structure as loading them serially.
+		"""
+		input_directory = os.path.join(self.data_directory, "simple_tree")
+		serial = optimise.get_profiles(input_directory)
+		parallel = optimise.get_profiles(input_directory, jobs=2)
+		self.assertProfilesEqual(parallel, serial)
+		self.assertEqual(parallel.weight, serial.weight, "The weights must be the same.")
+
+		files = {}
+		for directory, _, directory_files in os.walk(input_directory):
+			for file in directory_files:
+				with open(os.path.join(directory, file)) as input_file:
+					files[os.path.join(directory, file)] = input_file.read()
+		self.assertProfilesEqual(optimise.get_profiles(optimise.MemorySource(files), jobs=2), serial)
+
 	def test_get_profiles_settings(self):
 		"""
 		Tests whether loaded profiles have the correct settings.
@@ -233,6 +658,279 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		self.assertEqual(profile.subprofiles[0].subprofiles[0].weight, 1, "Just leaf1.")
 		self.assertEqual(profile.subprofiles[0].subprofiles[1].weight, 1, "Just leaf2.")
 
+	@tests.tests.parametrise({
+		"same": {"file_name": "printer", "directory_name": "printer", "result": True},
+		"extension": {"file_name": "printer.inst.cfg", "directory_name": "printer", "result": True},
+		"period_in_name": {"file_name": "ultimaker2.1.inst.cfg", "directory_name": "ultimaker2.1", "result": True},
+		"longer_name": {"file_name": "printer_extended.inst.cfg", "directory_name": "printer", "result": False},
+		"partial_component": {"file_name": "ultimaker2.12.inst.cfg", "directory_name": "ultimaker2.1", "result": False}
+	})
+	def test_is_main_file(self, file_name, directory_name, result):
+		"""
+		Tests whether the main file of a directory is recognised.
+		:param file_name: The name of the file.
+		:param directory_name: The name of the directory that the file is in.
+		:param result: Whether the file is the main file of the directory.
+		"""
+		self.assertEqual(optimise.is_main_file(file_name, directory_name), result)
+
+	def test_memory_source(self):
+		"""
+		Tests whether a source in memory finds the same structure as the
+		directory with the same files.
+		"""
+		input_directory = os.path.join(self.data_directory, "simple_tree")
+		files = {}
+		for directory, _, directory_files in os.walk(input_directory):
+			for file in directory_files:
+				with open(os.path.join(directory, file)) as profile_file:
+					files[os.path.join(directory, file)] = profile_file.read()
+		source = optimise.MemorySource(files)
+		self.assertEqual(source.root, input_directory, "The root is the directory that contains all files.")
+		self.assertEqual(optimise.find_profiles(source), optimise.find_profiles(optimise.DirectorySource(input_directory)))
+		self.assertEqual(source.digest(os.path.join(input_directory, "simple_tree.inst.cfg")), optimise.DirectorySource(input_directory).digest(os.path.join(input_directory, "simple_tree.inst.cfg")), "The digest must not depend on where the file is stored.")
+
+	@unittest.skipUnless(optimise.numpy, "The numpy engine requires NumPy.")
+	def test_numpy_profiles_same_as_dict(self):
+		"""
+		Tests whether the numpy engine gives the same result as optimising with
+		dictionaries of settings.
+		"""
+		for bubble_from_depth in range(3):
+			expected_root = self.material_tree()
+			optimise.flatten_profiles(expected_root)
+			optimise.bubble_common_values(expected_root, bubble_from_depth)
+			optimise.remove_redundancies(expected_root)
+
+			actual_root = self.material_tree()
+			compact = optimise.NumpyProfiles(actual_root)
+			compact.flatten_profiles()
+			compact.bubble_common_values(bubble_from_depth)
+			compact.remove_redundancies()
+			compact.store()
+
+			self.assertProfilesEqual(actual_root, expected_root)
+
+	@unittest.skipUnless(optimise.numpy, "The numpy engine requires NumPy.")
+	def test_numpy_profiles_tie(self):
+		"""
+		Tests whether the numpy engine breaks ties in favour of the value that
+		sorts first, regardless of the order of the value IDs.
+		"""
+		child1 = optimise.Profile(settings={"apples": "3", "pears": "b"})
+		child2 = optimise.Profile(settings={"apples": "2", "pears": "a"})
+		child3 = optimise.Profile(settings={"apples": "3", "pears": "c"}, weight=0)
+		parent = optimise.Profile(settings={"apples": "1", "pears": "d"}, subprofiles=[child1, child2, child3], weight=2)
+		compact = optimise.NumpyProfiles(parent)
+		compact.bubble_common_values(0)
+		compact.store()
+		self.assertDictEqual(parent.settings, {"apples": "2", "pears": "a"}, "Ties are broken lexicographically, not by the order in which the values were found.")
+
+	@tests.tests.parametrise({
+		"zip": {"extension": ".zip"},
+		"tar": {"extension": ".tar"},
+		"tar_gz": {"extension": ".tar.gz"}
+	})
+	def test_optimise_archive(self, extension):
+		"""
+		Tests whether optimising from and to an archive gives the same files as
+		optimising from and to a directory.
+		:param extension: The file extension of the archives.
+		"""
+		self.enter_temporary_directory()
+		shutil.make_archive("input", "zip" if extension == ".zip" else "tar", ".", "simple_tree")
+		if extension == ".tar.gz": #Compress it, so that the compression is detected when reading.
+			with tarfile.open("input.tar") as plain, tarfile.open("input.tar.gz", "w:gz") as compressed:
+				for member in plain:
+					compressed.addfile(member, plain.extractfile(member) if member.isfile() else None)
+		optimise.optimise("simple_tree", "output")
+		optimise.optimise("input" + extension, "output" + extension, jobs=2)
+
+		if extension == ".zip":
+			with zipfile.ZipFile("output.zip") as archive:
+				written = {name: archive.read(name).decode("utf-8") for name in archive.namelist()}
+		else:
+			with tarfile.open("output" + extension) as archive:
+				written = {member.name: archive.extractfile(member).read().decode("utf-8") for member in archive}
+		expected = {}
+		for directory, _, files in os.walk("output"):
+			for file in files:
+				with open(os.path.join(directory, file)) as output_file:
+					expected["/".join(os.path.relpath(os.path.join(directory, file), "output").split(os.sep))] = output_file.read()
+		self.assertEqual(written, expected)
+
+	@tests.tests.parametrise({
+		"root_directory": {"member": "./simple_tree"},
+		"inside_root": {"member": "."}
+	})
+	def test_optimise_archive_dot_prefix(self, member):
+		"""
+		Tests optimising a tar archive of which the member names start with
+		``./``, like when it's made with ``tar -cf input.tar ./simple_tree`` or
+		``tar -C simple_tree -cf simple_tree.tar .``.
+		:param member: The name to add the root directory under.
+		"""
+		self.enter_temporary_directory()
+		with tarfile.open("simple_tree.tar", "w") as archive:
+			archive.add("simple_tree", arcname=member)
+		optimise.optimise("simple_tree", "output")
+		optimise.optimise("simple_tree.tar", "output.tar")
+
+		with tarfile.open("output.tar") as archive:
+			written = {member.name: archive.extractfile(member).read().decode("utf-8") for member in archive}
+		expected = {}
+		for directory, _, files in os.walk("output"):
+			for file in files:
+				with open(os.path.join(directory, file)) as output_file:
+					expected["/".join(os.path.relpath(os.path.join(directory, file), "output").split(os.sep))] = output_file.read()
+		self.assertEqual(written, expected)
+
+	@tests.tests.parametrise({
+		"dict": {"engine": "dict"},
+		"fused": {"engine": "fused"},
+		"streaming": {"engine": "streaming"},
+		"compact": {"engine": "compact"}
+	})
+	def test_optimise_dry_run(self, engine):
+		"""
+		Tests whether a dry run reports the size of each profile and the stages
+		without writing anything.
+		:param engine: The engine to optimise with.
+		"""
+		self.enter_temporary_directory()
+		optimise.optimise("simple_tree", "output", engine=engine, dry_run=True, report_file="report.json", stages_file="stages.json")
+
+		self.assertFalse(os.path.exists("output"), "Nothing may be written in a dry run.")
+		with open("stages.json") as stages_file:
+			stages = [stage["stage"] for stage in json.load(stages_file)["stages"]]
+		self.assertNotIn("write_profiles", stages, "The stages must be reported in a dry run too, without writing.")
+		with open("report.json") as report_file:
+			report = json.load(report_file)
+		self.assertEqual([row["file"] for row in report["profiles"]], sorted([
+			os.path.join("simple_tree", "simple_tree.inst.cfg"),
+			os.path.join("simple_tree", "subdirectory", "subdirectory.inst.cfg"),
+			os.path.join("simple_tree", "subdirectory", "leaf1.inst.cfg"),
+			os.path.join("simple_tree", "subdirectory", "leaf2.inst.cfg")
+		]), "Each profile must be reported.")
+		leaf1 = report["profiles"][1]
+		self.assertEqual((leaf1["settings_before"], leaf1["settings_after"]), (1, 0), "Leaf 1 has the same apples as its parent after bubbling.")
+		self.assertEqual((leaf1["bytes_before"], leaf1["bytes_after"]), (len("[values]\napples = 5\n\n"), len("[values]\n\n")))
+		self.assertEqual(report["total"], {"settings_before": 6, "settings_after": 4, "bytes_before": 109, "bytes_after": 87})
+
+	def test_optimise_memory(self):
+		"""
+		Tests optimising profiles in memory, multiple times with different
+		options.
+		"""
+		files = {
+			os.path.join("printer", "printer.inst.cfg"): "[values]\napples = 3\n",
+			os.path.join("printer", "quality", "quality.inst.cfg"): "[values]\n",
+			os.path.join("printer", "quality", "fine.inst.cfg"): "[values]\napples = 4\n",
+			os.path.join("printer", "quality", "normal.inst.cfg"): "[values]\napples = 4\n"
+		}
+		bubbled = optimise.MemorySink()
+		optimise.optimise(optimise.MemorySource(files), bubbled)
+		self.assertEqual(bubbled.files, {
+			os.path.join("printer", "printer.inst.cfg"): "[values]\napples = 4\n\n",
+			os.path.join("printer", "quality", "quality.inst.cfg"): "[values]\n\n",
+			os.path.join("printer", "quality", "fine.inst.cfg"): "[values]\n\n",
+			os.path.join("printer", "quality", "normal.inst.cfg"): "[values]\n\n"
+		}, "By default, the apples bubble up to the root.")
+
+		retained = optimise.MemorySink()
+		optimise.optimise(optimise.MemorySource(files), retained, optimise.Options(bubble_from_depth=1))
+		self.assertEqual(retained.files[os.path.join("printer", "printer.inst.cfg")], "[values]\napples = 3\n\n", "The root is retained with these options.")
+		self.assertEqual(retained.files[os.path.join("printer", "quality", "quality.inst.cfg")], "[values]\napples = 4\n\n")
+
+		again = optimise.MemorySink()
+		optimise.optimise(optimise.MemorySource(files), again)
+		self.assertEqual(again.files, bubbled.files, "The options of an earlier optimisation must not affect later ones.")
+
+		exact = optimise.MemorySink()
+		optimise.optimise(optimise.MemorySource(files), exact, solver="exact")
+		self.assertEqual(exact.files, bubbled.files, "The exact solver finds the same values here.")
+		with self.assertRaises(ValueError):
+			optimise.optimise(optimise.MemorySource(files), optimise.MemorySink(), solver="exact", engine="compact")
+		with self.assertRaises(ValueError):
+			optimise.optimise(optimise.MemorySource(files), optimise.MemorySink(), solver="exact", optimise_jobs=2)
+
+	def test_optimise_report_csv(self):
+		"""
+		Tests whether the report is written as CSV if the file name asks for it.
+		"""
+		self.enter_temporary_directory()
+		optimise.optimise("simple_tree", "output", report_file="report.csv")
+
+		self.assertTrue(os.path.exists(os.path.join("output", "simple_tree", "simple_tree.inst.cfg")), "Without a dry run, the profiles must still be written.")
+		with open("report.csv", newline="") as report_file:
+			rows = list(csv.DictReader(report_file))
+		self.assertEqual(len(rows), 4, "Each profile must get a row.")
+		self.assertEqual(rows[0], {"file": os.path.join("simple_tree", "simple_tree.inst.cfg"), "settings_before": "3", "settings_after": "3", "bytes_before": "46", "bytes_after": "46"})
+
+	def test_optimise_stages_report(self):
+		"""
+		Tests whether optimising with a stages file reports on each stage.
+		"""
+		self.enter_temporary_directory()
+		optimise.optimise("simple_tree", "output", stages_file="stages.json")
+
+		with open("stages.json") as stages_file:
+			report = json.load(stages_file)
+		self.assertEqual([stage["stage"] for stage in report["stages"]], ["get_profiles", "flatten_profiles", "bubble_common_values", "remove_redundancies", "write_profiles"], "Each stage must be reported in order.")
+		self.assertEqual(report["stages"][0]["profiles"], 4, "There are four profiles in the simple tree.")
+		self.assertEqual(report["stages"][0]["settings"], 6, "Six settings were loaded from the simple tree.")
+		self.assertGreater(report["stages"][1]["settings"], report["stages"][0]["settings"], "Flattening copies settings to all profiles.")
+		for stage in report["stages"]:
+			self.assertGreaterEqual(stage["wall_time"], 0)
+			self.assertGreaterEqual(stage["cpu_time"], 0)
+			self.assertGreaterEqual(stage["peak_traced_memory"], 0)
+
+	def test_optimise_streaming(self):
+		"""
+		Tests whether optimising while streaming gives the same files as
+		optimising the whole profile structure at once.
+		"""
+		self.enter_temporary_directory(copy_simple_tree=False)
+		pending = [(self.material_tree(), "printer")]
+		while pending: #Put the material tree on disk, with a directory for each profile with subprofiles.
+			profile, path = pending.pop()
+			if profile.subprofiles:
+				os.makedirs(path)
+				for subprofile in profile.subprofiles:
+					name = subprofile.filepath.split(".")[0]
+					pending.append((subprofile, os.path.join(path, name if subprofile.subprofiles else name + ".inst.cfg")))
+				path = os.path.join(path, os.path.basename(path) + ".inst.cfg")
+			with open(path, "w") as cfg_file:
+				cfg_file.write("[values]\n")
+				for key, value in profile.settings.items():
+					cfg_file.write("{key} = {value}\n".format(key=key, value=value))
+
+		optimise.optimise("printer", "whole")
+		optimise.optimise("printer", "streamed", engine="streaming")
+		self.assertEqual(len([file for _, _, files in os.walk("streamed") for file in files]), 8, "All profiles must be written.")
+		for directory, _, files in os.walk("whole"):
+			for file in files:
+				whole_file = os.path.join(directory, file)
+				with open(whole_file) as expected, open(os.path.join("streamed", os.path.relpath(whole_file, "whole"))) as actual:
+					self.assertEqual(actual.read(), expected.read(), "{file} must be the same.".format(file=whole_file))
+
+	@tests.tests.parametrise({
+		"cache_file": {"option_values": {"cache_file": "cache.pickle"}},
+		"jobs": {"option_values": {"jobs": 2}},
+		"write_jobs": {"option_values": {"write_jobs": 2}}
+	})
+	def test_optimise_streaming_unsupported(self, option_values):
+		"""
+		Tests whether the streaming engine refuses the options that it can't
+		use, instead of ignoring them.
+		:param option_values: The option that the streaming engine can't use.
+		"""
+		self.enter_temporary_directory()
+		with self.assertRaises(ValueError):
+			optimise.optimise("simple_tree", "output", engine="streaming", **option_values)
+		self.assertFalse(os.path.exists("output"), "Nothing must be written.")
+		self.assertFalse(os.path.exists("cache.pickle"), "No cache must be made.")
+
 	@tests.tests.parametrise({
 		"empty": {
 			"cfg_file": "empty.inst.cfg",
@@ -245,6 +943,10 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		"multiple": {
 			"cfg_file": "multiple.inst.cfg",
 			"settings": {"foo": "3", "bar": "4"}
+		},
+		"formatting": {
+			"cfg_file": "formatting.inst.cfg",
+			"settings": {"foo": "3", "bar": "4", "baz": "first line\nsecond line\n\nthird line", "equation": "a == b"} #Keys are lower case. Indented lines continue the value.
 		}
 	})
 	def test_parse_cfg(self, cfg_file, settings):
@@ -259,6 +961,51 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		profile = optimise.parse_cfg(cfg_file)
 		self.assertDictEqual(profile.settings, settings)
 
+	def test_parse_cfg_baseconfig(self):
+		"""
+		Tests whether the general and metadata sections of CFG files are kept
+		for writing the file later.
+		"""
+		profile = optimise.parse_cfg(os.path.join(self.data_directory, "formatting.inst.cfg"))
+		self.assertEqual(profile.baseconfig, (("general", (("name", "Fine"),)), ("metadata", (("type", "quality"),))))
+		profile = optimise.parse_cfg(os.path.join(self.data_directory, "simple.inst.cfg"))
+		self.assertEqual(profile.baseconfig, ()) #No sections to keep.
+
+	@tests.tests.parametrise({
+		"section": {
+			"contents": "[values]\napples = 3\n[values]\npears = 4\n",
+			"error": configparser.DuplicateSectionError
+		},
+		"key": {
+			"contents": "[values]\napples = 3\nApples = 4\n",
+			"error": configparser.DuplicateOptionError
+		}
+	})
+	def test_parse_cfg_duplicate(self, contents, error):
+		"""
+		Tests whether duplicate sections and keys are rejected, like ConfigParser
+		does.
+		:param contents: The contents of the CFG file.
+		:param error: The error that ConfigParser raises for these contents.
+		"""
+		with self.assertRaises(error):
+			configparser.ConfigParser().read_string(contents)
+		with self.assertRaises(error):
+			optimise.parse_cfg("duplicate.inst.cfg", contents)
+
+	def test_parse_cfg_same_as_configparser(self):
+		"""
+		Tests whether CFG files are parsed the same as by ConfigParser.
+		"""
+		for cfg_file in ["empty.inst.cfg", "formatting.inst.cfg", "multiple.inst.cfg", "simple.inst.cfg"]:
+			with self.subTest(cfg_file=cfg_file):
+				cfg_file = os.path.join(self.data_directory, cfg_file)
+				expected = configparser.ConfigParser()
+				expected.read(cfg_file)
+				with open(cfg_file) as lines:
+					actual = optimise.parse_cfg_sections(lines, cfg_file)
+				self.assertEqual(actual, {section: dict(expected[section]) for section in expected.sections()})
+
 	@tests.tests.parametrise({
 		"empty": {
 			"json_file": "empty.def.json",
@@ -291,6 +1038,10 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		"weird_names": {
 			"json_file": "weird_names.def.json",
 			"settings": {"value": "3", "default_value": "4", "": "5", " ": "6", "hè?": "7"}
+		},
+		"metadata": {
+			"json_file": "metadata.def.json",
+			"settings": {"foo": "2", "bar": "='b' if foo > 1 else 'a'"} #Labels, descriptions and metadata are not settings.
 		}
 	})
 	def test_parse_json(self, json_file, settings):
@@ -305,6 +1056,57 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		profile = optimise.parse_json(json_file)
 		self.assertDictEqual(profile.settings, settings)
 
+	@tests.tests.parametrise({
+		"file": {"in_memory": False},
+		"memory": {"in_memory": True}
+	})
+	def test_parse_xml(self, in_memory):
+		"""
+		Tests whether material files are correctly parsed.
+		:param in_memory: Whether to give the contents of the file to the
+		parser, instead of letting it read the file.
+		"""
+		xml_file = os.path.join(self.data_directory, "generic_pla.fdm_material")
+		contents = None
+		if in_memory:
+			with open(xml_file) as material_file:
+				contents = material_file.read()
+		profile = optimise.parse(xml_file, contents)
+		self.assertDictEqual(profile.settings, {
+			"default_material_print_temperature": "200",
+			"material_bed_temperature": "60",
+			"material_flow_temp_graph": "[[2,180],[10,230]]"
+		}, "Only settings for all printers that have a setting key are used, and the processing temperature graph becomes a list.")
+		self.assertEqual(profile.baseconfig, (("general", (("name", "PLA"),)), ("metadata", (("type", "material"),))))
+		self.assertTrue(optimise.is_material(profile))
+
+	def test_profile_traversal(self):
+		"""
+		Tests the order in which a profile structure is traversed.
+		"""
+		root = self.material_tree()
+		traversal = optimise.ProfileTraversal(root)
+		self.assertEqual([os.path.splitext(os.path.splitext(profile.filepath)[0])[0] for profile in traversal.profiles], ["root", "variant", "PLA", "quality1", "quality2", "other", "quality3", "quality4"], "Pre-order: Each profile before its subprofiles.")
+		self.assertEqual(traversal.parents, [-1, 0, 1, 2, 2, 1, 5, 5])
+		self.assertEqual(traversal.depths, [0, 1, 2, 3, 3, 2, 3, 3])
+		self.assertEqual(traversal.post_order, [3, 4, 2, 6, 7, 5, 1, 0], "Post-order: Each profile after its subprofiles.")
+
+	def test_remove_redundancies_deep(self):
+		"""
+		Tests optimising a profile structure that is deeper than the recursion
+		limit.
+		"""
+		leaf = optimise.Profile(filepath="leaf.inst.cfg", settings={"apples": "5"})
+		profile = leaf
+		for depth in range(3000):
+			profile = optimise.Profile(filepath="{depth}.inst.cfg".format(depth=depth), subprofiles=[profile])
+		profile.settings["apples"] = "1"
+		optimise.flatten_profiles(profile)
+		optimise.bubble_common_values(profile, 0)
+		optimise.remove_redundancies(profile)
+		self.assertDictEqual(profile.settings, {"apples": "5"}, "The value of the leaf bubbles all the way up.")
+		self.assertDictEqual(leaf.settings, {}, "Then the leaf has nothing left.")
+
 	def test_remove_redundancies_empty(self):
 		"""
 		Tests removing redundant settings with empty profiles.
@@ -349,6 +1151,23 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		self.assertDictEqual(grandchild.settings, {}, "The grandchild apples=3 was the same as the child apples=3, even though the child setting was removed due to redundancy.")
 		self.assertDictEqual(child.settings, {}, "The child apples=3 was the same as parent apples=3.")
 
+	def test_remove_redundancies_lazy_material(self):
+		"""
+		Tests removing redundancies of lazily flattened profiles below a
+		material profile.
+
+		Only the settings that the profiles store themselves are looked at, but
+		the non-material settings that they inherit from the material profile
+		are compared with the profile above the material profile.
+		"""
+		quality = optimise.Profile(settings={"material_bed_temperature": 60})
+		material = optimise.Profile(settings={"material_bed_temperature": 70, "layer_height": 0.2337}, filepath="/path/to/PLA.inst.cfg", subprofiles=[quality])
+		variant = optimise.Profile(settings={"material_bed_temperature": 60, "layer_height": 0.1337, "apples": 3}, subprofiles=[material])
+		optimise.flatten_profiles(variant, lazy=True)
+		optimise.remove_redundancies(variant)
+		self.assertDictEqual(quality.settings, {"material_bed_temperature": 60, "layer_height": 0.2337}, "The layer height it inherits from the material differs from the variant. The apples it inherits from the variant are the same.")
+		self.assertDictEqual(material.settings, {"material_bed_temperature": 70}, "Material profiles should only contain material settings.")
+
 	def test_remove_redundancies_mixed(self):
 		"""
 		Tests removing redundancies where only part of the settings are
@@ -391,4 +1210,127 @@ class TestOptimise(unittest.TestCase, metaclass=tests.tests.TestMeta):
 		"""
 		root = optimise.Profile(settings={"foo": "bar"})
 		optimise.remove_redundancies(root)
-		self.assertDictEqual(root.settings, {"foo": "bar"}, "The settings of the root should be untouched.")
\ No newline at end of file
+		self.assertDictEqual(root.settings, {"foo": "bar"}, "The settings of the root should be untouched.")
+
+	def test_remove_redundancies_track(self):
+		"""
+		Tests whether removing a tracked setting is logged, and removing other
+		settings isn't.
+		"""
+		child = optimise.Profile(filepath="child.inst.cfg", settings={"apples": 3, "pears": 8})
+		parent = optimise.Profile(settings={"apples": 3, "pears": 8}, subprofiles=[child])
+		token = optimise.tracked_setting.set("apples")
+		self.addCleanup(optimise.tracked_setting.reset, token)
+		with self.assertLogs(level="DEBUG") as logs:
+			optimise.remove_redundancies(parent)
+		self.assertEqual(len(logs.output), 1, "Only the removal of the tracked setting must be logged.")
+		self.assertIn("apples", logs.output[0])
+		self.assertIn("child.inst.cfg", logs.output[0])
+
+	def test_render_cfg_same_as_configparser(self):
+		"""
+		Tests whether profiles are rendered the same as by ConfigParser.
+		"""
+		profile = optimise.Profile(filepath=os.path.join("printer", "PLA", "PLA.inst.cfg"), settings={"material_flow": "100", "Bar": "first\nsecond", "default_material_print_temperature": "210"}, baseconfig=(("general", (("name", "PLA"),)), ("metadata", (("type", "material"),))))
+		expected = configparser.ConfigParser()
+		expected.read_dict({"general": {"name": "PLA"}, "metadata": {"type": "material"}, "values": {"bar": "first\nsecond", "print temperature": "210", "material_flow": "100"}}) #Material settings get their name in material profiles.
+		expected_file = io.StringIO()
+		expected.write(expected_file)
+		self.assertEqual(optimise.render_cfg(profile), expected_file.getvalue())
+
+	def test_watch(self):
+		"""
+		Tests whether watching a directory only parses the files that changed
+		and only writes the outputs that changed, and gives the same result as
+		optimising from scratch.
+		"""
+		self.enter_temporary_directory()
+		leaf_file = os.path.join("simple_tree", "subdirectory", "leaf1.inst.cfg")
+		def edit_leaf():
+			with open(leaf_file, "w") as leaf:
+				leaf.write("[values]\napples = 5\nbananas = 22\n") #Loses the tie with bananas = -1 of the other leaf, so only this output changes.
+		edits = [edit_leaf, lambda: None] #What happens while waiting after each round.
+
+		sink = optimise.MemorySink()
+		with unittest.mock.patch("optimise.parse", wraps=optimise.parse) as parse, unittest.mock.patch.object(sink, "write", wraps=sink.write) as write, unittest.mock.patch("time.sleep", side_effect=lambda _: edits.pop(0)()):
+			optimise.watch("simple_tree", sink, rounds=3)
+			self.assertEqual(parse.call_count, 5, "All 4 files are parsed in the first round, then only the changed file.")
+			parse.assert_called_with(leaf_file)
+			self.assertEqual(write.call_count, 5, "All 4 files are written in the first round, then only the changed output.")
+			self.assertEqual(write.call_args[0][0], leaf_file)
+
+		expected = optimise.MemorySink()
+		optimise.optimise("simple_tree", expected)
+		self.assertEqual(sink.files, expected.files, "Watching must not change the result.")
+		self.assertIn("bananas = 22", sink.files[leaf_file])
+
+	def test_watch_edits(self):
+		"""
+		Tests whether watching a directory keeps giving the same result as
+		optimising from scratch, when settings are removed from a leaf, when a
+		leaf gets a new value that bubbles up and when a file is added.
+		"""
+		self.enter_temporary_directory()
+		sink = optimise.MemorySink()
+		def write_file(file, contents):
+			expected = optimise.MemorySink()
+			optimise.optimise("simple_tree", expected)
+			self.assertEqual(sink.files, expected.files, "Watching must not change the result.")
+			with open(os.path.join("simple_tree", "subdirectory", file), "w") as profile_file:
+				profile_file.write(contents)
+		edits = [ #What happens while waiting after each round.
+			lambda: write_file("leaf1.inst.cfg", "[values]\n"), #Inherits apples = 4 from its parent instead.
+			lambda: write_file("leaf2.inst.cfg", "[values]\napples = 10\n"), #Wins the tie with apples = 4, and bubbles up to the root.
+			lambda: write_file("leaf3.inst.cfg", "[values]\napples = 4\n"), #Changes the structure.
+			lambda: write_file("leaf3.inst.cfg", "[values]\napples = 3\n")
+		]
+		with unittest.mock.patch("time.sleep", side_effect=lambda _: edits.pop(0)()):
+			optimise.watch("simple_tree", sink, rounds=5)
+
+		expected = optimise.MemorySink()
+		optimise.optimise("simple_tree", expected)
+		self.assertEqual(sink.files, expected.files, "Watching must not change the result.")
+
+	def test_write_file_threads(self):
+		"""
+		Tests whether multiple threads can replace the same file at the same
+		time.
+		"""
+		temporary_directory = tempfile.TemporaryDirectory()
+		self.addCleanup(temporary_directory.cleanup)
+		output_file = os.path.join(temporary_directory.name, "profile.inst.cfg")
+		barrier = threading.Barrier(2)
+		replace = os.replace
+		def replace_together(source, destination): #Both threads have written their temporary file before either replaces the output file.
+			barrier.wait(timeout=10)
+			replace(source, destination)
+		with unittest.mock.patch("os.replace", replace_together):
+			with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+				futures = [pool.submit(optimise.write_file, output_file, "[values]\napples = {apples}\n\n".format(apples=apples), skip_unchanged=True) for apples in (3, 4)]
+				for future in futures:
+					future.result() #Raises the errors of the threads.
+		with open(output_file) as profile_file:
+			self.assertIn(profile_file.read(), ["[values]\napples = 3\n\n", "[values]\napples = 4\n\n"])
+		self.assertEqual(os.listdir(temporary_directory.name), ["profile.inst.cfg"], "No temporary files may be left behind.")
+
+	def test_write_profiles_skip_unchanged(self):
+		"""
+		Tests whether writing profiles while skipping unchanged files only
+		rewrites the files whose contents change.
+		"""
+		temporary_directory = tempfile.TemporaryDirectory()
+		self.addCleanup(temporary_directory.cleanup)
+		child1 = optimise.Profile(filepath="child1.inst.cfg", settings={"apples": "3"})
+		child2 = optimise.Profile(filepath="child2.inst.cfg", settings={"apples": "4"})
+		parent = optimise.Profile(filepath="parent.inst.cfg", subprofiles=[child1, child2])
+		optimise.write_profiles(temporary_directory.name, parent)
+		for file in ["child1.inst.cfg", "child2.inst.cfg", "parent.inst.cfg"]:
+			os.utime(os.path.join(temporary_directory.name, file), (0, 0)) #Pretend they were written long ago.
+
+		child2.settings["apples"] = "5"
+		optimise.write_profiles(temporary_directory.name, parent, skip_unchanged=True, jobs=2)
+		self.assertEqual(os.path.getmtime(os.path.join(temporary_directory.name, "child1.inst.cfg")), 0, "The contents of child1 didn't change, so it must not be rewritten.")
+		self.assertNotEqual(os.path.getmtime(os.path.join(temporary_directory.name, "child2.inst.cfg")), 0, "The contents of child2 changed, so it must be rewritten.")
+		with open(os.path.join(temporary_directory.name, "child2.inst.cfg")) as child2_file:
+			self.assertEqual(child2_file.read(), "[values]\napples = 5\n\n")
+		self.assertEqual(sorted(os.listdir(temporary_directory.name)), ["child1.inst.cfg", "child2.inst.cfg", "parent.inst.cfg"], "No temporary files may be left behind.")
\ No newline at end of file